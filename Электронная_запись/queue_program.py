@@ -5,31 +5,321 @@
 АСИНХРОННАЯ ВЕРСИЯ - БЕЗ ЗАВИСАНИЙ
 """
 
+import time
+
+_STARTUP_T0 = time.perf_counter()  # точка отсчёта для STARTUP_PROFILE
+
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 from datetime import datetime, timedelta
 import threading
-import time
+import asyncio
+import contextvars
+import importlib.util
 import re
 import os
-from concurrent.futures import ThreadPoolExecutor
-from queue import Queue as ThreadQueue
-
-# TTS опционально
+import io
+import json
+import sqlite3
+import random
+import uuid
+import hashlib
+import tempfile
+import wave
+from collections import OrderedDict, deque
+from functools import partial
+from queue import Empty, Queue as ThreadQueue
+
+# TTS опционально. Сам pyttsx3 (импорт и init — до секунды и больше)
+# подключается в потоке Announcer, окно его не ждёт.
 try:
-    import pyttsx3
     import winsound
 
-    TTS_ENGINE = pyttsx3.init()
-    TTS_ENGINE.setProperty('rate', 150)
-    TTS_ENGINE.setProperty('volume', 1.0)
-    HAS_TTS = True
-except:
-    print("TTS не доступен")
-    TTS_ENGINE = None
+    HAS_TTS = importlib.util.find_spec("pyttsx3") is not None
+except ImportError:
     HAS_TTS = False
+if not HAS_TTS:
+    print("TTS не доступен")
+
+
+def create_tts_engine():
+    import pyttsx3
+
+    engine = pyttsx3.init()
+    engine.setProperty('rate', 150)
+    engine.setProperty('volume', 1.0)
+    return engine
+
 
 CHECK_INTERVAL = 10
+POST_RETRIES = 2  # повторы POST с Idempotency-Key при таймауте/обрыве связи
+
+# HTTP: один httpx.AsyncClient на программу (см. ApiLoop) — TLS-соединения к API
+# переиспользуются (keep-alive), одновременно не больше API_WORKERS запросов.
+# GET/PUT идемпотентны и повторяются с экспоненциальной задержкой со случайным
+# разбросом (full jitter).
+API_WORKERS = 5
+API_RETRIES = int(os.getenv("API_RETRIES", "2"))
+API_BACKOFF_BASE = float(os.getenv("API_BACKOFF_BASE", "0.3"))  # секунды, удваивается
+API_BACKOFF_MAX = float(os.getenv("API_BACKOFF_MAX", "5"))
+API_RETRY_STATUSES = (429, 502, 503, 504)
+API_CONNECT_TIMEOUT = 5
+# (префикс пути, таймаут чтения); первый совпавший, иначе API_READ_TIMEOUT
+API_READ_TIMEOUTS = (
+    ("/api/health", 6),
+    ("/api/queue", 10),
+    ("/api/doctors", 10),
+    ("/api/available-slots", 10),
+    ("/api/appointments/today", 15),
+    ("/api/stats", 30),
+    ("/api/batch", 60),
+)
+API_READ_TIMEOUT = 20
+
+# Профиль запуска: STARTUP_PROFILE=1 — напечатать, через сколько секунд от
+# старта процесса прошёл каждый этап (окно, HTTP-клиент, ответ API, данные).
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "").strip() not in ("", "0")
+_startup_marks = {}
+
+
+def startup_mark(stage, final=False):
+    if not STARTUP_PROFILE or stage in _startup_marks:
+        return
+    _startup_marks[stage] = time.perf_counter() - _STARTUP_T0
+    if final:
+        print("Запуск: " + ", ".join(
+            f"{name} {t:.2f} с" for name, t in sorted(_startup_marks.items(), key=lambda kv: kv[1])))
+
+# ------------------------------
+# Трассировка (traceparent -> сервер, Zipkin JSON)
+# ------------------------------
+# Каждый HTTP-запрос к API — span с заголовком traceparent, сервер продолжает
+# тот же trace (обработчик, SQL). Задачи ApiLoop и ожидание в ui_queue
+# тоже попадают в trace, поэтому видно, где теряется время: очередь UI, сеть
+# или сервер. Включается переменными TRACE_FILE и/или TRACE_ZIPKIN_URL.
+TRACE_FILE = os.getenv("TRACE_FILE", "").strip()
+TRACE_ZIPKIN_URL = os.getenv("TRACE_ZIPKIN_URL", "").strip()
+TRACE_ENABLED = bool(TRACE_FILE or TRACE_ZIPKIN_URL)
+TRACE_SERVICE = "queue-program"
+
+_trace_stack = contextvars.ContextVar("trace_stack", default=())  # и в потоках, и в задачах asyncio
+_trace_buffer = ThreadQueue(maxsize=10000)
+_trace_started = threading.Event()
+
+
+def _trace_current():
+    stack = _trace_stack.get()
+    return stack[-1] if stack else None
+
+
+def _trace_record(name, parent, trace_id, span_id, start_us, duration_us, kind=None, tags=None):
+    record = {
+        "traceId": trace_id,
+        "id": span_id,
+        "name": name,
+        "timestamp": start_us,
+        "duration": max(1, duration_us),
+        "localEndpoint": {"serviceName": TRACE_SERVICE},
+        "tags": {k: str(v) for k, v in (tags or {}).items()},
+    }
+    if parent:
+        record["parentId"] = parent[1]
+    if kind:
+        record["kind"] = kind
+    if not _trace_started.is_set():
+        _trace_started.set()
+        threading.Thread(target=_trace_export_loop, daemon=True).start()
+    try:
+        _trace_buffer.put_nowait(record)
+    except Exception:
+        pass
+
+
+class trace_span:
+    """with trace_span("GET /api/queue", kind="CLIENT") as span: span.traceparent -> заголовок"""
+
+    def __init__(self, name, kind=None, **tags):
+        self.name = name
+        self.kind = kind
+        self.tags = tags
+
+    def __enter__(self):
+        if not TRACE_ENABLED:
+            return self
+        self.parent = _trace_current()
+        self.trace_id = self.parent[0] if self.parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start_us = time.time_ns() // 1000
+        self.start_ns = time.perf_counter_ns()
+        self._token = _trace_stack.set(_trace_stack.get() + ((self.trace_id, self.span_id),))
+        return self
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01" if TRACE_ENABLED else None
+
+    def __exit__(self, exc_type, exc, tb):
+        if not TRACE_ENABLED:
+            return False
+        _trace_stack.reset(self._token)
+        if exc is not None:
+            self.tags["error"] = f"{exc_type.__name__}: {exc}"
+        _trace_record(self.name, self.parent, self.trace_id, self.span_id, self.start_us,
+                      (time.perf_counter_ns() - self.start_ns) // 1000, self.kind, self.tags)
+        return False
+
+
+class _UITask:
+    """Задача для ui_queue: помнит, когда и из какого trace её поставили."""
+
+    __slots__ = ("fn", "parent", "enqueued_us", "enqueued_ns")
+
+    def __init__(self, fn, parent):
+        self.fn = fn
+        self.parent = parent
+        self.enqueued_us = time.time_ns() // 1000
+        self.enqueued_ns = time.perf_counter_ns()
+
+    def __call__(self):
+        if self.parent is None:
+            return self.fn()
+        trace_id = self.parent[0]
+        wait_us = (time.perf_counter_ns() - self.enqueued_ns) // 1000
+        _trace_record("ui.queue_wait", self.parent, trace_id, os.urandom(8).hex(), self.enqueued_us, wait_us)
+        token = _trace_stack.set((self.parent,))
+        try:
+            with trace_span("ui.task", **{"ui.callback": getattr(self.fn, "__qualname__", "?")}):
+                return self.fn()
+        finally:
+            _trace_stack.reset(token)
+
+
+class TracedUIQueue(ThreadQueue):
+    """ui_queue: помечает задачи временем постановки (лаг для UIDispatcher),
+    а при включённой трассировке ещё и trace'ом, из которого их поставили."""
+
+    def put(self, item, block=True, timeout=None):
+        if callable(item):
+            item = _UITask(item, _trace_current())
+        super().put(item, block, timeout)
+
+
+def _trace_export_loop():
+    import json
+    import urllib.request
+
+    while True:
+        batch = [_trace_buffer.get()]
+        deadline = time.monotonic() + 1
+        while len(batch) < 200:
+            try:
+                batch.append(_trace_buffer.get(timeout=max(0.0, deadline - time.monotonic())))
+            except Empty:
+                break
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                    for record in batch:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if TRACE_ZIPKIN_URL:
+                req = urllib.request.Request(
+                    TRACE_ZIPKIN_URL,
+                    data=json.dumps(batch).encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                    method="POST",
+                )
+                urllib.request.urlopen(req, timeout=5).close()
+        except Exception as e:
+            print(f"Ошибка экспорта трассировки: {e}")
+
+# ------------------------------
+# Диспетчер UI-задач (главный поток Tk)
+# ------------------------------
+# Фоновые потоки кладут callbacks в ui_queue; главный поток забирает их без
+# ожидания (get_nowait) и выполняет, пока не исчерпан бюджет кадра, остальное —
+# в следующем кадре. Одинаковые обновления (self.refresh_queue и т.п.),
+# ещё не выполненные, склеиваются в одно. Лаг очереди (от put до выполнения)
+# копится в stats и раз в UI_STATS_LOG_SECONDS печатается, если был заметен.
+UI_FRAME_BUDGET_MS = 12
+UI_IDLE_POLL_MS = 50
+UI_STATS_LOG_SECONDS = 300
+UI_LAG_ALPHA = 0.1
+
+
+class UIDispatcher:
+    def __init__(self, root, ui_queue):
+        self.root = root
+        self.ui_queue = ui_queue
+        self._pending = deque()     # (задача, ключ склейки)
+        self._pending_keys = set()
+        self._last_log = time.monotonic()
+        self.stats = {"ran": 0, "coalesced": 0, "errors": 0,
+                      "lag_ewma_ms": 0.0, "lag_max_ms": 0.0, "frame_max_ms": 0.0}
+
+    @staticmethod
+    def _coalesce_key(task):
+        """Склеиваем только bound-методы без аргументов: self.refresh_queue, display.refresh."""
+        fn = getattr(task, "fn", task)  # _UITask -> исходный callback
+        owner = getattr(fn, "__self__", None)
+        if owner is None or not hasattr(fn, "__func__"):
+            return None
+        return id(owner), fn.__func__
+
+    def _pull(self):
+        while True:
+            try:
+                task = self.ui_queue.get_nowait()
+            except Empty:
+                return
+            key = self._coalesce_key(task)
+            if key is not None:
+                if key in self._pending_keys:
+                    self.stats["coalesced"] += 1
+                    continue
+                self._pending_keys.add(key)
+            self._pending.append((task, key))
+
+    def _record_lag(self, task):
+        enqueued_ns = getattr(task, "enqueued_ns", None)
+        if enqueued_ns is None:
+            return
+        lag_ms = (time.perf_counter_ns() - enqueued_ns) / 1e6
+        stats = self.stats
+        stats["lag_ewma_ms"] += UI_LAG_ALPHA * (lag_ms - stats["lag_ewma_ms"])
+        stats["lag_max_ms"] = max(stats["lag_max_ms"], lag_ms)
+
+    def run_frame(self):
+        start = time.perf_counter()
+        deadline = start + UI_FRAME_BUDGET_MS / 1000
+        self._pull()
+        while self._pending and time.perf_counter() < deadline:
+            task, key = self._pending.popleft()
+            if key is not None:
+                self._pending_keys.discard(key)
+            self._record_lag(task)
+            try:
+                task()
+                self.stats["ran"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Ошибка UI-задачи: {e}")
+
+        frame_ms = (time.perf_counter() - start) * 1000
+        self.stats["frame_max_ms"] = max(self.stats["frame_max_ms"], frame_ms)
+        self._maybe_log()
+        # остались задачи — следующий кадр сразу, иначе редкий опрос
+        self.root.after(1 if self._pending else UI_IDLE_POLL_MS, self.run_frame)
+
+    def _maybe_log(self):
+        if time.monotonic() - self._last_log < UI_STATS_LOG_SECONDS:
+            return
+        self._last_log = time.monotonic()
+        stats = self.stats
+        if stats["lag_max_ms"] > UI_FRAME_BUDGET_MS * 4 or stats["errors"]:
+            print("UI: выполнено {ran}, склеено {coalesced}, ошибок {errors}, лаг ср. {lag_ewma_ms:.0f} мс / "
+                  "макс. {lag_max_ms:.0f} мс, самый долгий кадр {frame_max_ms:.0f} мс".format(**stats))
+        stats["lag_max_ms"] = stats["frame_max_ms"] = 0.0
+
 
 # ------------------------------
 # Темы оформления (Light/Dark)
@@ -172,165 +462,1118 @@ def apply_theme_recursive(widget, theme: dict):
         apply_theme_recursive(child, theme)
 
 
+class TreeSync:
+    """Обновление Treeview по ключу вместо «удалить всё и вставить заново»:
+    новые строки вставляются, изменённые — обновляются, переставленные —
+    переносятся, исчезнувшие — удаляются. Выделение и прокрутка сохраняются,
+    нетронутые строки не перерисовываются."""
+
+    def __init__(self, tree, key, values):
+        self.tree = tree
+        self.key = key            # row -> iid
+        self.values = values      # row -> tuple для колонок
+        self._values = {}         # iid -> последние записанные values
+
+    def apply(self, rows) -> bool:
+        """True — если в таблице что-то поменялось."""
+        tree = self.tree
+        wanted = [(str(self.key(row)), tuple(self.values(row))) for row in rows]
+        wanted_ids = {iid for iid, _ in wanted}
+
+        current = list(tree.get_children())
+        stale = [iid for iid in current if iid not in wanted_ids]
+        changed = bool(stale)
+        if stale:
+            tree.delete(*stale)
+            for iid in stale:
+                self._values.pop(iid, None)
+            current = [iid for iid in current if iid in wanted_ids]
+
+        for index, (iid, vals) in enumerate(wanted):
+            if index < len(current) and current[index] == iid:
+                pass
+            elif tree.exists(iid):
+                tree.move(iid, '', index)
+                current.remove(iid)
+                current.insert(index, iid)
+                changed = True
+            else:
+                tree.insert('', index, iid=iid, values=vals)
+                current.insert(index, iid)
+                self._values[iid] = vals
+                changed = True
+                continue
+            if self._values.get(iid) != vals:
+                tree.item(iid, values=vals)
+                self._values[iid] = vals
+                changed = True
+        return changed
+
+
+# ------------------------------
+# Озвучивание вызовов (один поток TTS)
+# ------------------------------
+# pyttsx3 не потокобезопасен, поэтому движком пользуется только поток
+# Announcer. Вызовы звучат по очереди (FIFO). Если того же пациента в тот же
+# кабинет уже ждут в очереди, вызывают сейчас или вызывали последние
+# ANNOUNCE_DEDUP_SECONDS, повтор пропускается. Неизменные части фразы
+# («Приглашаем пациента», «в Кабинет 1») синтезируются один раз в WAV
+# (ANNOUNCE_CACHE_DIR). При вызове синтезируется только имя, а части
+# склеиваются и играются одним звуком. Имена на диск не пишутся — их кэш
+# только в памяти.
+ANNOUNCE_CACHE_DIR = os.getenv("ANNOUNCE_CACHE_DIR",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache"))
+ANNOUNCE_DEDUP_SECONDS = 10
+ANNOUNCE_NAME_CACHE = 100
+ANNOUNCE_PREFIX = "Приглашаем пациента"
+
+
+def _read_wav(path):
+    with wave.open(path, "rb") as w:
+        return w.getparams()[:3], w.readframes(w.getnframes())  # (каналы, ширина, частота), кадры
+
+
+class Announcer:
+    def __init__(self, engine_factory):
+        self.engine_factory = engine_factory  # вызывается в потоке Announcer
+        self.engine = None
+        self.available = True
+        self._cond = threading.Condition()
+        self._queue = deque()       # (пациент, кабинет)
+        self._warm = deque()        # фрагменты для синтеза заранее
+        self._current = None
+        self._recent = {}           # (пациент, кабинет) -> когда прозвучал
+        self._fragments = {}        # текст -> (параметры, кадры)
+        self._names = OrderedDict()  # LRU имён
+        self._can_render = True     # False — синтез в файл не работает, говорим напрямую
+        os.makedirs(ANNOUNCE_CACHE_DIR, exist_ok=True)
+        threading.Thread(target=self._run, name="announcer", daemon=True).start()
+        self.warm([])
+
+    def announce(self, patient_name, room) -> bool:
+        if not self.available:
+            return False
+        key = (str(patient_name), str(room))
+        with self._cond:
+            recent = self._recent.get(key)
+            if key == self._current or key in self._queue or (
+                    recent is not None and time.monotonic() - recent < ANNOUNCE_DEDUP_SECONDS):
+                return False
+            self._queue.append(key)
+            self._cond.notify()
+        return True
+
+    def warm(self, rooms):
+        """Синтезировать заранее «в <кабинет>» (и начало фразы), пока вызовов нет."""
+        texts = [ANNOUNCE_PREFIX] + [f"в {room}" for room in rooms]
+        with self._cond:
+            for text in texts:
+                if text not in self._fragments and text not in self._warm:
+                    self._warm.append(text)
+            self._cond.notify()
+
+    def _run(self):
+        try:
+            self.engine = self.engine_factory()
+        except Exception as e:
+            print(f"TTS не доступен: {e}")
+            self.available = False
+            return
+        startup_mark("TTS")
+        while True:
+            with self._cond:
+                while not self._queue and not self._warm:
+                    self._cond.wait()
+                if self._queue:  # вызовы важнее прогрева
+                    self._current, text = self._queue.popleft(), None
+                else:
+                    text = self._warm.popleft()
+            try:
+                if text is not None:
+                    if self._can_render:
+                        self._fragment(text)
+                    continue
+                self._speak(*self._current)
+            except Exception as e:
+                if text is not None:
+                    print(f"Синтез в файл недоступен, озвучиваем напрямую: {e}")
+                    self._can_render = False
+                else:
+                    print(f"Ошибка озвучивания: {e}")
+            finally:
+                if text is None:
+                    with self._cond:
+                        now = time.monotonic()
+                        self._recent[self._current] = now
+                        self._recent = {k: t for k, t in self._recent.items()
+                                        if now - t < ANNOUNCE_DEDUP_SECONDS}
+                        self._current = None
+
+    def _speak(self, patient_name, room):
+        try:
+            winsound.MessageBeep()
+            winsound.Beep(1000, 300)
+        except Exception:
+            pass
+
+        if self._can_render:
+            try:
+                parts = [self._fragment(ANNOUNCE_PREFIX), self._name(patient_name), self._fragment(f"в {room}")]
+                if self._play(parts):
+                    return
+            except Exception as e:
+                print(f"Синтез в файл недоступен, озвучиваем напрямую: {e}")
+                self._can_render = False
+        self.engine.say(f"{ANNOUNCE_PREFIX} {patient_name} в {room}")
+        self.engine.runAndWait()
+
+    def _render(self, text, path):
+        self.engine.save_to_file(text, path)
+        self.engine.runAndWait()
+        return _read_wav(path)
+
+    def _fragment(self, text):
+        audio = self._fragments.get(text)
+        if audio is None:
+            voice = f"{self.engine.getProperty('voice')}|{self.engine.getProperty('rate')}|{text}"
+            path = os.path.join(ANNOUNCE_CACHE_DIR, hashlib.sha1(voice.encode("utf-8")).hexdigest() + ".wav")
+            audio = _read_wav(path) if os.path.exists(path) else self._render(text, path)
+            self._fragments[text] = audio
+        return audio
+
+    def _name(self, text):
+        audio = self._names.pop(text, None)
+        if audio is None:
+            fd, path = tempfile.mkstemp(suffix=".wav")
+            os.close(fd)
+            try:
+                audio = self._render(text, path)
+            finally:
+                os.remove(path)
+        self._names[text] = audio
+        while len(self._names) > ANNOUNCE_NAME_CACHE:
+            self._names.popitem(last=False)
+        return audio
+
+    @staticmethod
+    def _play(parts) -> bool:
+        """Склеить WAV-фрагменты и проиграть (синхронно). False — форматы фрагментов различаются."""
+        params = parts[0][0]
+        if any(p != params for p, _ in parts):
+            return False
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as w:
+            w.setnchannels(params[0])
+            w.setsampwidth(params[1])
+            w.setframerate(params[2])
+            for _, frames in parts:
+                w.writeframes(frames)
+        winsound.PlaySound(buf.getvalue(), winsound.SND_MEMORY)
+        return True
+
+
+# ------------------------------
+# Планировщик автообновления панели
+# ------------------------------
+# Вместо refresh_all каждые CHECK_INTERVAL секунд: пока данные не меняются,
+# интервал удваивается до REFRESH_MAX_INTERVAL; как только что-то поменялось —
+# снова CHECK_INTERVAL, после клика/клавиши — не позже чем через
+# REFRESH_ACTIVE_INTERVAL. Следующее обновление планируется только когда
+# пришли все ответы текущего — медленный API не копит обновления. Свёрнутое
+# окно не обновляется; при разворачивании — обновление сразу.
+REFRESH_ACTIVE_INTERVAL = 3
+REFRESH_MAX_INTERVAL = int(os.getenv("REFRESH_MAX_INTERVAL", "300"))
+
+
+class RefreshScheduler:
+    def __init__(self, root, refresh):
+        self.root = root
+        self.refresh = refresh  # refresh(done); done(changed) — когда все ответы получены и применены
+        self.interval = CHECK_INTERVAL
+        self.running = False
+        self._job = None
+        self._due = 0.0
+        root.bind('<Map>', self._on_map, add='+')
+
+    def _schedule(self, delay):
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+        self._due = time.monotonic() + delay
+        self._job = self.root.after(int(delay * 1000), self._tick)
+
+    def _tick(self):
+        self._job = None
+        if self.running:
+            return  # следующее запланирует finished()
+        if self.root.state() in ('iconic', 'withdrawn'):
+            return  # свёрнуто — ждём <Map>
+        self.running = True
+        try:
+            self.refresh(self.finished)
+        except Exception:
+            self.finished(False)  # иначе running останется True и автообновление встанет
+            raise
+
+    def finished(self, changed):
+        self.running = False
+        self.interval = CHECK_INTERVAL if changed else min(self.interval * 2, REFRESH_MAX_INTERVAL)
+        self._schedule(self.interval)
+
+    def now(self):
+        """Обновить сейчас (кнопка «Обновить», старт); идущее обновление не дублируем."""
+        self.interval = CHECK_INTERVAL
+        if not self.running:
+            self._schedule(0)
+
+    def poke(self, event=None):
+        """Действие пользователя: следующее обновление — не позже чем через REFRESH_ACTIVE_INTERVAL."""
+        self.interval = CHECK_INTERVAL
+        if not self.running and self._due - time.monotonic() > REFRESH_ACTIVE_INTERVAL:
+            self._schedule(REFRESH_ACTIVE_INTERVAL)
+
+    def _on_map(self, event):
+        if event.widget is self.root and self._job is None and not self.running:
+            self._schedule(0)
+
+
+# ------------------------------
+# Локальная копия и отложенные изменения (offline)
+# ------------------------------
+# Когда API недоступен (Koyeb просыпается, Supabase тормозит), программа не
+# должна показывать пустые таблицы и тем более придумывать свободное время.
+# Последние ответы API (врачи, очередь, записи по дням, слоты) лежат в
+# локальном SQLite: без связи чтения отдаются оттуда сразу, без ожидания
+# таймаутов. Изменения без связи пишутся в outbox того же файла и уходят по
+# порядку, когда API снова отвечает. Перед отправкой запись/строка очереди
+# сверяется с тем, что видел администратор: если на сервере её успели
+# изменить, изменение не применяется, а попадает в конфликты (их показывает
+# панель). Пока outbox не пуст, новые изменения тоже идут через него — чтобы
+# не обогнать более ранние.
+OFFLINE_DB = os.getenv("OFFLINE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "queue_offline.db"))
+OFFLINE_PROBE_SECONDS = 15          # как часто без связи проверять /api/health
+OFFLINE_SLOTS_MAX_AGE = 6 * 3600    # более старые слоты не показываем: лучше пусто, чем двойная запись
+OFFLINE_KEEP_DAYS = 14              # копии старше удаляются при запуске
+OFFLINE_HTTP_STATUSES = (502, 503, 504)  # ответ шлюза при спящем/упавшем сервере — тоже «нет связи»
+
+# Записи по дням: при переключении дня таблица сразу берётся из копии, а ответ
+# API приходит следом. Сервер отдаёт ETag, поэтому неизменившийся день
+# перепроверяется ответом 304 без тела. После загрузки текущего дня соседние
+# (по APPOINTMENTS_PREFETCH_DAYS в обе стороны) подгружаются в фоне — если их
+# не перепроверяли дольше APPOINTMENTS_FRESH_SECONDS или с тех пор записи менялись.
+APPOINTMENTS_PREFETCH_DAYS = int(os.getenv("APPOINTMENTS_PREFETCH_DAYS", "3"))
+APPOINTMENTS_FRESH_SECONDS = float(os.getenv("APPOINTMENTS_FRESH_SECONDS", "60"))
+
+# op -> (метод, путь, как назвать администратору); args: {"id": ..., "data": {...}}
+OFFLINE_OPS = {
+    "appointment.create": ("POST", "/api/appointments", "новая запись"),
+    "appointment.update": ("PUT", "/api/appointments/{id}", "изменение записи"),
+    "appointment.cancel": ("PUT", "/api/appointments/{id}/cancel", "отмена записи"),
+    "queue.add": ("POST", "/api/queue", "добавление в очередь"),
+    "queue.status": ("PUT", "/api/queue/{id}/status", "статус в очереди"),
+    "doctor.status": ("PUT", "/api/doctors/{id}/status", "статус врача"),
+    "batch": ("POST", "/api/batch", "неявка"),
+}
+OFFLINE_CREATES = ("appointment.create", "queue.add")  # сервер выдаёт id — локальный (-id outbox) заменяем на него
+QUEUE_CLOSED_STATUSES = ("завершён", "не_пришёл", "отменён")
+# какой статус получает запись, когда её строку очереди закрывают (у «отменён» — никакого)
+QUEUE_CLOSE_APPOINTMENT_STATUS = {"завершён": "завершена", "не_пришёл": "не_пришёл"}
+
+
+class LocalIdMissing(Exception):
+    """Изменение ссылается на запись, созданную без связи, которую сервер не принял."""
+
+
+class OfflineStore:
+    """Копия ответов API и outbox изменений в одном SQLite-файле (общий для всех потоков)."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self._lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS mirror (
+                    key TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    base TEXT,
+                    idempotency_key TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS local_ids (
+                    local_id INTEGER PRIMARY KEY,
+                    server_id INTEGER NOT NULL
+                );
+            """)
+            self.conn.execute("DELETE FROM mirror WHERE fetched_at < ?",
+                              (time.time() - OFFLINE_KEEP_DAYS * 86400,))
+
+    # ---------- копия ответов ----------
+    def put(self, key, data):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO mirror (key, data, fetched_at) VALUES (?, ?, ?)",
+                              (key, json.dumps(data, ensure_ascii=False), time.time()))
+
+    def get(self, key, max_age=None):
+        with self._lock:
+            row = self.conn.execute("SELECT data, fetched_at FROM mirror WHERE key = ?", (key,)).fetchone()
+        if row is None or (max_age is not None and time.time() - row["fetched_at"] > max_age):
+            return None
+        return json.loads(row["data"])
+
+    def keys(self, prefix):
+        with self._lock:
+            rows = self.conn.execute("SELECT key FROM mirror WHERE key LIKE ?", (prefix + "%",)).fetchall()
+        return [row["key"] for row in rows]
+
+    # ---------- outbox ----------
+    def enqueue(self, op, args, base=None, idempotency_key=None) -> int:
+        with self._lock, self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO outbox (op, args, base, idempotency_key, created_at) VALUES (?, ?, ?, ?, ?)",
+                (op, json.dumps(args, ensure_ascii=False),
+                 json.dumps(base, ensure_ascii=False) if base is not None else None,
+                 idempotency_key or str(uuid.uuid4()), time.time()),
+            )
+            return cur.lastrowid
+
+    def _entries(self, state):
+        with self._lock:
+            rows = self.conn.execute("SELECT * FROM outbox WHERE state = ? ORDER BY id", (state,)).fetchall()
+        return [
+            {**dict(row), "args": json.loads(row["args"]),
+             "base": json.loads(row["base"]) if row["base"] else None}
+            for row in rows
+        ]
+
+    def pending(self) -> list:
+        return self._entries("pending")
+
+    def has_pending(self) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM outbox WHERE state = 'pending' LIMIT 1").fetchone() is not None
+
+    def done(self, entry_id, server_id=None):
+        with self._lock, self.conn:
+            if server_id is not None:
+                self.conn.execute("INSERT OR REPLACE INTO local_ids (local_id, server_id) VALUES (?, ?)",
+                                  (-entry_id, server_id))
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def failed(self, entry_id, error):
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE outbox SET attempts = attempts + 1, error = ? WHERE id = ?",
+                              (str(error), entry_id))
+
+    def conflict(self, entry_id, error):
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE outbox SET state = 'conflict', error = ? WHERE id = ?", (str(error), entry_id))
+
+    def take_conflicts(self) -> list:
+        """Конфликты для показа администратору; показанные удаляются."""
+        conflicts = self._entries("conflict")
+        if conflicts:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM outbox WHERE state = 'conflict' AND id <= ?", (conflicts[-1]["id"],))
+        return conflicts
+
+    def server_id(self, value):
+        """Локальный id (отрицательный, = -id в outbox) -> id на сервере; обычный id — как есть."""
+        if not isinstance(value, int) or value >= 0:
+            return value
+        with self._lock:
+            row = self.conn.execute("SELECT server_id FROM local_ids WHERE local_id = ?", (value,)).fetchone()
+        return row["server_id"] if row else value
+
+    def resolve(self, value):
+        """args для отправки: все id/appointment_id заменены на серверные."""
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        out = {}
+        for k, v in value.items():
+            if k in ("id", "appointment_id") and isinstance(v, int) and v < 0:
+                v = self.server_id(v)
+                if v < 0:
+                    raise LocalIdMissing("связанная запись не была создана на сервере")
+            out[k] = self.resolve(v)
+        return out
+
+
+def _queue_status_items(entry) -> list:
+    """(queue_id, статус) изменений статуса очереди из записи outbox (одиночной или пакета)."""
+    if entry["op"] == "queue.status":
+        return [(entry["args"]["id"], entry["args"]["data"]["status"])]
+    if entry["op"] == "batch":
+        return [(item["id"], item["status"]) for item in entry["args"]["data"]["items"]
+                if item.get("op") == "queue.status"]
+    return []
+
+
+def apply_pending(key, rows, pending, server_id):
+    """Данные сервера/копии + ещё не отправленные изменения — администратор видит то, что сделал.
+    key: doctors, queue, appointments:<дата>, slots:<дата>:<врач>."""
+    if not isinstance(rows, list) or not pending:
+        return rows
+    kind, _, rest = key.partition(":")
+    rows = [dict(row) if isinstance(row, dict) else row for row in rows]
+
+    def same(a, b):
+        return server_id(a) == server_id(b)
+
+    for entry in pending:
+        op, args, base = entry["op"], entry["args"], entry["base"] or {}
+        data = args.get("data") or {}
+        local_id = -entry["id"]
+
+        if kind == "doctors" and op == "doctor.status":
+            for row in rows:
+                if same(row["id"], args["id"]):
+                    row["status"] = data["status"]
+
+        elif kind == "appointments":
+            if op == "appointment.create" and data["appointment_date"] == rest:
+                rows.append({**data, **base, "id": local_id, "status": "активна"})
+            elif op == "appointment.update":
+                row = next((r for r in rows if same(r["id"], args["id"])), None)
+                if row is None and data.get("appointment_date") == rest and base.get("row"):
+                    row = dict(base["row"])
+                    rows.append(row)
+                if row is not None:
+                    row.update(data)
+                    row.update({k: base[k] for k in ("doctor_name", "room") if k in base})
+                    if row["appointment_date"] != rest:
+                        rows.remove(row)
+            elif op == "appointment.cancel":
+                rows = [r for r in rows if not same(r["id"], args["id"])]
+
+        elif kind == "queue":
+            if op == "queue.add":
+                rows.append({**base, "id": local_id, "appointment_id": data["appointment_id"], "status": "ожидание"})
+            elif op == "appointment.cancel":
+                rows = [r for r in rows if not same(r.get("appointment_id"), args["id"])]
+            for queue_id, status in _queue_status_items(entry):
+                for row in rows:
+                    if same(row["id"], queue_id):
+                        row["status"] = status
+                rows = [r for r in rows if r["status"] not in QUEUE_CLOSED_STATUSES]
+
+        elif kind == "slots" and op in ("appointment.create", "appointment.update"):
+            # занятое без связи время убираем; освобождённое — не возвращаем (надёжнее)
+            date, _, doctor_id = rest.partition(":")
+            target = {**(base.get("row") or {}), **data}
+            if target.get("appointment_date") == date and str(target.get("doctor_id")) == doctor_id:
+                taken = target.get("appointment_time")
+                rows = [t for t in rows if (t.get("time") if isinstance(t, dict) else t) != taken]
+
+    if kind == "appointments":
+        rows.sort(key=lambda r: str(r.get("appointment_time", "")))
+    return rows
+
+
+# ------------------------------
+# Запросы к API: один поток asyncio (httpx)
+# ------------------------------
+# Все запросы к API — корутины в одном event loop (поток api-loop) с общим
+# httpx.AsyncClient; обработчики кнопок больше не заводят по потоку на
+# действие. submit() запускает задачу, а результат передаёт в Tk через
+# ui_queue (UIDispatcher):
+#   key   — одинаковые задачи не дублируются: пока первая идёт, следующие
+#           подписываются на её результат (обновление панели и экрана очереди);
+#   group — новая задача группы отменяет предыдущую (слоты для даты, которую
+#           уже сменили): её callback не вызывается, запрос прерывается.
+# Локальная копия (OfflineStore) читается прямо в loop — это локальный SQLite.
+
+
+class ApiTask:
+    """Подписка на результат submit(); cancel() — результат больше не нужен."""
+
+    __slots__ = ("callback", "group", "cancelled", "job", "_loop")
+
+    def __init__(self, loop, callback, group):
+        self._loop = loop
+        self.callback = callback
+        self.group = group
+        self.cancelled = False
+        self.job = None
+
+    def cancel(self):
+        self.cancelled = True
+        self._loop.loop.call_soon_threadsafe(self._loop._cancel, self)
+
+
+class _ApiJob:
+    __slots__ = ("task", "key", "tickets")
+
+    def __init__(self, key):
+        self.task = None
+        self.key = key
+        self.tickets = []
+
+
+class ApiLoop:
+    def __init__(self, deliver=None):
+        self.deliver = deliver  # deliver(fn) — выполнить fn в потоке Tk; None — прямо в loop
+        self.loop = asyncio.new_event_loop()
+        self._jobs = {}    # key -> _ApiJob
+        self._groups = {}  # group -> ApiTask
+        self.stats = {"started": 0, "deduplicated": 0, "superseded": 0}
+        threading.Thread(target=self._run, name="api-loop", daemon=True).start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, make_coro, callback=None, key=None, group=None) -> ApiTask:
+        """make_coro() -> корутина (создаётся в loop); callback(result, error) — в потоке Tk."""
+        ticket = ApiTask(self, callback, group)
+        self.loop.call_soon_threadsafe(self._start, make_coro, ticket, key)
+        return ticket
+
+    def _start(self, make_coro, ticket, key):
+        if ticket.cancelled:
+            return
+        if ticket.group is not None:
+            previous = self._groups.get(ticket.group)
+            if previous is not None:
+                self.stats["superseded"] += 1
+                self._cancel(previous)
+            self._groups[ticket.group] = ticket
+
+        job = self._jobs.get(key) if key is not None else None
+        if job is None:
+            job = _ApiJob(key)
+            job.task = self.loop.create_task(self._run_job(job, make_coro))
+            if key is not None:
+                self._jobs[key] = job
+            self.stats["started"] += 1
+        else:
+            self.stats["deduplicated"] += 1
+        job.tickets.append(ticket)
+        ticket.job = job
+
+    def _cancel(self, ticket):
+        ticket.cancelled = True
+        if self._groups.get(ticket.group) is ticket:
+            del self._groups[ticket.group]
+        job = ticket.job
+        if job is None or ticket not in job.tickets:
+            return
+        job.tickets.remove(ticket)
+        if not job.tickets and not job.task.done():
+            # больше никто не ждёт — прерываем запрос; новая такая же задача начнётся заново
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+            job.task.cancel()
+
+    async def _run_job(self, job, make_coro):
+        coro = make_coro()
+        with trace_span(getattr(coro, "__qualname__", "api.task").replace(".<locals>", "")):
+            try:
+                result, error = await coro, None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result, error = None, str(e)
+            finally:
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+            # доставляем из задачи — ui-задача остаётся в том же trace
+            for ticket in job.tickets:
+                if self._groups.get(ticket.group) is ticket:
+                    del self._groups[ticket.group]
+                if ticket.cancelled or ticket.callback is None:
+                    continue
+                if self.deliver is None:
+                    ticket.callback(result, error)
+                else:
+                    self.deliver(partial(ticket.callback, result, error))
+
+
 class Database:
-    """Асинхронный API клиент"""
+    """Асинхронный API клиент: методы — корутины для ApiLoop; из Tk — через submit()"""
 
-    def __init__(self):
+    def __init__(self, deliver=None):
         self.api_base = os.getenv("API_BASE", "").strip().rstrip("/")
         if not self.api_base:
             self.api_base = "https://spatial-jaime-dental-clinictj-7c05d6e5.koyeb.app"
 
-        try:
-            import requests
-            self._requests = requests
-        except Exception as e:
-            raise RuntimeError("Не установлен пакет requests. Установите: pip install requests") from e
+        if importlib.util.find_spec("httpx") is None:
+            raise RuntimeError("Не установлен пакет httpx. Установите: pip install httpx")
+
+        # Локальная копия и outbox (см. OfflineStore); то, что осталось с прошлого запуска, отправим первым
+        self.offline = OfflineStore(OFFLINE_DB)
+        self.online = not self.offline.has_pending()
+        self._etags = {}  # key копии -> ETag ответа, с которым она сохранена
+        self._fresh = {}  # key копии -> time.monotonic() последней проверки у сервера
+        self._writes = 0  # счётчик отправленных изменений — в ключе обновлений таблиц (см. get_queue_async)
+
+        # Импорт httpx, клиент и проверка /api/health — первой задачей в loop, окно их не ждёт
+        self.api = ApiLoop(deliver)
+        self.submit(self._start)
+
+    def submit(self, make_coro, callback=None, key=None, group=None) -> ApiTask:
+        """Выполнить корутину в ApiLoop; callback(result, error) — в потоке Tk (см. ApiLoop)"""
+        return self.api.submit(make_coro, callback, key, group)
 
-        # Thread pool для асинхронных запросов
-        self.executor = ThreadPoolExecutor(max_workers=5)
+    async def _start(self):
+        import httpx
+
+        self._httpx = httpx
+        # Общий клиент: не больше API_WORKERS соединений, остальные запросы ждут свободного (keep-alive)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=API_WORKERS, max_keepalive_connections=API_WORKERS),
+        )
+        startup_mark("HTTP-клиент")
 
         # Проверка доступности
         try:
-            self.api_get("/api/health", timeout=6)
+            await self.api_get("/api/health")
             print(f"✓ Подключено к API: {self.api_base}")
         except Exception as e:
             print(f"⚠ Не удалось подключиться к API: {e}")
+            self.online = False
+        startup_mark("проверка API")
+
+        self.api.loop.create_task(self._sync_loop())
 
     def _url(self, path: str) -> str:
         if not path.startswith("/"):
             path = "/" + path
         return f"{self.api_base}{path}"
 
-    def api_get(self, path: str, params: dict = None, timeout: int = 20):
-        """GET запрос к API"""
+    def _timeout(self, path: str, timeout=None):
+        """Явный timeout или по таблице API_READ_TIMEOUTS; ожидание соединения из пула не ограничено."""
+        if timeout is None:
+            timeout = next((t for prefix, t in API_READ_TIMEOUTS if path.startswith(prefix)), API_READ_TIMEOUT)
+        return self._httpx.Timeout(timeout, connect=min(API_CONNECT_TIMEOUT, timeout), pool=None)
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after=None) -> float:
+        if retry_after and str(retry_after).isdigit():
+            return min(float(retry_after), API_BACKOFF_MAX)
+        return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+
+    async def _request(self, method: str, path: str, retries: int, timeout=None, headers: dict = None,
+                       raw: bool = False, **kwargs):
+        """Запрос через общий клиент; при обрыве/таймауте/429/5xx шлюза — до retries повторов.
+        raw=True — вернуть сам ответ (для 304 и заголовков), а не JSON."""
+        attempt = 0
+        while True:
+            try:
+                with trace_span(f"{method} {path}", kind="CLIENT",
+                                **{"http.url": self._url(path), "retry": attempt}) as span:
+                    r = await self.client.request(method, self._url(path), timeout=self._timeout(path, timeout),
+                                                  headers={**(headers or {}), **self._trace_headers(span)}, **kwargs)
+                    span.tags["http.status_code"] = r.status_code
+                    if r.status_code not in API_RETRY_STATUSES or attempt >= retries:
+                        if r.is_error:
+                            raise self._httpx.HTTPStatusError(self._error_detail(r), request=r.request, response=r)
+                        return r if raw else r.json()
+                    reason = f"HTTP {r.status_code}"
+                    delay = self._backoff(attempt, r.headers.get("Retry-After"))
+            except self._httpx.TransportError as e:  # обрыв, таймаут, DNS
+                if attempt >= retries:
+                    print(f"API {method} error [{path}]: {e!r}")
+                    raise
+                reason = repr(e)
+                delay = self._backoff(attempt)
+            except Exception as e:
+                print(f"API {method} error [{path}]: {e}")
+                raise
+            attempt += 1
+            print(f"API {method} retry {attempt} через {delay:.1f} c [{path}]: {reason}")
+            await asyncio.sleep(delay)
+
+    async def api_get(self, path: str, params: dict = None, timeout: int = None):
+        """GET запрос к API (повторяется при сбое связи)"""
+        return await self._request("GET", path, API_RETRIES, timeout, params=params)
+
+    async def api_post(self, path: str, payload: dict = None, timeout: int = None, idempotency_key: str = None):
+        """POST запрос к API.
+        С idempotency_key запрос повторяется при таймауте/обрыве связи:
+        сервер вернёт сохранённый ответ и не создаст дубль.
+        """
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else {}
+        return await self._request("POST", path, POST_RETRIES if idempotency_key else 0, timeout,
+                                   headers=headers, json=payload)
+
+    async def api_put(self, path: str, payload: dict = None, timeout: int = None):
+        """PUT запрос к API (идемпотентен — повторяется при сбое связи)"""
+        return await self._request("PUT", path, API_RETRIES, timeout, json=payload)
+
+    @staticmethod
+    def _trace_headers(span) -> dict:
+        return {"traceparent": span.traceparent} if span.traceparent else {}
+
+    # ---------- Локальная копия и outbox ----------
+    def _is_offline_error(self, e) -> bool:
+        if isinstance(e, self._httpx.TransportError):
+            return True
+        return isinstance(e, self._httpx.HTTPStatusError) and e.response.status_code in OFFLINE_HTTP_STATUSES
+
+    def _go_offline(self, e):
+        if self.online:
+            print(f"⚠ Нет связи с API, работаем по локальной копии: {e!r}")
+        self.online = False
+
+    def _view(self, key, data):
+        return apply_pending(key, data, self.offline.pending(), self.offline.server_id)
+
+    async def _read(self, key: str, path: str, params: dict = None, max_age: float = None):
+        """GET с локальной копией: ответ сохраняется под key; без связи — сразу копия.
+        В обоих случаях поверх накладываются ещё не отправленные изменения."""
+        error = None
+        if self.online:
+            try:
+                data = await self._fetch(key, path, params)
+            except Exception as e:
+                if not self._is_offline_error(e):
+                    raise
+                self._go_offline(e)
+                error = e
+            else:
+                return self._view(key, data)
+
+        data = self.offline.get(key, max_age)
+        if data is None:
+            raise error or ConnectionError(f"Нет связи с API и нет сохранённой копии ({key})")
+        return self._view(key, data)
+
+    async def _fetch(self, key: str, path: str, params: dict = None):
+        """GET с If-None-Match, если копия сохранена с ETag: 304 — копия ещё верна."""
+        etag = self._etags.get(key)
+        r = await self._request("GET", path, API_RETRIES, params=params, raw=True,
+                                headers={"If-None-Match": etag} if etag else None)
+        if r.status_code == 304:
+            data = self.offline.get(key)
+            if data is None:  # копию успели удалить — запрашиваем целиком
+                self._etags.pop(key, None)
+                return await self._fetch(key, path, params)
+        else:
+            data = r.json()
+            if r.headers.get("ETag"):
+                self._etags[key] = r.headers["ETag"]
+            else:
+                self._etags.pop(key, None)
+        self.offline.put(key, data)
+        self._fresh[key] = time.monotonic()
+        return data
+
+    def _changed(self):
+        """После своего изменения все дни записей считаются непроверенными (перенос меняет два дня)."""
+        self._fresh.clear()
+
+    async def _send(self, op: str, args: dict, idempotency_key: str):
+        method, path, _ = OFFLINE_OPS[op]
+        args = self.offline.resolve(args)
+        path = path.format(**args)
         try:
-            r = self._requests.get(self._url(path), params=params, timeout=timeout)
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            print(f"API GET error [{path}]: {e}")
-            raise
-
-    def api_post(self, path: str, payload: dict = None, timeout: int = 20):
-        """POST запрос к API"""
+            if method == "POST":
+                return await self.api_post(path, args.get("data"), idempotency_key=idempotency_key)
+            return await self.api_put(path, args.get("data"))
+        finally:
+            self._changed()  # и при ошибке: запрос мог дойти до сервера
+            self._writes += 1
+
+    async def _submit(self, op: str, args: dict, base=None):
+        """Изменение: сразу в API; без связи (или пока outbox не пуст) — в outbox.
+        Из outbox возвращается {"success": True, "queued": True, "id": <локальный id>}."""
+        key = str(uuid.uuid4())
+        if self.online and not self.offline.has_pending():
+            try:
+                return await self._send(op, args, key)
+            except Exception as e:
+                if not self._is_offline_error(e):
+                    raise
+                self._go_offline(e)
+        # тот же Idempotency-Key: если запрос всё-таки дошёл, сервер не создаст дубль
+        base = base() if callable(base) else base
+        entry_id = self.offline.enqueue(op, args, base, key)
+        return {"success": True, "queued": True, "id": -entry_id}
+
+    def cached(self, key):
+        """Локальная копия с неотправленными изменениями, без запроса к API ([] — если её нет)."""
         try:
-            r = self._requests.post(self._url(path), json=payload, timeout=timeout)
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            print(f"API POST error [{path}]: {e}")
-            raise
+            return self._view(key, self.offline.get(key)) or []
+        except Exception:
+            return []
 
-    def api_put(self, path: str, payload: dict = None, timeout: int = 20):
-        """PUT запрос к API"""
+    def _find_appointment(self, apt_id):
+        """Запись из локальной копии (с неотправленными изменениями) — то, что видел администратор."""
+        for key in self.offline.keys("appointments:"):
+            row = next((a for a in self.cached(key) if a.get("id") == apt_id), None)
+            if row is not None:
+                return row
+        return None
+
+    def _doctor_info(self, doctor_id) -> dict:
+        doctor = next((d for d in self.cached("doctors") if d.get("id") == doctor_id), None)
+        return {"doctor_name": doctor["name"], "room": doctor["room"]} if doctor else {}
+
+    def _queue_row(self, appointment_id) -> dict:
+        """Поля строки очереди для показа до отправки — из записи в локальной копии."""
+        apt = self._find_appointment(appointment_id) or {}
+        fields = ("patient_name", "phone", "service_name", "doctor_id", "doctor_name", "room", "duration_hours")
+        return {k: apt.get(k, "") for k in fields}
+
+    def _queue_statuses(self, queue_ids) -> dict:
+        current = {str(q.get("id")): q.get("status") for q in self.cached("queue")}
+        return {str(queue_id): current.get(str(queue_id)) for queue_id in queue_ids}
+
+    def _queue_rows(self, queue_ids) -> dict:
+        """Запись строк очереди (id, врач, дата) — чтобы при отправке найти итоговый статус закрытой строки."""
+        rows = {str(q.get("id")): q for q in self.cached("queue")}
+        return {str(queue_id): {k: rows[str(queue_id)].get(k) for k in ("appointment_id", "doctor_id", "appointment_date")}
+                for queue_id in queue_ids if str(queue_id) in rows}
+
+    async def _snapshot(self, snapshots, key, path, params=None):
+        """Ответ сервера из snapshots, при первом обращении — запрос."""
+        if key not in snapshots:
+            snapshots[key] = await self.api_get(path, params=params)
+        return snapshots[key]
+
+    async def _server_appointment(self, apt_id, date_str, snapshots):
+        """Активная запись apt_id на сервере среди записей дня date_str или None."""
+        day = await self._snapshot(snapshots, f"appointments:{date_str}",
+                                   "/api/appointments/today", {"date": date_str})
+        return next((a for a in day if a["id"] == apt_id), None)
+
+    async def _already_applied(self, entry, snapshots) -> bool:
+        """Изменение уже есть на сервере: запрос дошёл, но ответ потерялся (таймаут) и запись
+        легла в outbox со старой базой. Такую запись не отправляем и не считаем конфликтом."""
+        base = entry["base"] or {}
+        row = base.get("row")
+        if entry["op"] == "appointment.update" and row:
+            target = {**row, **entry["args"]["data"]}
+            current = await self._server_appointment(self.offline.server_id(entry["args"]["id"]),
+                                                     target["appointment_date"], snapshots)
+            return current is not None and (
+                (str(current["doctor_id"]), str(current["appointment_time"])[:5])
+                == (str(target["doctor_id"]), str(target["appointment_time"])[:5]))
+        if entry["op"] == "appointment.cancel" and row:
+            apt_id = self.offline.server_id(entry["args"]["id"])
+            cancelled = await self._snapshot(
+                snapshots, f"cancelled:{row['appointment_date']}:{row['doctor_id']}", "/api/appointments",
+                {"date_from": row["appointment_date"], "date_to": row["appointment_date"],
+                 "doctor_id": row["doctor_id"], "status": "отменена", "limit": 200})
+            return any(a["id"] == apt_id for a in cancelled["items"])
+
+        items = _queue_status_items(entry)
+        if not items:
+            return False
+        queue = await self._snapshot(snapshots, "queue", "/api/queue")
+        for queue_id, status in items:
+            server_queue_id = self.offline.server_id(queue_id)
+            current = next((q for q in queue if q["id"] == server_queue_id), None)
+            if status in QUEUE_CLOSED_STATUSES:
+                # /api/queue отдаёт только активные строки: закрытой строки там нет, а закрыть её
+                # могли и с другим статусом — сверяем итоговый статус записи
+                if current is not None or not await self._closed_as(base, queue_id, status, snapshots):
+                    return False
+            elif current is None or current["status"] != status:
+                return False
+        return True
+
+    async def _closed_as(self, base, queue_id, status, snapshots) -> bool:
+        """Запись закрытой строки очереди на сервере в статусе, который даёт status."""
+        row = (base.get("queue_rows") or {}).get(str(queue_id))
+        apt_status = QUEUE_CLOSE_APPOINTMENT_STATUS.get(status)
+        if not row or not row.get("appointment_id") or not row.get("appointment_date") or apt_status is None:
+            return False
+        day = str(row["appointment_date"])[:10]
+        closed = await self._snapshot(
+            snapshots, f"{apt_status}:{day}:{row['doctor_id']}", "/api/appointments",
+            {"date_from": day, "date_to": day, "doctor_id": row["doctor_id"], "status": apt_status, "limit": 200})
+        return any(a["id"] == self.offline.server_id(row["appointment_id"]) for a in closed["items"])
+
+    async def _conflict(self, entry, snapshots):
+        """Текст конфликта, если на сервере уже не то, что видел администратор; иначе None.
+        snapshots — ответы сервера в пределах одной отправки (сбрасываются после каждого изменения)."""
+        base = entry["base"] or {}
+        row = base.get("row")
+        if entry["op"] in ("appointment.update", "appointment.cancel") and row:
+            current = await self._server_appointment(self.offline.server_id(entry["args"]["id"]),
+                                                     row["appointment_date"], snapshots)
+            if current is None:
+                return f"запись {row['patient_name']} уже отменена или перенесена на сервере"
+            if (current["doctor_id"], current["appointment_time"]) != (row["doctor_id"], row["appointment_time"]):
+                return (f"запись {row['patient_name']} на сервере уже изменена: "
+                        f"{current['appointment_time']}, {current.get('doctor_name', '')}")
+
+        for queue_id, status in _queue_status_items(entry):
+            expected = (base.get("statuses") or {}).get(str(queue_id))
+            if expected is None:
+                continue
+            queue = await self._snapshot(snapshots, "queue", "/api/queue")
+            server_queue_id = self.offline.server_id(queue_id)
+            current = next((q for q in queue if q["id"] == server_queue_id), None)
+            if current is None:
+                return "пациента уже нет в очереди"
+            if current["status"] != expected:
+                return f"у пациента {current['patient_name']} на сервере уже статус «{current['status']}»"
+        return None
+
+    async def flush_outbox(self) -> bool:
+        """Отправить outbox по порядку. False — связь снова пропала (остаток отправится позже)."""
+        snapshots = {}
+        while True:
+            pending = self.offline.pending()
+            if not pending:
+                # между проверкой и online = True нет await — новое изменение не проскочит мимо outbox
+                if not self.online:
+                    print("✓ Связь с API восстановлена, локальные изменения отправлены")
+                self.online = True
+                return True
+
+            entry = pending[0]
+            try:
+                if await self._already_applied(entry, snapshots):
+                    print(f"Изменение #{entry['id']} ({entry['op']}) уже есть на сервере — не отправляем")
+                    self.offline.done(entry["id"])
+                    continue
+                conflict = await self._conflict(entry, snapshots)
+                result = None if conflict else await self._send(entry["op"], entry["args"], entry["idempotency_key"])
+            except LocalIdMissing as e:
+                conflict = str(e)
+            except Exception as e:
+                if self._is_offline_error(e):
+                    self.offline.failed(entry["id"], e)
+                    self._go_offline(e)
+                    return False
+                response = getattr(e, "response", None)
+                conflict = self._error_detail(response) if response is not None else str(e)
+
+            if conflict is None and entry["op"] == "batch" and not result.get("committed"):
+                errors = [r.get("error") for r in result.get("results", []) if not r.get("ok")]
+                conflict = "; ".join(map(str, errors)) or "пакет отменён"
+
+            if conflict is not None:
+                print(f"Конфликт изменения #{entry['id']} ({entry['op']}): {conflict}")
+                self.offline.conflict(entry["id"], conflict)
+                continue
+
+            server_id = result.get("id") if entry["op"] in OFFLINE_CREATES and isinstance(result, dict) else None
+            self.offline.done(entry["id"], server_id)
+            snapshots.clear()
+
+    @staticmethod
+    def _error_detail(response) -> str:
         try:
-            r = self._requests.put(self._url(path), json=payload, timeout=timeout)
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            print(f"API PUT error [{path}]: {e}")
-            raise
-
-    # ---------- Асинхронные методы ----------
-    def get_doctors_async(self, callback):
-        """Асинхронное получение врачей"""
-
-        def task():
+            detail = response.json().get("detail")
+        except Exception:
+            detail = None
+        return f"HTTP {response.status_code}: {detail}" if detail else f"HTTP {response.status_code}"
+
+    async def _sync_loop(self):
+        """Без связи — раз в OFFLINE_PROBE_SECONDS проверяем API и отправляем outbox."""
+        while True:
+            await asyncio.sleep(OFFLINE_PROBE_SECONDS)
+            if self.online and not self.offline.has_pending():
+                continue
+            try:
+                await self._request("GET", "/api/health", 0)
+            except Exception:
+                continue
             try:
-                data = self.api_get("/api/doctors")
-                result = data if isinstance(data, list) else []
-                callback(result, None)
+                with trace_span("sync outbox"):
+                    await self.flush_outbox()
             except Exception as e:
-                callback([], str(e))
-
-        self.executor.submit(task)
+                print(f"Ошибка отправки локальных изменений: {e}")
+
+    def offline_status(self) -> dict:
+        """Для панели: есть ли связь, сколько изменений ждут отправки, новые конфликты."""
+        return {
+            "online": self.online,
+            "pending": len(self.offline.pending()),
+            "conflicts": self.offline.take_conflicts(),
+        }
+
+    # ---------- Обновление таблиц (callback(result, error) — в потоке Tk) ----------
+    # В ключе — счётчик изменений: обновление после своего изменения не присоединяется к запросу,
+    # начатому до него (его ответ — ещё старое состояние), а запрашивает заново.
+    def get_doctors_async(self, callback):
+        """Асинхронное получение врачей"""
+        return self.submit(self.get_doctors, callback, key=("doctors", self._writes))
 
     def get_queue_async(self, callback):
         """Асинхронное получение очереди"""
-
-        def task():
-            try:
-                data = self.api_get("/api/queue")
-                result = data if isinstance(data, list) else []
-                callback(result, None)
-            except Exception as e:
-                callback([], str(e))
-
-        self.executor.submit(task)
+        return self.submit(self.get_queue, callback, key=("queue", self._writes))
 
     def get_appointments_async(self, date_str, callback):
         """Асинхронное получение записей"""
-
-        def task():
-            try:
-                params = {"date": date_str}
-                data = self.api_get("/api/appointments/today", params=params)
-                result = data if isinstance(data, list) else []
-                callback(result, None)
-            except Exception as e:
-                callback([], str(e))
-
-        self.executor.submit(task)
+        return self.submit(partial(self.get_appointments, date_str), callback,
+                           key=("appointments", date_str, self._writes))
+
+    def prefetch_appointments(self, date_str):
+        """Фоновая подгрузка соседних дней (ближние первыми), по одному запросу за раз"""
+        if not self.online or APPOINTMENTS_PREFETCH_DAYS <= 0:
+            return None
+        center = datetime.strptime(date_str, "%Y-%m-%d").date()
+        dates = [(center + timedelta(days=sign * n)).strftime("%Y-%m-%d")
+                 for n in range(1, APPOINTMENTS_PREFETCH_DAYS + 1) for sign in (1, -1)]
+        return self.submit(partial(self._prefetch, dates), group="prefetch")  # новый день — прежняя подгрузка не нужна
+
+    async def _prefetch(self, dates):
+        for date_str in dates:
+            key = f"appointments:{date_str}"
+            if time.monotonic() - self._fresh.get(key, float("-inf")) < APPOINTMENTS_FRESH_SECONDS:
+                continue
+            if not self.online:
+                return
+            await self.get_appointments(date_str)
 
     def get_stats_async(self, callback):
         """Асинхронное получение статистики"""
+        return self.submit(self.get_stats, callback, key="stats")
 
-        def task():
-            try:
-                data = self.api_get("/api/stats")
-                result = data if isinstance(data, dict) else {
-                    'total': 0, 'active': 0, 'cancelled': 0, 'completed': 0, 'doctors': []
-                }
-                callback(result, None)
-            except Exception as e:
-                callback({'total': 0, 'active': 0, 'cancelled': 0, 'completed': 0, 'doctors': []}, str(e))
-
-        self.executor.submit(task)
-
-    # ---------- Синхронные методы для простых операций ----------
-    def get_doctors(self):
+    # ---------- Чтения ----------
+    async def get_doctors(self):
         """GET /api/doctors"""
-        try:
-            data = self.api_get("/api/doctors")
-            return data if isinstance(data, list) else []
-        except:
-            return []
+        data = await self._read("doctors", "/api/doctors")
+        return data if isinstance(data, list) else []
 
-    def update_doctor_status(self, doctor_id: int, new_status: str):
-        """PUT /api/doctors/{doctor_id}/status"""
-        try:
-            payload = {"status": new_status}
-            return self.api_put(f"/api/doctors/{doctor_id}/status", payload)
-        except Exception as e:
-            raise Exception(f"Не удалось обновить статус врача: {e}")
-
-    def get_available_slots(self, date_str: str, doctor_id: int = None):
+    async def get_queue(self):
+        """GET /api/queue"""
+        data = await self._read("queue", "/api/queue")
+        return data if isinstance(data, list) else []
+
+    async def get_appointments(self, date_str: str):
+        """GET /api/appointments/today?date="""
+        data = await self._read(f"appointments:{date_str}", "/api/appointments/today", params={"date": date_str})
+        return data if isinstance(data, list) else []
+
+    async def get_stats(self):
+        """GET /api/stats"""
+        data = await self.api_get("/api/stats")
+        return data if isinstance(data, dict) else {
+            'total': 0, 'active': 0, 'cancelled': 0, 'completed': 0, 'doctors': []
+        }
+
+    async def get_available_slots(self, date_str: str, doctor_id: int = None):
         """GET /api/available-slots
 
         Возвращает список строк времени (['08:00', '08:30', ...]).
-        Если API недоступен/медленный, возвращаем дефолтные слоты,
-        чтобы UI не оставался пустым (и пользователь мог выбрать время).
+        Сетку строит сервер по расписанию врача: пустой список — выходной
+        или всё занято. Без связи — сохранённые слоты не старше
+        OFFLINE_SLOTS_MAX_AGE без времени, занятого неотправленными записями;
+        если их нет — пустой список: придуманное время дало бы двойную запись.
         """
-
-        def _default_slots():
-            # 08:00–18:00 каждые 30 минут
-            out = []
-            h, m = 8, 0
-            while True:
-                out.append(f"{h:02d}:{m:02d}")
-                m += 30
-                if m >= 60:
-                    h += 1
-                    m -= 60
-                if h > 18 or (h == 18 and m > 0):
-                    break
-            return out
-
         try:
             params = {"date": date_str}
             if doctor_id:
                 params["doctor_id"] = doctor_id
-            data = self.api_get("/api/available-slots", params=params)
+            data = await self._read(f"slots:{date_str}:{doctor_id or ''}", "/api/available-slots",
+                                    params=params, max_age=OFFLINE_SLOTS_MAX_AGE)
 
             # Нормализация ответа
             slots = []
@@ -347,10 +1590,6 @@ class Database:
             else:
                 slots = []
 
-            # Если сервер вернул пусто — лучше показать дефолт, чем «пустое поле»
-            if not slots:
-                return _default_slots()
-
             # unique preserve order
             seen = set()
             norm = []
@@ -361,10 +1600,41 @@ class Database:
             return norm
         except Exception as e:
             print(f"API GET error [/api/available-slots]: {e}")
-            return _default_slots()
+            return []
+
+    async def search_appointments(self, patient_name: str):
+        """Поиск записей по имени пациента"""
+        try:
+            if not self.online:
+                raise ConnectionError("нет связи с API")  # сразу к поиску по локальной копии
+            params = {"patient_name": patient_name}
+            data = await self.api_get("/api/appointments/search", params=params)
+            return data if isinstance(data, list) else []
+        except Exception:
+            # Если нет специального endpoint, ищем вручную (±30 дней; запросы идут параллельно,
+            # не больше API_WORKERS одновременно)
+            today = datetime.now().date()
+            dates = [(today + timedelta(days=days)).strftime("%Y-%m-%d") for days in range(-30, 30)]
+            results = await asyncio.gather(*(self.get_appointments(date) for date in dates),
+                                           return_exceptions=True)
+            all_appointments = [apt for apts in results if isinstance(apts, list) for apt in apts]
+
+            # Фильтруем по имени
+            patient_name_lower = patient_name.lower()
+            return [apt for apt in all_appointments
+                    if patient_name_lower in apt.get('patient_name', '').lower()]
 
-    def create_appointment(self, patient_name: str, phone: str, doctor_id: int,
-                           appointment_date: str, appointment_time: str, service_id: int = None):
+    # ---------- Изменения ----------
+    async def update_doctor_status(self, doctor_id: int, new_status: str):
+        """PUT /api/doctors/{doctor_id}/status"""
+        try:
+            payload = {"status": new_status}
+            return await self._submit("doctor.status", {"id": doctor_id, "data": payload})
+        except Exception as e:
+            raise Exception(f"Не удалось обновить статус врача: {e}")
+
+    async def create_appointment(self, patient_name: str, phone: str, doctor_id: int,
+                                 appointment_date: str, appointment_time: str, service_id: int = None):
         """POST /api/appointments"""
         try:
             payload = {
@@ -377,13 +1647,13 @@ class Database:
             if service_id:
                 payload["service_id"] = service_id
 
-            return self.api_post("/api/appointments", payload)
+            return await self._submit("appointment.create", {"data": payload}, lambda: self._doctor_info(doctor_id))
         except Exception as e:
             raise Exception(f"Не удалось создать запись: {e}")
 
-    def update_appointment(self, apt_id: int, doctor_id: int = None,
-                           appointment_time: str = None, appointment_date: str = None):
-        """Обновление записи (предполагается endpoint PUT /api/appointments/{apt_id})"""
+    async def update_appointment(self, apt_id: int, doctor_id: int = None,
+                                 appointment_time: str = None, appointment_date: str = None):
+        """Обновление записи (PUT /api/appointments/{apt_id})"""
         try:
             payload = {}
             if doctor_id is not None:
@@ -393,64 +1663,54 @@ class Database:
             if appointment_date:
                 payload["appointment_date"] = appointment_date
 
-            return self.api_put(f"/api/appointments/{apt_id}", payload)
+            return await self._submit("appointment.update", {"id": apt_id, "data": payload}, lambda: {
+                "row": self._find_appointment(apt_id),
+                **(self._doctor_info(doctor_id) if doctor_id is not None else {}),
+            })
         except Exception as e:
             raise Exception(f"Не удалось обновить запись: {e}")
 
-    def cancel_appointment(self, apt_id: int):
+    async def cancel_appointment(self, apt_id: int):
         """PUT /api/appointments/{apt_id}/cancel"""
         try:
-            return self.api_put(f"/api/appointments/{apt_id}/cancel")
+            return await self._submit("appointment.cancel", {"id": apt_id},
+                                      lambda: {"row": self._find_appointment(apt_id)})
         except Exception as e:
             raise Exception(f"Не удалось отменить запись: {e}")
 
-    def get_queue(self):
-        """GET /api/queue"""
-        try:
-            data = self.api_get("/api/queue")
-            return data if isinstance(data, list) else []
-        except:
-            return []
-
-    def add_to_queue(self, appointment_id: int):
+    async def add_to_queue(self, appointment_id: int):
         """Добавление записи в очередь (POST /api/queue)"""
         try:
             payload = {"appointment_id": appointment_id}
-            return self.api_post("/api/queue", payload)
+            return await self._submit("queue.add", {"data": payload}, lambda: self._queue_row(appointment_id))
         except Exception as e:
             raise Exception(f"Не удалось добавить в очередь: {e}")
 
-    def update_queue_status(self, queue_id: int, new_status: str):
+    async def update_queue_status(self, queue_id: int, new_status: str):
         """Обновление статуса в очереди"""
         try:
             payload = {"status": new_status}
-            return self.api_put(f"/api/queue/{queue_id}/status", payload)
+            return await self._submit("queue.status", {"id": queue_id, "data": payload},
+                                      lambda: {"statuses": self._queue_statuses([queue_id]),
+                                               "queue_rows": self._queue_rows([queue_id])})
         except Exception as e:
             print(f"Не удалось обновить статус очереди: {e}")
             raise
 
-    def search_appointments(self, patient_name: str):
-        """Поиск записей по имени пациента"""
+    async def batch(self, items: list, atomic: bool = True):
+        """Несколько изменений записей/очереди одним запросом (POST /api/batch, одна транзакция).
+        items: [{"op": "queue.status", "id": 5, "status": "не_пришёл"}, ...]"""
         try:
-            params = {"patient_name": patient_name}
-            data = self.api_get("/api/appointments/search", params=params)
-            return data if isinstance(data, list) else []
-        except:
-            # Если нет специального endpoint, ищем вручную
-            all_appointments = []
-            for days in range(-30, 30):  # Ищем в диапазоне ±30 дней
-                date = (datetime.now().date() + timedelta(days=days)).strftime("%Y-%m-%d")
-                try:
-                    apts = self.api_get("/api/appointments/today", params={"date": date})
-                    if isinstance(apts, list):
-                        all_appointments.extend(apts)
-                except:
-                    pass
-
-            # Фильтруем по имени
-            patient_name_lower = patient_name.lower()
-            return [apt for apt in all_appointments
-                    if patient_name_lower in apt.get('patient_name', '').lower()]
+            queue_ids = [item["id"] for item in items if item.get("op") == "queue.status"]
+            result = await self._submit("batch", {"data": {"items": items, "atomic": atomic}}, lambda: {
+                "statuses": self._queue_statuses(queue_ids),
+                "queue_rows": self._queue_rows(queue_ids),
+            })
+            if result.get("queued"):
+                return {"committed": True, "queued": True, "results": []}
+            return result
+        except Exception as e:
+            raise Exception(f"Не удалось выполнить пакет изменений: {e}")
 
 
 class AdminPanel:
@@ -459,18 +1719,18 @@ class AdminPanel:
         self.root.title("Панель управления - Электронная очередь")
         self.root.geometry("1400x900")
 
-        self.db = Database()
+        # Для асинхронных обновлений: ответы API приходят сюда и выполняются в главном потоке
+        self.ui_queue = TracedUIQueue()
+
+        self.db = Database(self.ui_queue.put)
         self.theme_manager = ThemeManager(root, "light")
         self.patient_display = None
         self.current_date = datetime.now().date()
-
-        # Для асинхронных обновлений
-        self.ui_queue = ThreadQueue()
-        self.is_refreshing = False
+        self.appointments_date = None  # день, записи которого сейчас в таблице
+        self.announcer = Announcer(create_tts_engine) if HAS_TTS else None
 
         self.create_ui()
         self.start_ui_queue_processor()
-        self.refresh_all()
         self.start_auto_refresh()
 
     def create_ui(self):
@@ -481,6 +1741,11 @@ class AdminPanel:
         ttk.Label(top_panel, text="ПАНЕЛЬ УПРАВЛЕНИЯ",
                   font=('Arial', 20, 'bold'), style="TLabel").pack(side='left')
 
+        # Плашка «нет связи» / «отправка изменений» (см. update_offline_status)
+        self.offline_label = ttk.Label(top_panel, text="", font=('Arial', 11, 'bold'),
+                                       style="TLabel", foreground='#E53935')
+        self.offline_label.pack(side='left', padx=20)
+
         btn_frame = ttk.Frame(top_panel, style="TFrame")
         btn_frame.pack(side='right')
 
@@ -512,6 +1777,8 @@ class AdminPanel:
         self.doctors_tree.column('room', width=100)
         self.doctors_tree.column('status', width=100)
         self.doctors_tree.pack(fill='both', expand=True, padx=5, pady=5)
+        self.doctors_sync = TreeSync(self.doctors_tree, key=lambda doc: doc['id'],
+                                     values=lambda doc: (doc['name'], doc['room'], doc['status']))
 
         doctors_btn_frame = ttk.Frame(doctors_frame, style="TFrame")
         doctors_btn_frame.pack(fill='x', padx=5, pady=5)
@@ -541,6 +1808,13 @@ class AdminPanel:
         self.queue_tree.column('room', width=80)
         self.queue_tree.column('status', width=100)
         self.queue_tree.pack(fill='both', expand=True, padx=5, pady=5)
+        self.queue_sync = TreeSync(self.queue_tree, key=lambda item: item['id'], values=lambda item: (
+            item['patient_name'],
+            item.get('service_name', ''),
+            item['doctor_name'],
+            item['room'],
+            item['status']
+        ))
 
         queue_btn_frame = ttk.Frame(queue_frame, style="TFrame")
         queue_btn_frame.pack(fill='x', padx=5, pady=5)
@@ -551,6 +1825,8 @@ class AdminPanel:
                    style="Primary.TButton", width=15).pack(side='left', padx=2)
         ttk.Button(queue_btn_frame, text="Завершить", command=self.complete_patient,
                    style="Warn.TButton", width=15).pack(side='left', padx=2)
+        ttk.Button(queue_btn_frame, text="Не пришли", command=self.mark_no_show,
+                   style="Danger.TButton", width=15).pack(side='left', padx=2)
 
         # Правая колонка - Записи
         right_column = ttk.Frame(main_container, style="TFrame")
@@ -588,6 +1864,13 @@ class AdminPanel:
         self.appointments_tree.column('service', width=100)
         self.appointments_tree.column('doctor', width=120)
         self.appointments_tree.pack(fill='both', expand=True, padx=5, pady=5)
+        self.appointments_sync = TreeSync(self.appointments_tree, key=lambda apt: apt['id'], values=lambda apt: (
+            apt['appointment_time'],
+            apt['patient_name'],
+            apt['phone'],
+            apt.get('service_name', ''),
+            apt['doctor_name']
+        ))
 
         # Кнопки записей
         apt_btn_frame = ttk.Frame(appointments_frame, style="TFrame")
@@ -605,19 +1888,9 @@ class AdminPanel:
                    style="Primary.TButton", width=15).pack(side='left', padx=2)
 
     def start_ui_queue_processor(self):
-        """Обработчик очереди UI-обновлений"""
-
-        def process_queue():
-            try:
-                while True:
-                    task = self.ui_queue.get(timeout=0.1)
-                    if task:
-                        task()
-            except:
-                pass
-            self.root.after(100, process_queue)
-
-        process_queue()
+        """Обработчик очереди UI-обновлений: не блокирует главный поток (см. UIDispatcher)"""
+        self.ui_dispatcher = UIDispatcher(self.root, self.ui_queue)
+        self.ui_dispatcher.run_frame()
 
     def toggle_theme(self):
         self.theme_manager.toggle()
@@ -657,22 +1930,18 @@ class AdminPanel:
             messagebox.showwarning("Предупреждение", "Выберите врача")
             return
 
+        doctor_id = int(selected[0])
         item = self.doctors_tree.item(selected[0])
         doctor_name = item['values'][0]
 
-        def task():
-            try:
-                doctors = self.db.get_doctors()
-                doctor = next((d for d in doctors if d['name'] == doctor_name), None)
-                if doctor:
-                    self.db.update_doctor_status(doctor['id'], status)
-                    self.ui_queue.put(lambda: self.refresh_doctors())
-                    self.ui_queue.put(
-                        lambda: messagebox.showinfo("Успех", f"Врач {doctor_name} теперь {message_status}"))
-            except Exception as e:
-                self.ui_queue.put(lambda: messagebox.showerror("Ошибка", str(e)))
+        def done(result, error):
+            if error:
+                messagebox.showerror("Ошибка", error)
+                return
+            self.refresh_doctors()
+            messagebox.showinfo("Успех", f"Врач {doctor_name} теперь {message_status}")
 
-        threading.Thread(target=task, daemon=True).start()
+        self.db.submit(lambda: self.db.update_doctor_status(doctor_id, status), done)
 
     # ---------- Управление очередью ----------
     def call_patient(self):
@@ -686,17 +1955,15 @@ class AdminPanel:
         patient_name = item['values'][0]
         room = item['values'][3]
 
-        def task():
-            try:
-                self.db.update_queue_status(int(queue_id), 'готов')
-                self.ui_queue.put(lambda: self.announce_patient(patient_name, room))
-                self.ui_queue.put(lambda: self.refresh_queue())
-                if self.patient_display and self.patient_display.winfo_exists():
-                    self.ui_queue.put(lambda: self.patient_display.refresh())
-            except Exception as e:
-                self.ui_queue.put(lambda: messagebox.showerror("Ошибка", f"Не удалось пригласить пациента: {e}"))
+        def done(result, error):
+            if error:
+                messagebox.showerror("Ошибка", f"Не удалось пригласить пациента: {error}")
+                return
+            self.announce_patient(patient_name, room)
+            self.refresh_queue()
+            self.refresh_patient_display()
 
-        threading.Thread(target=task, daemon=True).start()
+        self.db.submit(lambda: self.db.update_queue_status(int(queue_id), 'готов'), done)
 
     def accept_patient(self):
         selected = self.queue_tree.selection()
@@ -708,17 +1975,15 @@ class AdminPanel:
         item = self.queue_tree.item(queue_id)
         patient_name = item['values'][0]
 
-        def task():
-            try:
-                self.db.update_queue_status(int(queue_id), 'в_работе')
-                self.ui_queue.put(lambda: self.refresh_queue())
-                self.ui_queue.put(lambda: messagebox.showinfo("Успех", f"Пациент {patient_name} принят"))
-                if self.patient_display and self.patient_display.winfo_exists():
-                    self.ui_queue.put(lambda: self.patient_display.refresh())
-            except Exception as e:
-                self.ui_queue.put(lambda: messagebox.showerror("Ошибка", f"Не удалось принять пациента: {e}"))
+        def done(result, error):
+            if error:
+                messagebox.showerror("Ошибка", f"Не удалось принять пациента: {error}")
+                return
+            self.refresh_queue()
+            self.refresh_patient_display()
+            messagebox.showinfo("Успех", f"Пациент {patient_name} принят")
 
-        threading.Thread(target=task, daemon=True).start()
+        self.db.submit(lambda: self.db.update_queue_status(int(queue_id), 'в_работе'), done)
 
     def complete_patient(self):
         selected = self.queue_tree.selection()
@@ -731,17 +1996,40 @@ class AdminPanel:
         patient_name = item['values'][0]
 
         if messagebox.askyesno("Подтверждение", f"Завершить приём пациента {patient_name}?"):
-            def task():
-                try:
-                    self.db.update_queue_status(int(queue_id), 'завершён')
-                    self.ui_queue.put(lambda: self.refresh_queue())
-                    self.ui_queue.put(lambda: messagebox.showinfo("Успех", f"Приём пациента {patient_name} завершён"))
-                    if self.patient_display and self.patient_display.winfo_exists():
-                        self.ui_queue.put(lambda: self.patient_display.refresh())
-                except Exception as e:
-                    self.ui_queue.put(lambda: messagebox.showerror("Ошибка", f"Не удалось завершить приём: {e}"))
-
-            threading.Thread(target=task, daemon=True).start()
+            def done(result, error):
+                if error:
+                    messagebox.showerror("Ошибка", f"Не удалось завершить приём: {error}")
+                    return
+                self.refresh_queue()
+                self.refresh_patient_display()
+                messagebox.showinfo("Успех", f"Приём пациента {patient_name} завершён")
+
+            self.db.submit(lambda: self.db.update_queue_status(int(queue_id), 'завершён'), done)
+
+    def mark_no_show(self):
+        """Неявка для всех выделенных в очереди — одним пакетным запросом."""
+        selected = self.queue_tree.selection()
+        if not selected:
+            messagebox.showwarning("Предупреждение", "Выберите пациентов из очереди (Ctrl/Shift — несколько)")
+            return
+
+        names = [self.queue_tree.item(queue_id)['values'][0] for queue_id in selected]
+        if not messagebox.askyesno("Подтверждение", f"Отметить неявку ({len(names)}): {', '.join(map(str, names))}?"):
+            return
+
+        items = [{"op": "queue.status", "id": int(queue_id), "status": "не_пришёл"} for queue_id in selected]
+
+        def done(result, error):
+            if not error and not result.get("committed"):
+                errors = [r.get("error") for r in result.get("results", []) if not r.get("ok")]
+                error = "; ".join(map(str, errors)) or "пакет отменён"
+            if error:
+                messagebox.showerror("Ошибка", f"Не удалось отметить неявку: {error}")
+                return
+            self.refresh_queue()
+            self.refresh_patient_display()
+
+        self.db.submit(lambda: self.db.batch(items), done)
 
     # ---------- Управление записями ----------
     def create_appointment(self):
@@ -776,7 +2064,7 @@ class AdminPanel:
         # Врач
         ttk.Label(form_frame, text="Врач:").grid(row=3, column=0, sticky='w', pady=10)
         doctor_var = tk.StringVar()
-        doctors = self.db.get_doctors()
+        doctors = self.db.cached("doctors")  # список уже загружен панелью — без запроса
         doctor_combo = ttk.Combobox(form_frame, textvariable=doctor_var, width=28, state='readonly')
         doctor_combo['values'] = [f"{d['name']} ({d['room']})" for d in doctors]
         if doctors:
@@ -801,13 +2089,16 @@ class AdminPanel:
 
             date_str = date_entry.get()
 
-            def task():
-                slots = self.db.get_available_slots(date_str, doctor['id'])
-                self.ui_queue.put(lambda: time_combo.configure(values=slots))
+            def done(slots, error):
+                if error or not dialog.winfo_exists():
+                    return
+                time_combo.configure(values=slots)
                 if slots:
-                    self.ui_queue.put(lambda: time_combo.current(0))
+                    time_combo.current(0)
 
-            threading.Thread(target=task, daemon=True).start()
+            # слоты для прежних врача/даты, если ещё не пришли, больше не нужны — запрос отменяется
+            self.db.submit(lambda: self.db.get_available_slots(date_str, doctor['id']), done,
+                           key=("slots", date_str, doctor['id']), group=("slots", str(dialog)))
 
         doctor_combo.bind('<<ComboboxSelected>>', update_time_slots)
         date_entry.bind('<FocusOut>', update_time_slots)
@@ -838,22 +2129,22 @@ class AdminPanel:
                 messagebox.showerror("Ошибка", "Врач не найден")
                 return
 
-            def task():
-                try:
-                    self.db.create_appointment(
-                        patient_name=name,
-                        phone=phone,
-                        doctor_id=doctor['id'],
-                        appointment_date=date_str,
-                        appointment_time=time_str
-                    )
-                    self.ui_queue.put(lambda: messagebox.showinfo("Успех", "Запись успешно создана!"))
-                    self.ui_queue.put(dialog.destroy)
-                    self.ui_queue.put(lambda: self.refresh_appointments())
-                except Exception as e:
-                    self.ui_queue.put(lambda: messagebox.showerror("Ошибка", str(e)))
-
-            threading.Thread(target=task, daemon=True).start()
+            def done(result, error):
+                if error:
+                    messagebox.showerror("Ошибка", error)
+                    return
+                messagebox.showinfo("Успех", "Нет связи с сервером: запись сохранена и будет отправлена автоматически"
+                                    if result.get("queued") else "Запись успешно создана!")
+                dialog.destroy()
+                self.refresh_appointments()
+
+            self.db.submit(lambda: self.db.create_appointment(
+                patient_name=name,
+                phone=phone,
+                doctor_id=doctor['id'],
+                appointment_date=date_str,
+                appointment_time=time_str
+            ), done)
 
         ttk.Button(btn_frame, text="Сохранить", command=save_appointment,
                    style="Ok.TButton", width=15).pack(side='left', padx=5)
@@ -900,7 +2191,7 @@ class AdminPanel:
         # Врач
         ttk.Label(form_frame, text="Врач:").grid(row=1, column=0, sticky='w', pady=10)
         doctor_var = tk.StringVar()
-        doctors = self.db.get_doctors()
+        doctors = self.db.cached("doctors")  # список уже загружен панелью — без запроса
         doctor_combo = ttk.Combobox(form_frame, textvariable=doctor_var, width=28, state='readonly')
         doctor_combo['values'] = [f"{d['name']} ({d['room']})" for d in doctors]
 
@@ -930,15 +2221,18 @@ class AdminPanel:
 
             date_str = date_entry.get()
 
-            def task():
-                slots = self.db.get_available_slots(date_str, doctor['id'])
+            def done(slots, error):
+                if error or not dialog.winfo_exists():
+                    return
                 # Добавляем текущее время в список
                 if current_time not in slots:
-                    slots.insert(0, current_time)
-                self.ui_queue.put(lambda: time_combo.configure(values=slots))
-                self.ui_queue.put(lambda: time_var.set(current_time))
+                    slots = [current_time] + slots
+                time_combo.configure(values=slots)
+                time_var.set(current_time)
 
-            threading.Thread(target=task, daemon=True).start()
+            # слоты для прежних врача/даты, если ещё не пришли, больше не нужны — запрос отменяется
+            self.db.submit(lambda: self.db.get_available_slots(date_str, doctor['id']), done,
+                           key=("slots", date_str, doctor['id']), group=("slots", str(dialog)))
 
         doctor_combo.bind('<<ComboboxSelected>>', update_time_slots)
         date_entry.bind('<FocusOut>', update_time_slots)
@@ -963,21 +2257,21 @@ class AdminPanel:
                 messagebox.showerror("Ошибка", "Врач не найден")
                 return
 
-            def task():
-                try:
-                    self.db.update_appointment(
-                        apt_id=apt_id,
-                        doctor_id=doctor['id'],
-                        appointment_time=new_time,
-                        appointment_date=new_date
-                    )
-                    self.ui_queue.put(lambda: messagebox.showinfo("Успех", "Запись успешно изменена!"))
-                    self.ui_queue.put(dialog.destroy)
-                    self.ui_queue.put(lambda: self.refresh_appointments())
-                except Exception as e:
-                    self.ui_queue.put(lambda: messagebox.showerror("Ошибка", str(e)))
-
-            threading.Thread(target=task, daemon=True).start()
+            def done(result, error):
+                if error:
+                    messagebox.showerror("Ошибка", error)
+                    return
+                messagebox.showinfo("Успех", "Нет связи с сервером: изменение сохранено и будет отправлено автоматически"
+                                    if result.get("queued") else "Запись успешно изменена!")
+                dialog.destroy()
+                self.refresh_appointments()
+
+            self.db.submit(lambda: self.db.update_appointment(
+                apt_id=apt_id,
+                doctor_id=doctor['id'],
+                appointment_time=new_time,
+                appointment_date=new_date
+            ), done)
 
         ttk.Button(btn_frame, text="Сохранить", command=save_changes,
                    style="Ok.TButton", width=15).pack(side='left', padx=5)
@@ -996,35 +2290,30 @@ class AdminPanel:
         patient_name = item['values'][1]
         doctor_name = item['values'][4]
 
-        # Проверяем статус врача
-        def task():
-            try:
-                doctors = self.db.get_doctors()
-                doctor = next((d for d in doctors if d['name'] == doctor_name), None)
-
-                if not doctor:
-                    self.ui_queue.put(lambda: messagebox.showerror("Ошибка", "Врач не найден"))
-                    return
-
-                # Проверяем статус врача - только "свободен" позволяет добавить в очередь
-                if doctor['status'].lower() != 'свободен':
-                    self.ui_queue.put(lambda: messagebox.showwarning(
-                        "Предупреждение",
-                        f"Врач {doctor_name} сейчас {doctor['status']}.\nЗапись попадёт в очередь только когда врач будет свободен."
-                    ))
-                    return
-
-                # Добавляем в очередь
-                self.db.add_to_queue(apt_id)
-                self.ui_queue.put(lambda: messagebox.showinfo("Успех", f"Пациент {patient_name} добавлен в очередь"))
-                self.ui_queue.put(lambda: self.refresh_queue())
-                if self.patient_display and self.patient_display.winfo_exists():
-                    self.ui_queue.put(lambda: self.patient_display.refresh())
+        async def invite():
+            # Проверяем статус врача - только "свободен" позволяет добавить в очередь
+            doctors = await self.db.get_doctors()
+            doctor = next((d for d in doctors if d['name'] == doctor_name), None)
+            if doctor and doctor['status'].lower() == 'свободен':
+                await self.db.add_to_queue(apt_id)
+            return doctor
 
-            except Exception as e:
-                self.ui_queue.put(lambda: messagebox.showerror("Ошибка", f"Не удалось добавить в очередь: {e}"))
+        def done(doctor, error):
+            if error:
+                messagebox.showerror("Ошибка", f"Не удалось добавить в очередь: {error}")
+            elif not doctor:
+                messagebox.showerror("Ошибка", "Врач не найден")
+            elif doctor['status'].lower() != 'свободен':
+                messagebox.showwarning(
+                    "Предупреждение",
+                    f"Врач {doctor_name} сейчас {doctor['status']}.\nЗапись попадёт в очередь только когда врач будет свободен."
+                )
+            else:
+                messagebox.showinfo("Успех", f"Пациент {patient_name} добавлен в очередь")
+                self.refresh_queue()
+                self.refresh_patient_display()
 
-        threading.Thread(target=task, daemon=True).start()
+        self.db.submit(invite, done)
 
     def cancel_appointment_with_search(self):
         """Отмена записи с поиском по имени"""
@@ -1078,29 +2367,27 @@ class AdminPanel:
             for item in results_tree.get_children():
                 results_tree.delete(item)
 
-            def task():
-                try:
-                    appointments = self.db.search_appointments(name)
-
-                    def update_ui():
-                        if not appointments:
-                            messagebox.showinfo("Результат", "Записи не найдены")
-                            return
-
-                        for apt in appointments:
-                            results_tree.insert('', 'end', iid=str(apt['id']), values=(
-                                apt.get('appointment_date', ''),
-                                apt.get('appointment_time', ''),
-                                apt.get('patient_name', ''),
-                                apt.get('phone', ''),
-                                apt.get('doctor_name', '')
-                            ))
+            def done(appointments, error):
+                if not dialog.winfo_exists():
+                    return
+                if error:
+                    messagebox.showerror("Ошибка", f"Ошибка поиска: {error}")
+                    return
+                if not appointments:
+                    messagebox.showinfo("Результат", "Записи не найдены")
+                    return
 
-                    self.ui_queue.put(update_ui)
-                except Exception as e:
-                    self.ui_queue.put(lambda: messagebox.showerror("Ошибка", f"Ошибка поиска: {e}"))
+                for apt in appointments:
+                    results_tree.insert('', 'end', iid=str(apt['id']), values=(
+                        apt.get('appointment_date', ''),
+                        apt.get('appointment_time', ''),
+                        apt.get('patient_name', ''),
+                        apt.get('phone', ''),
+                        apt.get('doctor_name', '')
+                    ))
 
-            threading.Thread(target=task, daemon=True).start()
+            # новый поиск отменяет предыдущий, иначе его результаты смешаются с новыми
+            self.db.submit(lambda: self.db.search_appointments(name), done, group=("search", str(dialog)))
 
         def cancel_selected():
             selected = results_tree.selection()
@@ -1113,19 +2400,20 @@ class AdminPanel:
             patient_name = item['values'][2]
 
             if messagebox.askyesno("Подтверждение", f"Отменить запись для {patient_name}?"):
-                def task():
-                    try:
-                        self.db.cancel_appointment(apt_id)
-                        # Удаляем из дерева поиска
-                        self.ui_queue.put(lambda: results_tree.delete(selected[0]))
-                        # Удаляем из основного списка (если он уже отображается)
-                        self.ui_queue.put(lambda: self.appointments_tree.delete(str(apt_id)) if self.appointments_tree.exists(str(apt_id)) else None)
-                        self.ui_queue.put(lambda: messagebox.showinfo("Успех", "Запись отменена"))
-                        self.ui_queue.put(lambda: self.refresh_appointments())
-                    except Exception as e:
-                        self.ui_queue.put(lambda: messagebox.showerror("Ошибка", str(e)))
-
-                threading.Thread(target=task, daemon=True).start()
+                def done(result, error):
+                    if error:
+                        messagebox.showerror("Ошибка", error)
+                        return
+                    # Удаляем из дерева поиска
+                    if dialog.winfo_exists() and results_tree.exists(selected[0]):
+                        results_tree.delete(selected[0])
+                    # Удаляем из основного списка (если он уже отображается)
+                    if self.appointments_tree.exists(str(apt_id)):
+                        self.appointments_tree.delete(str(apt_id))
+                    messagebox.showinfo("Успех", "Запись отменена")
+                    self.refresh_appointments()
+
+                self.db.submit(lambda: self.db.cancel_appointment(apt_id), done)
 
         # Двойной клик по строке — отмена выбранной записи
         results_tree.bind('<Double-1>', lambda e: cancel_selected())
@@ -1195,136 +2483,207 @@ class AdminPanel:
         else:
             self.patient_display.lift()
 
+    def refresh_patient_display(self):
+        if self.patient_display and self.patient_display.winfo_exists():
+            self.patient_display.refresh()
+
     # ---------- Обновление данных ----------
     def refresh_all(self):
-        if self.is_refreshing:
-            return
-
-        self.is_refreshing = True
-        self.refresh_doctors()
-        self.refresh_queue()
-        self.refresh_appointments()
-
-        def done():
-            self.is_refreshing = False
-            if self.patient_display and self.patient_display.winfo_exists():
-                self.patient_display.refresh()
+        """Обновить всё сейчас; дальше — по расписанию RefreshScheduler"""
+        self.refresh_scheduler.now()
 
-        self.ui_queue.put(done)
+    def _refresh_all(self, done):
+        self.update_offline_status()
+        results = []
 
-    def refresh_doctors(self):
-        def callback(doctors, error):
-            if error:
+        def part_done(changed):
+            results.append(changed)
+            if len(results) < 3:
                 return
+            try:
+                if self.patient_display and self.patient_display.winfo_exists():
+                    self.patient_display.refresh()
+                startup_mark("данные на экране", final=True)
+            finally:
+                done(any(results))
+
+        self.refresh_doctors(part_done)
+        self.refresh_queue(part_done)
+        self.refresh_appointments(part_done)
+
+    def update_offline_status(self):
+        """Плашка о работе без связи и конфликты изменений, сделанных без связи"""
+        status = self.db.offline_status()
+        if not status["online"]:
+            text = "⚠ Нет связи с сервером — показаны сохранённые данные"
+            if status["pending"]:
+                text += f", не отправлено изменений: {status['pending']}"
+        elif status["pending"]:
+            text = f"Отправка изменений: {status['pending']}"
+        else:
+            text = ""
+        if self.offline_label.cget("text") != text:
+            self.offline_label.config(text=text)
 
-            selected = self.doctors_tree.selection()
-            selected_name = None
-            if selected:
-                item = self.doctors_tree.item(selected[0])
-                selected_name = item['values'][0]
-
-            for item in self.doctors_tree.get_children():
-                self.doctors_tree.delete(item)
-
-            for doc in doctors:
-                self.doctors_tree.insert('', 'end', values=(doc['name'], doc['room'], doc['status']))
-
-            # Восстанавливаем выделение
-            if selected_name:
-                for item in self.doctors_tree.get_children():
-                    if self.doctors_tree.item(item)['values'][0] == selected_name:
-                        self.doctors_tree.selection_set(item)
-                        break
+        if status["conflicts"]:
+            lines = [f"• {OFFLINE_OPS[c['op']][2]}: {c['error']}" for c in status["conflicts"]]
+            messagebox.showwarning("Изменения не применены",
+                                   "Изменения, сделанные без связи, не применены — на сервере данные уже другие:\n\n"
+                                   + "\n".join(lines))
 
+    def refresh_doctors(self, on_done=None):
+        def callback(doctors, error):
+            # on_done — в finally: исключение здесь не должно остановить автообновление
+            changed = False
+            try:
+                changed = not error and self.doctors_sync.apply(doctors)
+                if changed and self.announcer:
+                    self.announcer.warm(doc['room'] for doc in doctors)
+            finally:
+                if on_done:
+                    on_done(changed)
+
+        # callback выполняется в главном потоке (через ui_queue) — Treeview трогать можно
         self.db.get_doctors_async(callback)
 
-    def refresh_queue(self):
+    def refresh_queue(self, on_done=None):
         def callback(queue, error):
-            if error:
-                return
-
-            selected = self.queue_tree.selection()
-            selected_id = selected[0] if selected else None
-
-            for item in self.queue_tree.get_children():
-                self.queue_tree.delete(item)
-
-            for item in queue:
-                self.queue_tree.insert('', 'end', iid=str(item['id']), values=(
-                    item['patient_name'],
-                    item.get('service_name', ''),
-                    item['doctor_name'],
-                    item['room'],
-                    item['status']
-                ))
-
-            if selected_id and self.queue_tree.exists(selected_id):
-                self.queue_tree.selection_set(selected_id)
-                self.queue_tree.focus(selected_id)
+            changed = False
+            try:
+                changed = not error and self.queue_sync.apply(queue)
+            finally:
+                if on_done:
+                    on_done(changed)
 
         self.db.get_queue_async(callback)
 
-    def refresh_appointments(self):
+    def refresh_appointments(self, on_done=None):
         date_str = self.current_date.strftime("%Y-%m-%d")
+        if self.appointments_date != date_str:
+            # другой день: сразу показываем сохранённую копию (или пусто), ответ API придёт следом
+            self.appointments_sync.apply(self.db.cached(f"appointments:{date_str}"))
+            self.appointments_date = date_str
 
         def callback(apts, error):
-            if error:
-                return
-
-            selected = self.appointments_tree.selection()
-            selected_id = selected[0] if selected else None
-
-            for item in self.appointments_tree.get_children():
-                self.appointments_tree.delete(item)
-
-            for apt in apts:
-                self.appointments_tree.insert('', 'end', iid=str(apt['id']), values=(
-                    apt['appointment_time'],
-                    apt['patient_name'],
-                    apt['phone'],
-                    apt.get('service_name', ''),
-                    apt['doctor_name']
-                ))
-
-            if selected_id and self.appointments_tree.exists(selected_id):
-                self.appointments_tree.selection_set(selected_id)
-                self.appointments_tree.focus(selected_id)
+            # пока ждали ответ, день могли переключить — тогда ответ не применяем
+            current = date_str == self.current_date.strftime("%Y-%m-%d")
+            changed = False
+            try:
+                changed = not error and current and self.appointments_sync.apply(apts)
+                if not error and current:
+                    self.db.prefetch_appointments(date_str)
+            finally:
+                if on_done:
+                    on_done(changed)
 
         self.db.get_appointments_async(date_str, callback)
 
     def start_auto_refresh(self):
-        """Автообновление каждые 10 секунд"""
+        """Автообновление: реже, пока ничего не меняется, чаще после действий (см. RefreshScheduler)"""
+        self.refresh_scheduler = RefreshScheduler(self.root, self._refresh_all)
+        self.root.bind_all('<ButtonPress>', self.refresh_scheduler.poke, add='+')
+        self.root.bind_all('<KeyPress>', self.refresh_scheduler.poke, add='+')
+        self.refresh_scheduler.now()
 
-        def auto_refresh():
-            while True:
-                time.sleep(CHECK_INTERVAL)
-                try:
-                    self.ui_queue.put(self.refresh_all)
-                except:
-                    break
+    def announce_patient(self, patient_name, room):
+        """Объявление пациента (в очередь Announcer; повторный вызов подряд не дублируется)"""
+        if self.announcer:
+            self.announcer.announce(patient_name, room)
+
+
+class DoctorCard:
+    """Карточка врача на экране очереди: виджеты создаются один раз,
+    при обновлении меняются только StringVar, цвета и видимость строк."""
+
+    BG = '#f5f5f5'
+
+    def __init__(self, parent):
+        self.frame = tk.Frame(parent, bg=self.BG, relief='raised', borderwidth=3)
+        self.room = tk.StringVar(self.frame)
+        self.name = tk.StringVar(self.frame)
+        self.state = tk.StringVar(self.frame)
+        self.patient = tk.StringVar(self.frame)
+        self.count = tk.StringVar(self.frame)
+        self.wait = tk.StringVar(self.frame)
+
+        tk.Label(self.frame, textvariable=self.room, font=('Arial', 36, 'bold'), bg=self.BG).pack(pady=15)
+        tk.Label(self.frame, textvariable=self.name, font=('Arial', 24), bg=self.BG).pack(pady=5)
+        tk.Frame(self.frame, bg='#2196F3', height=3).pack(fill='x', pady=15)
+
+        self.state_label = tk.Label(self.frame, textvariable=self.state, bg=self.BG)
+        self.patient_label = tk.Label(self.frame, textvariable=self.patient, font=('Arial', 32, 'bold'),
+                                      bg=self.BG, fg='#2196F3')
+        self.count_label = tk.Label(self.frame, textvariable=self.count, font=('Arial', 32, 'bold'), bg=self.BG)
+        self.wait_label = tk.Label(self.frame, textvariable=self.wait, font=('Arial', 24), bg=self.BG, fg='#757575')
+        # порядок строк под разделителем; видимые перепаковываются только когда набор меняется
+        self._rows = (self.patient_label, self.count_label, self.wait_label)
+        self._visible = None
+        self._state_style = None
+        self.position = None
+
+    @staticmethod
+    def _set(var, value):
+        if var.get() != value:
+            var.set(value)
+
+    def update(self, doctor, items):
+        """items — строки очереди только этого врача, в порядке очереди."""
+        self._set(self.room, doctor['room'])
+        self._set(self.name, doctor['name'])
 
-        thread = threading.Thread(target=auto_refresh, daemon=True)
-        thread.start()
+        current = None
+        waiting_count = 0
+        first_waiting = None
+        for item in items:
+            if item['status'] == 'в_работе':
+                current = item
+            elif item['status'] in ['готов', 'ожидание']:
+                if not current:
+                    current = item
+                waiting_count += 1
+            if item['status'] == 'ожидание' and first_waiting is None:
+                first_waiting = item
 
-    def announce_patient(self, patient_name, room):
-        """Объявление пациента"""
-        if HAS_TTS:
-            def announce():
-                try:
-                    winsound.MessageBeep()
-                    winsound.Beep(1000, 300)
-                except:
-                    pass
-
-                if TTS_ENGINE:
-                    try:
-                        text = f"Приглашаем пациента {patient_name} в {room}"
-                        TTS_ENGINE.say(text)
-                        TTS_ENGINE.runAndWait()
-                    except:
-                        pass
-
-            threading.Thread(target=announce, daemon=True).start()
+        visible = set()
+        if current:
+            if current['status'] == 'в_работе':
+                style = ("ИДЁТ ПРИЁМ", '#4CAF50', 28, 10)
+                self._set(self.patient, current['patient_name'])
+                visible.add(self.patient_label)
+            elif current['status'] == 'готов':
+                style = ("ПРИГЛАШАЕМ", '#FF9800', 28, 10)
+                self._set(self.patient, current['patient_name'])
+                visible.add(self.patient_label)
+            else:
+                style = ("ОЖИДАНИЕ", '#FF9800', 28, 10)
+                if waiting_count > 0:
+                    self._set(self.count, f"{waiting_count} чел.")
+                    visible.add(self.count_label)
+        else:
+            style = ("СВОБОДНО", '#4CAF50', 36, 30)
+
+        # оценка сервера: сколько ждать следующему в очереди
+        if first_waiting is not None and first_waiting.get('estimated_wait_min') is not None:
+            self._set(self.wait, f"Ожидание ≈ {first_waiting['estimated_wait_min']} мин")
+            visible.add(self.wait_label)
+
+        self._set(self.state, style[0])
+        if style != self._state_style:
+            _, color, size, pady = style
+            self.state_label.configure(fg=color, font=('Arial', size, 'bold'))
+            if self._state_style is None:
+                self.state_label.pack(pady=pady)
+            elif self._state_style[3] != pady:
+                self.state_label.pack_configure(pady=pady)
+            self._state_style = style
+
+        if visible != self._visible:
+            for label in self._rows:
+                label.pack_forget()
+            for label in self._rows:
+                if label in visible:
+                    label.pack(pady=5 if label is self.wait_label else 10)
+            self._visible = visible
 
 
 class PatientDisplay(tk.Toplevel):
@@ -1332,7 +2691,8 @@ class PatientDisplay(tk.Toplevel):
 
     def __init__(self, master, db):
         super().__init__(master)
-        self.db = db
+        self.db = db  # ответы приходят в главный поток (см. ApiLoop)
+        self.cards = {}  # doctor_id -> DoctorCard
         self.title("Электронная очередь")
         self.geometry("1920x1080")
         self.configure(bg='white')
@@ -1358,62 +2718,36 @@ class PatientDisplay(tk.Toplevel):
             def callback_queue(queue, error2):
                 if error2:
                     return
-
-                for widget in self.rooms_container.winfo_children():
-                    widget.destroy()
-
-                for i, doctor in enumerate(doctors):
-                    row = i // 2
-                    col = i % 2
-                    self.create_doctor_card(doctor, queue, row, col)
+                self.render(doctors, queue)
 
             self.db.get_queue_async(callback_queue)
 
         self.db.get_doctors_async(callback_doctors)
 
-    def create_doctor_card(self, doctor, queue, row, col):
-        card = tk.Frame(self.rooms_container, bg='#f5f5f5', relief='raised', borderwidth=3)
-        card.grid(row=row, column=col, padx=20, pady=20, sticky='nsew')
-
-        self.rooms_container.grid_rowconfigure(row, weight=1)
-        self.rooms_container.grid_columnconfigure(col, weight=1)
-
-        tk.Label(card, text=doctor['room'], font=('Arial', 36, 'bold'), bg='#f5f5f5').pack(pady=15)
-        tk.Label(card, text=doctor['name'], font=('Arial', 24), bg='#f5f5f5').pack(pady=5)
-        tk.Frame(card, bg='#2196F3', height=3).pack(fill='x', pady=15)
-
-        current = None
-        waiting_count = 0
+    def render(self, doctors, queue):
+        if not self.winfo_exists():
+            return
 
+        # очередь раскладываем по врачам один раз, а не сканируем её для каждой карточки
+        by_doctor = {}
         for item in queue:
-            if item['doctor_id'] == doctor['id']:
-                if item['status'] == 'в_работе':
-                    current = item
-                elif item['status'] in ['готов', 'ожидание']:
-                    if not current:
-                        current = item
-                    waiting_count += 1
-
-        if current:
-            if current['status'] == 'в_работе':
-                tk.Label(card, text="ИДЁТ ПРИЁМ", font=('Arial', 28, 'bold'),
-                         bg='#f5f5f5', fg='#4CAF50').pack(pady=10)
-                tk.Label(card, text=current['patient_name'], font=('Arial', 32, 'bold'),
-                         bg='#f5f5f5', fg='#2196F3').pack(pady=10)
-            elif current['status'] == 'готов':
-                tk.Label(card, text="ПРИГЛАШАЕМ", font=('Arial', 28, 'bold'),
-                         bg='#f5f5f5', fg='#FF9800').pack(pady=10)
-                tk.Label(card, text=current['patient_name'], font=('Arial', 32, 'bold'),
-                         bg='#f5f5f5', fg='#2196F3').pack(pady=10)
-            else:
-                tk.Label(card, text="ОЖИДАНИЕ", font=('Arial', 28, 'bold'),
-                         bg='#f5f5f5', fg='#FF9800').pack(pady=10)
-                if waiting_count > 0:
-                    tk.Label(card, text=f"{waiting_count} чел.", font=('Arial', 32, 'bold'),
-                             bg='#f5f5f5').pack(pady=10)
-        else:
-            tk.Label(card, text="СВОБОДНО", font=('Arial', 36, 'bold'),
-                     bg='#f5f5f5', fg='#4CAF50').pack(pady=30)
+            by_doctor.setdefault(item['doctor_id'], []).append(item)
+
+        for doctor_id in set(self.cards) - {doc['id'] for doc in doctors}:
+            self.cards.pop(doctor_id).frame.destroy()
+
+        for i, doctor in enumerate(doctors):
+            card = self.cards.get(doctor['id'])
+            if card is None:
+                card = self.cards[doctor['id']] = DoctorCard(self.rooms_container)
+            position = (i // 2, i % 2)
+            if card.position != position:
+                row, col = position
+                card.frame.grid(row=row, column=col, padx=20, pady=20, sticky='nsew')
+                self.rooms_container.grid_rowconfigure(row, weight=1)
+                self.rooms_container.grid_columnconfigure(col, weight=1)
+                card.position = position
+            card.update(doctor, by_doctor.get(doctor['id'], ()))
 
     def auto_refresh(self):
         self.refresh()
@@ -1421,6 +2755,9 @@ class PatientDisplay(tk.Toplevel):
 
 
 if __name__ == "__main__":
+    startup_mark("модули")
     root = tk.Tk()
     app = AdminPanel(root)
+    startup_mark("интерфейс")
+    root.after_idle(startup_mark, "окно отрисовано")
     root.mainloop()
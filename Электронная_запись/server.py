@@ -1,13 +1,31 @@
 #!/usr/bin/env python3
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import deque
+import asyncio
+import base64
+import bisect
+import contextvars
+import functools
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import mimetypes
+import re
 import uvicorn
 import os
+import queue
 import threading
+import time
 
 # ------------------------------
 # DB mode:
@@ -19,6 +37,9 @@ SQLITE_PATH = os.getenv("SQLITE_PATH", "dental_clinic.db")
 
 USE_POSTGRES = DATABASE_URL.startswith("postgres://") or DATABASE_URL.startswith("postgresql://")
 
+# Реплики только для чтения (через запятую). Пусто — все запросы идут в DATABASE_URL.
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+
 
 def normalize_date_str(date_str: str) -> str:
     """
@@ -51,6 +72,28 @@ app.add_middleware(
 )
 
 
+# JSON API сжимаем на лету (большие списки записей/очереди), статика ниже сжата заранее
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+
+
+# потоки событий не сжимаем: gzip копит данные и табло получало бы их с задержкой
+GZIP_SKIP_PATHS = ("/api/queue/stream",)
+
+
+class ApiGZipMiddleware(GZipMiddleware):
+    """GZip только для /api/*: статические файлы уже лежат в памяти в br/gzip."""
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http" and scope["path"].startswith("/api/")
+                and scope["path"] not in GZIP_SKIP_PATHS):
+            await super().__call__(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(ApiGZipMiddleware, minimum_size=GZIP_MIN_SIZE)
+
+
 @app.get("/api/health")
 def health():
     return {"status": "ok"}
@@ -66,6 +109,147 @@ class AppointmentCreate(BaseModel):
     duration_hours: int | None = 1
 
 
+# ==============================
+# Трассировка (W3C traceparent -> Zipkin JSON)
+# ==============================
+# Программа очереди передаёт заголовок traceparent, сервер продолжает тот же
+# trace: span запроса, span обработчика (после admission control) и span'ы SQL.
+# Включается, если задан TRACE_FILE (строки JSON) и/или TRACE_ZIPKIN_URL
+# (локальный Zipkin/Jaeger, например http://localhost:9411/api/v2/spans).
+TRACE_FILE = os.getenv("TRACE_FILE", "").strip()
+TRACE_ZIPKIN_URL = os.getenv("TRACE_ZIPKIN_URL", "").strip()
+TRACE_ENABLED = bool(TRACE_FILE or TRACE_ZIPKIN_URL)
+TRACE_SERVICE = os.getenv("TRACE_SERVICE", "dental-api")
+
+_trace_ctx = contextvars.ContextVar("trace_ctx", default=None)  # (trace_id, span_id)
+_trace_buffer = queue.Queue(maxsize=10000)
+_trace_thread = None
+_trace_lock = threading.Lock()
+
+
+def parse_traceparent(value: str):
+    """'00-<trace_id>-<span_id>-01' -> (trace_id, span_id) или None."""
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+class _Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "tags", "start_us", "start_ns")
+
+    def __init__(self, name, kind, tags, parent):
+        self.trace_id = parent[0] if parent else os.urandom(16).hex()
+        self.parent_id = parent[1] if parent else None
+        self.span_id = os.urandom(8).hex()
+        self.name = name
+        self.kind = kind
+        self.tags = tags
+        self.start_us = time.time_ns() // 1000
+        self.start_ns = time.perf_counter_ns()
+
+
+@contextmanager
+def trace_span(name: str, kind: str = None, parent=None, **tags):
+    """Span вокруг блока кода. parent — (trace_id, span_id) из заголовка, иначе текущий контекст.
+    Вне запроса (фоновые циклы) span'ы без kind не пишутся, чтобы не засорять экспорт.
+    """
+    parent = parent or _trace_ctx.get()
+    if not TRACE_ENABLED or (parent is None and kind is None):
+        yield None
+        return
+    span = _Span(name, kind, tags, parent)
+    token = _trace_ctx.set((span.trace_id, span.span_id))
+    try:
+        yield span
+    except BaseException as e:
+        span.tags["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _trace_ctx.reset(token)
+        _trace_finish(span)
+
+
+def _trace_finish(span: _Span):
+    record = {
+        "traceId": span.trace_id,
+        "id": span.span_id,
+        "name": span.name,
+        "timestamp": span.start_us,
+        "duration": max(1, (time.perf_counter_ns() - span.start_ns) // 1000),
+        "localEndpoint": {"serviceName": TRACE_SERVICE},
+        "tags": {k: str(v) for k, v in span.tags.items()},
+    }
+    if span.parent_id:
+        record["parentId"] = span.parent_id
+    if span.kind:
+        record["kind"] = span.kind
+    _trace_start_exporter()
+    try:
+        _trace_buffer.put_nowait(record)
+    except queue.Full:
+        pass  # экспорт не успевает — теряем span, но не тормозим запросы
+
+
+def _trace_start_exporter():
+    global _trace_thread
+    if _trace_thread is not None:
+        return
+    with _trace_lock:
+        if _trace_thread is None:
+            _trace_thread = threading.Thread(target=_trace_export_loop, daemon=True)
+            _trace_thread.start()
+
+
+def _trace_export_loop():
+    import urllib.request
+
+    while True:
+        batch = [_trace_buffer.get()]
+        deadline = time.monotonic() + 1
+        while len(batch) < 200:
+            try:
+                batch.append(_trace_buffer.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                    for record in batch:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if TRACE_ZIPKIN_URL:
+                req = urllib.request.Request(
+                    TRACE_ZIPKIN_URL,
+                    data=json.dumps(batch).encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                    method="POST",
+                )
+                urllib.request.urlopen(req, timeout=5).close()
+        except Exception as e:
+            print(f"Ошибка экспорта трассировки: {e}")
+
+
+class _TracedPgCursor:
+    """Курсор psycopg2 внутри pg_transaction: каждый execute — отдельный span."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def execute(self, sql, params=None):
+        with trace_span("pg.execute", **{"db.statement": str(sql)[:300]}):
+            return self._cur.execute(sql, params)
+
+    def executemany(self, sql, seq):
+        with trace_span("pg.executemany", **{"db.statement": str(sql)[:300]}):
+            return self._cur.executemany(sql, seq)
+
+
 # ==============================
 # SQLite helpers (local)
 # ==============================
@@ -112,6 +296,7 @@ def ensure_schema_sqlite(conn: sqlite3.Connection) -> None:
             doctor_id INTEGER NOT NULL,
             status TEXT DEFAULT 'ожидание',
             called_at TEXT,
+            finished_at TEXT,
             created_at TEXT DEFAULT (datetime('now')),
             FOREIGN KEY (appointment_id) REFERENCES appointments(id),
             FOREIGN KEY (doctor_id) REFERENCES doctors(id)
@@ -152,11 +337,13 @@ def ensure_schema_sqlite(conn: sqlite3.Connection) -> None:
     except Exception:
         pass
 
-    # queue.called_at / queue.status
+    # queue.called_at / queue.finished_at / queue.status
     try:
         cols = [r[1] for r in cur.execute("PRAGMA table_info(queue)").fetchall()]
         if "called_at" not in cols:
             cur.execute("ALTER TABLE queue ADD COLUMN called_at TEXT")
+        if "finished_at" not in cols:
+            cur.execute("ALTER TABLE queue ADD COLUMN finished_at TEXT")
         if "status" not in cols:
             cur.execute("ALTER TABLE queue ADD COLUMN status TEXT DEFAULT 'ожидание'")
         if "appointment_id" not in cols:
@@ -166,10 +353,166 @@ def ensure_schema_sqlite(conn: sqlite3.Connection) -> None:
     except Exception:
         pass
 
+    # --- архивные таблицы (копия структуры + archived_at) ---
+    try:
+        for table in ("appointments", "queue"):
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_archive AS SELECT * FROM {table} WHERE 0")
+            hot = {r[1]: r[2] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+            hot["archived_at"] = "TEXT"
+            cols = [r[1] for r in cur.execute(f"PRAGMA table_info({table}_archive)").fetchall()]
+            for col, col_type in hot.items():
+                if col not in cols:
+                    cur.execute(f"ALTER TABLE {table}_archive ADD COLUMN {col} {col_type}")
+            # id в архиве уникален: повторный перенос той же строки игнорируется (старые дубли убираем)
+            cur.execute(f"DELETE FROM {table}_archive WHERE rowid NOT IN "
+                        f"(SELECT MIN(rowid) FROM {table}_archive GROUP BY id)")
+            cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_archive_id ON {table}_archive(id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_appointments_archive_date ON appointments_archive(appointment_date)")
+    except Exception:
+        pass
+
+    # --- ключи идемпотентности (повторы POST без дублей) ---
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS idempotency_keys (
+            idem_key TEXT PRIMARY KEY,
+            scope TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status_code INTEGER,
+            response TEXT,
+            created_at TEXT NOT NULL
+        )"""
+    )
+
+    # --- общие token bucket'ы для rate limiting (RATE_LIMIT_BACKEND=db) ---
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS rate_limits (
+            bucket TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )"""
+    )
+
+    # --- расписание врачей: недельный шаблон + исключения на даты ---
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS doctor_schedules (
+            doctor_id INTEGER NOT NULL,
+            weekday INTEGER NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            break_start TEXT,
+            break_end TEXT,
+            slot_minutes INTEGER NOT NULL DEFAULT 30,
+            PRIMARY KEY (doctor_id, weekday),
+            FOREIGN KEY (doctor_id) REFERENCES doctors(id)
+        )"""
+    )
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS schedule_exceptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            doctor_id INTEGER NOT NULL,
+            exception_date TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            start_time TEXT,
+            end_time TEXT,
+            note TEXT DEFAULT '',
+            FOREIGN KEY (doctor_id) REFERENCES doctors(id)
+        )"""
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_schedule_exceptions_date ON schedule_exceptions(exception_date)")
+
+    # --- outbox уведомлений (пишется в одной транзакции с записью) ---
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_type TEXT NOT NULL,
+            aggregate_id INTEGER,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )"""
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at)")
+
+    # --- индексы под keyset-пагинацию GET /api/appointments ---
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_appointments_keyset "
+        "ON appointments(appointment_date, appointment_time, id)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_appointments_doctor_keyset "
+        "ON appointments(doctor_id, appointment_date, appointment_time, id)"
+    )
+
     conn.commit()
 
 
+class _TracedSqliteCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        if not self.connection.tracing:
+            return super().execute(sql, parameters)
+        with trace_span("sqlite.execute", **{"db.statement": sql[:300]}):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq):
+        if not self.connection.tracing:
+            return super().executemany(sql, seq)
+        with trace_span("sqlite.executemany", **{"db.statement": sql[:300]}):
+            return super().executemany(sql, seq)
+
+
+class _TracedSqliteConnection(sqlite3.Connection):
+    tracing = False
+
+    def cursor(self, factory=_TracedSqliteCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+
+# Пакет /api/batch: соединение SQLite или курсор PG общей транзакции (см. «Пакетные изменения»)
+_batch_tx = contextvars.ContextVar("batch_tx", default=None)
+# длительности приёмов, завершённых внутри пакета: в статистику — только после commit
+_batch_service_samples = contextvars.ContextVar("batch_service_samples", default=None)
+
+
+class _BatchSqliteConnection:
+    """Соединение внутри пакета: обработчики зовут commit/close как обычно, фиксирует пакет."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
 def get_db_sqlite():
+    batch = _batch_tx.get()
+    if batch is not None:
+        return batch
+
+    if TRACE_ENABLED:
+        conn = sqlite3.connect(SQLITE_PATH, factory=_TracedSqliteConnection)
+        conn.row_factory = sqlite3.Row
+        # миграция схемы на каждом подключении — одним span'ом, без отдельных запросов
+        with trace_span("sqlite.connect"):
+            ensure_schema_sqlite(conn)
+        conn.tracing = True
+        return conn
+
     conn = sqlite3.connect(SQLITE_PATH)
     conn.row_factory = sqlite3.Row
     ensure_schema_sqlite(conn)
@@ -281,6 +624,7 @@ def ensure_schema_pg():
                     doctor_id INTEGER NOT NULL,
                     status TEXT DEFAULT 'ожидание',
                     called_at TIMESTAMPTZ,
+                    finished_at TIMESTAMPTZ,
                     created_at TIMESTAMPTZ DEFAULT NOW(),
                     FOREIGN KEY (appointment_id) REFERENCES public.appointments(id),
                     FOREIGN KEY (doctor_id) REFERENCES public.doctors(id)
@@ -288,6 +632,7 @@ def ensure_schema_pg():
             """)
             try:
                 cur.execute("ALTER TABLE public.queue ADD COLUMN IF NOT EXISTS called_at TIMESTAMPTZ")
+                cur.execute("ALTER TABLE public.queue ADD COLUMN IF NOT EXISTS finished_at TIMESTAMPTZ")
                 cur.execute("ALTER TABLE public.queue ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'ожидание'")
             except Exception:
                 pass
@@ -302,6 +647,117 @@ def ensure_schema_pg():
                 )
             """)
 
+            # архивные таблицы (hot/cold): та же структура + archived_at
+            for table in ("appointments", "queue"):
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS public.{table}_archive "
+                    f"(LIKE public.{table} INCLUDING DEFAULTS)"
+                )
+                cur.execute(f"ALTER TABLE public.{table}_archive ADD COLUMN IF NOT EXISTS archived_at TIMESTAMPTZ")
+                # колонки, добавленные в горячую таблицу позже, переносим и в архив
+                cur.execute(
+                    "SELECT column_name, data_type FROM information_schema.columns "
+                    "WHERE table_schema = 'public' AND table_name = %s",
+                    (table,),
+                )
+                for col, col_type in cur.fetchall():
+                    try:
+                        cur.execute(f"ALTER TABLE public.{table}_archive ADD COLUMN IF NOT EXISTS {col} {col_type}")
+                    except Exception:
+                        pass
+                # id в архиве уникален: повторный перенос той же строки игнорируется (старые дубли убираем)
+                cur.execute(
+                    f"DELETE FROM public.{table}_archive a USING public.{table}_archive b "
+                    f"WHERE a.id = b.id AND a.ctid > b.ctid"
+                )
+                cur.execute(
+                    f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_archive_id ON public.{table}_archive (id)"
+                )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_appointments_archive_date "
+                "ON public.appointments_archive (appointment_date)"
+            )
+
+            # ключи идемпотентности
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS public.idempotency_keys (
+                    idem_key TEXT PRIMARY KEY,
+                    scope TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    status_code INTEGER,
+                    response TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+            """)
+
+            # token bucket'ы для rate limiting (RATE_LIMIT_BACKEND=db)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS public.rate_limits (
+                    bucket TEXT PRIMARY KEY,
+                    tokens DOUBLE PRECISION NOT NULL,
+                    updated_at DOUBLE PRECISION NOT NULL
+                )
+            """)
+
+            # расписание врачей
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS public.doctor_schedules (
+                    doctor_id INTEGER NOT NULL REFERENCES public.doctors(id),
+                    weekday SMALLINT NOT NULL,
+                    start_time TEXT NOT NULL,
+                    end_time TEXT NOT NULL,
+                    break_start TEXT,
+                    break_end TEXT,
+                    slot_minutes INTEGER NOT NULL DEFAULT 30,
+                    PRIMARY KEY (doctor_id, weekday)
+                )
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS public.schedule_exceptions (
+                    id SERIAL PRIMARY KEY,
+                    doctor_id INTEGER NOT NULL REFERENCES public.doctors(id),
+                    exception_date TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    start_time TEXT,
+                    end_time TEXT,
+                    note TEXT DEFAULT ''
+                )
+            """)
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_schedule_exceptions_date "
+                "ON public.schedule_exceptions (exception_date)"
+            )
+
+            # outbox уведомлений
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS public.outbox (
+                    id BIGSERIAL PRIMARY KEY,
+                    event_type TEXT NOT NULL,
+                    aggregate_id INTEGER,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    last_error TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    sent_at TIMESTAMPTZ
+                )
+            """)
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_pending "
+                "ON public.outbox (status, next_attempt_at)"
+            )
+
+            # индексы под keyset-пагинацию GET /api/appointments
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_appointments_keyset "
+                "ON public.appointments (appointment_date, appointment_time, id)"
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_appointments_doctor_keyset "
+                "ON public.appointments (doctor_id, appointment_date, appointment_time, id)"
+            )
+
     except Exception as e:
         print(f"Ошибка при инициализации схемы PostgreSQL: {e}")
     finally:
@@ -312,34 +768,127 @@ def ensure_schema_pg():
 ensure_schema_pg()
 
 
-def pg_query_all(sql: str, params: tuple = ()):
-    """Выполняет SELECT, возвращает список dict."""
-    conn, key = _pg_getconn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            cols = [desc[0] for desc in cur.description]
-            rows = cur.fetchall()
-            return [dict(zip(cols, row)) for row in rows]
-    finally:
-        _pg_putconn(conn, key)
+# --- реплики для чтения ---
+_replica_pools = []
+_replica_rr = itertools.count()
+_replica_down_until = {}
+_replica_lock = threading.Lock()
 
 
-def pg_query_one(sql: str, params: tuple = ()):
-    """Выполняет SELECT, возвращает один dict или None."""
+def _init_replica_pools():
+    if _replica_pools or not DATABASE_REPLICA_URLS:
+        return
+    from psycopg2.pool import SimpleConnectionPool
+
+    with _replica_lock:
+        if _replica_pools:
+            return
+        for dsn in DATABASE_REPLICA_URLS:
+            _replica_pools.append(SimpleConnectionPool(
+                0, 5,
+                dsn=dsn,
+                connect_timeout=5,
+                sslmode=os.getenv("PGSSLMODE", "require"),
+            ))
+
+
+def _replica_getconn():
+    """Соединение с репликой (по кругу, пропуская недавно упавшие) или None."""
+    _init_replica_pools()
+    if not _replica_pools:
+        return None
+    now = time.monotonic()
+    for _ in range(len(_replica_pools)):
+        idx = next(_replica_rr) % len(_replica_pools)
+        if _replica_down_until.get(idx, 0) > now:
+            continue
+        pool = _replica_pools[idx]
+        key = _pg_conn_key()
+        try:
+            return pool.getconn(key), key, pool, idx
+        except Exception as e:
+            print(f"Реплика #{idx} недоступна: {e}")
+            _replica_down_until[idx] = now + 30
+    return None
+
+
+def _pg_read(sql: str, params: tuple, fetch, readonly: bool):
+    """SELECT на реплике (если readonly и она есть), при ошибке реплики — на основной БД."""
+    with trace_span("pg.query", **{"db.statement": sql[:300], "db.readonly": readonly}):
+        return _pg_read_inner(sql, params, fetch, readonly)
+
+
+def _pg_read_inner(sql: str, params: tuple, fetch, readonly: bool):
+    batch = _batch_tx.get()
+    if batch is not None:
+        batch.execute(sql, params)
+        return fetch(batch)
+
+    if readonly:
+        replica = _replica_getconn()
+        if replica is not None:
+            conn, key, pool, idx = replica
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(sql, params)
+                    result = fetch(cur)
+                conn.rollback()  # не держим открытую транзакцию на реплике
+                pool.putconn(conn, key)
+                return result
+            except Exception as e:
+                print(f"Ошибка чтения с реплики #{idx}, читаем с основной БД: {e}")
+                _replica_down_until[idx] = time.monotonic() + 30
+                try:
+                    pool.putconn(conn, key, close=True)
+                except Exception:
+                    pass
+
     conn, key = _pg_getconn()
     try:
         with conn.cursor() as cur:
             cur.execute(sql, params)
-            cols = [desc[0] for desc in cur.description] if cur.description else []
-            row = cur.fetchone()
-            return dict(zip(cols, row)) if row else None
+            return fetch(cur)
     finally:
         _pg_putconn(conn, key)
 
 
+def _fetch_all_dicts(cur):
+    cols = [desc[0] for desc in cur.description]
+    return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+
+def _fetch_one_dict(cur):
+    cols = [desc[0] for desc in cur.description] if cur.description else []
+    row = cur.fetchone()
+    return dict(zip(cols, row)) if row else None
+
+
+def pg_query_all(sql: str, params: tuple = (), readonly: bool = False):
+    """Выполняет SELECT, возвращает список dict. readonly=True — можно читать с реплики."""
+    return _pg_read(sql, params, _fetch_all_dicts, readonly)
+
+
+def pg_query_one(sql: str, params: tuple = (), readonly: bool = False):
+    """Выполняет SELECT, возвращает один dict или None. readonly=True — можно читать с реплики."""
+    return _pg_read(sql, params, _fetch_one_dict, readonly)
+
+
 def pg_execute(sql: str, params: tuple = (), returning_id: bool = False):
     """INSERT / UPDATE / DELETE. Если returning_id=True, возвращает id."""
+    with trace_span("pg.execute", **{"db.statement": sql[:300]}):
+        return _pg_execute_inner(sql, params, returning_id)
+
+
+def _pg_execute_inner(sql: str, params: tuple, returning_id: bool):
+    batch = _batch_tx.get()
+    if batch is not None:
+        if returning_id:
+            batch.execute(sql + " RETURNING id", params)
+            row = batch.fetchone()
+            return row[0] if row else None
+        batch.execute(sql, params)
+        return None
+
     conn, key = _pg_getconn()
     try:
         conn.autocommit = False
@@ -360,6 +909,1515 @@ def pg_execute(sql: str, params: tuple = (), returning_id: bool = False):
         _pg_putconn(conn, key)
 
 
+@contextmanager
+def pg_transaction():
+    """Несколько запросов в одной транзакции: commit при успехе, rollback при ошибке."""
+    batch = _batch_tx.get()
+    if batch is not None:
+        # внутри /api/batch — это часть общей транзакции пакета
+        yield batch
+        return
+
+    with trace_span("pg.transaction"):
+        conn, key = _pg_getconn()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                yield _TracedPgCursor(cur) if TRACE_ENABLED else cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            _pg_putconn(conn, key)
+
+
+# ==============================
+# Архив (hot/cold)
+# ==============================
+# Завершённые/отменённые/неявки старше горизонта переносятся в *_archive,
+# чтобы рабочие таблицы appointments и queue оставались маленькими.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "6"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVABLE_STATUSES = ("завершена", "отменена", "не_пришёл")
+
+_APPOINTMENT_REPORT_COLS = (
+    "id, patient_name, phone, doctor_id, appointment_date, appointment_time, "
+    "service_name, duration_hours, status, created_at"
+)
+_QUEUE_REPORT_COLS = "id, appointment_id, doctor_id, status"
+
+
+def _table(name: str) -> str:
+    return f"public.{name}" if USE_POSTGRES else name
+
+
+def appointments_source(include_archive: bool = False) -> str:
+    """FROM-источник записей: только рабочая таблица или рабочая + архив."""
+    if not include_archive:
+        return _table("appointments")
+    return (
+        f"(SELECT {_APPOINTMENT_REPORT_COLS} FROM {_table('appointments')} "
+        f"UNION ALL SELECT {_APPOINTMENT_REPORT_COLS} FROM {_table('appointments_archive')})"
+    )
+
+
+def queue_source(include_archive: bool = False) -> str:
+    """FROM-источник очереди для отчётов."""
+    if not include_archive:
+        return _table("queue")
+    return (
+        f"(SELECT {_QUEUE_REPORT_COLS} FROM {_table('queue')} "
+        f"UNION ALL SELECT {_QUEUE_REPORT_COLS} FROM {_table('queue_archive')})"
+    )
+
+
+def archive_old_records(days: int = None) -> dict:
+    """Переносит старые закрытые записи (и их строки очереди) в архив.
+    Работает пачками по ARCHIVE_BATCH_SIZE, каждая пачка — одна транзакция.
+    Записи, у которых ещё есть активная строка в очереди, не трогаем.
+    Архиватор работает в каждом воркере: в PostgreSQL пачка берётся с
+    FOR UPDATE SKIP LOCKED, так что воркеры не переносят одни и те же записи;
+    уникальный id в *_archive — страховка от повторной вставки.
+    """
+    days = ARCHIVE_AFTER_DAYS if days is None else int(days)
+    cutoff = (datetime.now().date() - timedelta(days=days)).strftime("%Y-%m-%d")
+    now_iso = datetime.now().isoformat(timespec="seconds")
+    moved = {"appointments": 0, "queue": 0, "cutoff": cutoff}
+
+    select_sql = (
+        "SELECT a.id FROM {apts} a "
+        "WHERE a.status IN ({statuses}) AND a.appointment_date < {ph} "
+        "  AND NOT EXISTS (SELECT 1 FROM {queue} q WHERE q.appointment_id = a.id "
+        "                  AND q.status IN ('ожидание', 'готов', 'в_работе')) "
+        "ORDER BY a.id LIMIT {ph}{lock}"
+    )
+
+    if USE_POSTGRES:
+        while True:
+            with pg_transaction() as cur:
+                cur.execute(
+                    select_sql.format(apts="public.appointments", queue="public.queue",
+                                      statuses="%s, %s, %s", ph="%s", lock=" FOR UPDATE OF a SKIP LOCKED"),
+                    (*ARCHIVABLE_STATUSES, cutoff, ARCHIVE_BATCH_SIZE),
+                )
+                ids = [r[0] for r in cur.fetchall()]
+                if not ids:
+                    break
+                for table, key in (("queue", "appointment_id"), ("appointments", "id")):
+                    cur.execute(
+                        "SELECT column_name FROM information_schema.columns "
+                        "WHERE table_schema = 'public' AND table_name = %s",
+                        (table,),
+                    )
+                    cols = ", ".join(r[0] for r in cur.fetchall())
+                    cur.execute(
+                        f"INSERT INTO public.{table}_archive ({cols}, archived_at) "
+                        f"SELECT {cols}, now() FROM public.{table} WHERE {key} = ANY(%s) "
+                        f"ON CONFLICT (id) DO NOTHING",
+                        (ids,),
+                    )
+                    moved[table] += cur.rowcount
+                    cur.execute(f"DELETE FROM public.{table} WHERE {key} = ANY(%s)", (ids,))
+            if len(ids) < ARCHIVE_BATCH_SIZE:
+                break
+        if moved["queue"]:
+            invalidate("queue")
+        return moved
+
+    conn = get_db_sqlite()
+    try:
+        cur = conn.cursor()
+        while True:
+            ids = [r[0] for r in cur.execute(
+                select_sql.format(apts="appointments", queue="queue", statuses="?, ?, ?", ph="?", lock=""),
+                (*ARCHIVABLE_STATUSES, cutoff, ARCHIVE_BATCH_SIZE),
+            ).fetchall()]
+            if not ids:
+                break
+            qmarks = ", ".join(["?"] * len(ids))
+            for table, key in (("queue", "appointment_id"), ("appointments", "id")):
+                cols = ", ".join(r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall())
+                cur.execute(
+                    f"INSERT OR IGNORE INTO {table}_archive ({cols}, archived_at) "
+                    f"SELECT {cols}, ? FROM {table} WHERE {key} IN ({qmarks})",
+                    (now_iso, *ids),
+                )
+                moved[table] += cur.rowcount
+                cur.execute(f"DELETE FROM {table} WHERE {key} IN ({qmarks})", tuple(ids))
+            conn.commit()
+            if len(ids) < ARCHIVE_BATCH_SIZE:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if moved["queue"]:
+        invalidate("queue")
+    return moved
+
+
+def _archive_loop():
+    while True:
+        try:
+            moved = archive_old_records()
+            if moved["appointments"] or moved["queue"]:
+                print(f"Архивация: {moved}")
+        except Exception as e:
+            print(f"Ошибка архивации: {e}")
+        time.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+
+
+@app.on_event("startup")
+def start_archiver():
+    if ARCHIVE_AFTER_DAYS > 0 and ARCHIVE_INTERVAL_HOURS > 0:
+        threading.Thread(target=_archive_loop, daemon=True).start()
+
+
+# ==============================
+# Кэш + межпроцессная инвалидация
+# ==============================
+# Кэшируются врачи, услуги, занятость слотов, расписания и снимок очереди.
+# При нескольких воркерах (WEB_CONCURRENCY > 1, uvicorn --workers N, gunicorn)
+# любое изменение рассылается остальным процессам:
+#   - PostgreSQL: LISTEN/NOTIFY на канале CACHE_BUS_CHANNEL
+#   - SQLite: файлы-метки в CACHE_BUS_DIR (опрос mtime)
+# Записей в кэше не больше CACHE_MAX_ENTRIES (планы дня по врачу и дате
+# иначе копились бы бесконечно): сначала выбрасываются просроченные, затем самые старые.
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+CACHE_BUS_CHANNEL = "cache_invalidate"
+CACHE_BUS_DSN = os.getenv("CACHE_BUS_DSN", DATABASE_URL)
+CACHE_BUS_DIR = os.getenv("CACHE_BUS_DIR", SQLITE_PATH + ".bus")
+CACHE_BUS_POLL = float(os.getenv("CACHE_BUS_POLL", "0.5"))
+CACHE_NAMES = ("doctors", "services", "slots", "queue", "schedules")
+
+
+def _multi_worker() -> bool:
+    """Несколько процессов обслуживают один сервер — кэшам нужна общая инвалидация.
+    uvicorn --workers N запускает воркеры дочерними процессами multiprocessing, даже без WEB_CONCURRENCY."""
+    import multiprocessing
+
+    return (WORKERS > 1 or multiprocessing.parent_process() is not None
+            or os.getenv("SERVER_SOFTWARE", "").startswith("gunicorn"))
+
+
+CACHE_BUS = _multi_worker()
+
+_cache = {}
+_cache_gen = {name: 0 for name in CACHE_NAMES}
+_cache_changed_at = {name: 0.0 for name in CACHE_NAMES}
+_cache_lock = threading.Lock()
+
+
+def cache_get(name: str, key, loader):
+    """Значение из кэша или loader(). Если пока грузили пришла инвалидация — не сохраняем."""
+    if CACHE_TTL <= 0:
+        return loader()
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get((name, key))
+        if hit and hit[0] > now:
+            return hit[1]
+        gen = _cache_gen[name]
+    value = loader()
+    with _cache_lock:
+        if _cache_gen[name] == gen:
+            if len(_cache) >= CACHE_MAX_ENTRIES:
+                _cache_prune(now)
+            _cache[(name, key)] = (now + CACHE_TTL, value)
+    return value
+
+
+def _cache_prune(now: float):
+    """Под _cache_lock: убрать просроченные записи, а если их мало — самые старые."""
+    for k in [k for k, (expires, _) in _cache.items() if expires <= now]:
+        del _cache[k]
+    extra = len(_cache) - CACHE_MAX_ENTRIES * 9 // 10
+    if extra > 0:
+        for k in list(itertools.islice(_cache, extra)):
+            del _cache[k]
+
+
+def _drop_local(names=None):
+    names = [n for n in (names or CACHE_NAMES) if n in _cache_gen]
+    now = time.monotonic()
+    with _cache_lock:
+        for name in names:
+            _cache_gen[name] += 1
+            _cache_changed_at[name] = now
+        for k in [k for k in _cache if k[0] in names]:
+            del _cache[k]
+
+
+def invalidate(*names):
+    """Сбросить кэш в этом процессе и (в multi-worker режиме) во всех остальных."""
+    _drop_local(names)
+    if not CACHE_BUS:
+        return
+    try:
+        if USE_POSTGRES:
+            pg_execute("SELECT pg_notify(%s, %s)", (CACHE_BUS_CHANNEL, ",".join(names)))
+        else:
+            os.makedirs(CACHE_BUS_DIR, exist_ok=True)
+            for name in names:
+                with open(os.path.join(CACHE_BUS_DIR, name), "w") as f:
+                    f.write(str(time.time_ns()))
+    except Exception as e:
+        # не удалось разослать — другие воркеры догонят по CACHE_TTL
+        print(f"Ошибка рассылки инвалидации кэша: {e}")
+
+
+def _drop_remote(names=None):
+    """Сигнал от другого воркера: сбросить кэши, а очередь в памяти — перечитать из БД."""
+    _drop_local(names)
+    if names is None or "queue" in names:
+        queue_engine.mark_stale()
+
+
+def _pg_listen_loop():
+    import select
+    import psycopg2
+
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(
+                CACHE_BUS_DSN,
+                connect_timeout=10,
+                sslmode=os.getenv("PGSSLMODE", "require"),
+            )
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CACHE_BUS_CHANNEL}")
+            # пока слушателя не было, сообщения могли потеряться
+            _drop_remote()
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _drop_remote(conn.notifies.pop(0).payload.split(","))
+        except Exception as e:
+            print(f"Шина кэша (LISTEN) недоступна: {e}")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+
+def _file_bus_stamp(name: str) -> str:
+    try:
+        with open(os.path.join(CACHE_BUS_DIR, name)) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def _file_bus_loop():
+    seen = {name: _file_bus_stamp(name) for name in CACHE_NAMES}
+    while True:
+        time.sleep(CACHE_BUS_POLL)
+        for name in CACHE_NAMES:
+            stamp = _file_bus_stamp(name)
+            if stamp != seen[name]:
+                seen[name] = stamp
+                _drop_remote([name])
+
+
+def invalidates(*names):
+    """Декоратор для изменяющих endpoints: после вызова сбрасывает указанные кэши."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                invalidate(*names)
+        return wrapper
+    return decorator
+
+
+@app.on_event("startup")
+def start_cache_bus():
+    if CACHE_BUS:
+        target = _pg_listen_loop if USE_POSTGRES else _file_bus_loop
+        threading.Thread(target=target, daemon=True).start()
+        print(f"Кэш: инвалидация между процессами включена ({'LISTEN/NOTIFY' if USE_POSTGRES else CACHE_BUS_DIR})")
+
+
+# ==============================
+# Идемпотентность (Idempotency-Key)
+# ==============================
+# Клиент присылает заголовок Idempotency-Key и при таймауте повторяет запрос
+# с тем же ключом. Первый запрос выполняется и его ответ сохраняется,
+# повторы получают сохранённый ответ (заголовок Idempotent-Replayed: true).
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+_idem_last_cleanup = 0.0
+
+
+def _idem_cleanup():
+    """Удаляет просроченные ключи (не чаще раза в 10 минут)."""
+    global _idem_last_cleanup
+    if time.monotonic() - _idem_last_cleanup < 600:
+        return
+    _idem_last_cleanup = time.monotonic()
+    if USE_POSTGRES:
+        pg_execute(
+            "DELETE FROM public.idempotency_keys WHERE created_at < now() - %s * interval '1 hour'",
+            (IDEMPOTENCY_TTL_HOURS,),
+        )
+        return
+    cutoff = (datetime.now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)).isoformat(timespec="seconds")
+    conn = get_db_sqlite()
+    conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (cutoff,))
+    conn.commit()
+    conn.close()
+
+
+def _idem_begin(key: str, scope: str, fingerprint: str):
+    """Пытается занять ключ. None — ключ наш (выполняем запрос), иначе — сохранённая строка."""
+    _idem_cleanup()
+    if USE_POSTGRES:
+        with pg_transaction() as cur:
+            cur.execute(
+                "DELETE FROM public.idempotency_keys "
+                "WHERE idem_key = %s AND created_at < now() - %s * interval '1 hour'",
+                (key, IDEMPOTENCY_TTL_HOURS),
+            )
+            cur.execute(
+                "INSERT INTO public.idempotency_keys (idem_key, scope, fingerprint) VALUES (%s, %s, %s) "
+                "ON CONFLICT (idem_key) DO NOTHING",
+                (key, scope, fingerprint),
+            )
+            if cur.rowcount == 1:
+                return None
+            cur.execute(
+                "SELECT scope, fingerprint, status_code, response FROM public.idempotency_keys WHERE idem_key = %s",
+                (key,),
+            )
+            row = cur.fetchone()
+            return dict(zip(("scope", "fingerprint", "status_code", "response"), row)) if row else None
+
+    now_iso = datetime.now().isoformat(timespec="seconds")
+    cutoff = (datetime.now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)).isoformat(timespec="seconds")
+    conn = get_db_sqlite()
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM idempotency_keys WHERE idem_key = ? AND created_at < ?", (key, cutoff))
+        cur.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (idem_key, scope, fingerprint, created_at) VALUES (?, ?, ?, ?)",
+            (key, scope, fingerprint, now_iso),
+        )
+        conn.commit()
+        if cur.rowcount == 1:
+            return None
+        row = cur.execute(
+            "SELECT scope, fingerprint, status_code, response FROM idempotency_keys WHERE idem_key = ?",
+            (key,),
+        ).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def _idem_finish(key: str, status_code: int, body):
+    response = json.dumps(body, ensure_ascii=False, default=str)
+    if USE_POSTGRES:
+        pg_execute(
+            "UPDATE public.idempotency_keys SET status_code = %s, response = %s WHERE idem_key = %s",
+            (status_code, response, key),
+        )
+        return
+    conn = get_db_sqlite()
+    conn.execute(
+        "UPDATE idempotency_keys SET status_code = ?, response = ? WHERE idem_key = ?",
+        (status_code, response, key),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _idem_release(key: str):
+    """Ошибка сервера — освобождаем ключ, чтобы повтор выполнился заново."""
+    try:
+        if USE_POSTGRES:
+            pg_execute("DELETE FROM public.idempotency_keys WHERE idem_key = %s", (key,))
+            return
+        conn = get_db_sqlite()
+        conn.execute("DELETE FROM idempotency_keys WHERE idem_key = ?", (key,))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Не удалось освободить Idempotency-Key {key}: {e}")
+
+
+def run_idempotent(key: str | None, scope: str, payload, handler):
+    """Выполняет handler() один раз на Idempotency-Key; повторы получают сохранённый ответ."""
+    if not key:
+        return handler()
+
+    fingerprint = hashlib.sha256(
+        json.dumps({"scope": scope, "payload": payload}, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+
+    stored = _idem_begin(key, scope, fingerprint)
+    if stored is not None:
+        if stored["scope"] != scope or stored["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key уже использован для другого запроса")
+        if stored["response"] is None:
+            raise HTTPException(status_code=409, detail="Запрос с этим Idempotency-Key ещё выполняется")
+        return JSONResponse(
+            status_code=stored["status_code"],
+            content=json.loads(stored["response"]),
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    try:
+        result = handler()
+    except HTTPException as e:
+        # 4xx — это ответ (например «Время занято»), его тоже повторяем
+        if e.status_code < 500:
+            _idem_finish(key, e.status_code, {"detail": e.detail})
+        else:
+            _idem_release(key)
+        raise
+    except Exception:
+        _idem_release(key)
+        raise
+    _idem_finish(key, 200, result)
+    return result
+
+
+# ==============================
+# Outbox уведомлений
+# ==============================
+# Событие (подтверждение записи, перенос) пишется в таблицу outbox в той же
+# транзакции, что и сама запись, — запрос не ждёт внешних провайдеров.
+# Фоновый диспетчер забирает события пачками и отправляет через канал
+# OUTBOX_CHANNEL; при ошибке — повтор с экспоненциальной задержкой,
+# после OUTBOX_MAX_ATTEMPTS событие помечается 'failed'.
+OUTBOX_CHANNEL = os.getenv("OUTBOX_CHANNEL", "off")  # off | webhook | stub (для разработки)
+OUTBOX_STUB_FILE = os.getenv("OUTBOX_STUB_FILE", SQLITE_PATH + ".outbox.jsonl")
+OUTBOX_WEBHOOK_URL = os.getenv("OUTBOX_WEBHOOK_URL", "")
+OUTBOX_POLL = float(os.getenv("OUTBOX_POLL", "2"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "5"))      # секунды, удваивается
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "3600"))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))               # пока событие «взято» одним воркером
+OUTBOX_KEEP_DAYS = float(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+
+_outbox_wakeup = threading.Event()
+
+
+def outbox_add(cur, event_type: str, aggregate_id: int, payload: dict):
+    """Кладёт событие в outbox курсором текущей транзакции (PG или SQLite)."""
+    body = json.dumps(payload, ensure_ascii=False, default=str)
+    if USE_POSTGRES:
+        cur.execute(
+            "INSERT INTO public.outbox (event_type, aggregate_id, payload) VALUES (%s, %s, %s)",
+            (event_type, aggregate_id, body),
+        )
+    else:
+        now_iso = datetime.now().isoformat(timespec="seconds")
+        cur.execute(
+            "INSERT INTO outbox (event_type, aggregate_id, payload, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (event_type, aggregate_id, body, now_iso, now_iso),
+        )
+    # диспетчер в этом процессе не ждёт следующего опроса
+    _outbox_wakeup.set()
+
+
+def _send_stub(event: dict):
+    """Локальный канал для тестов: строка JSON в файл + лог."""
+    line = json.dumps(event, ensure_ascii=False, default=str)
+    with open(OUTBOX_STUB_FILE, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+    print(f"[outbox] {event['event_type']} #{event['aggregate_id']}")
+
+
+def _send_webhook(event: dict):
+    import urllib.request
+
+    req = urllib.request.Request(
+        OUTBOX_WEBHOOK_URL,
+        data=json.dumps(event, ensure_ascii=False, default=str).encode("utf-8"),
+        headers={"Content-Type": "application/json", "Idempotency-Key": f"outbox-{event['id']}"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        if resp.status >= 300:
+            raise RuntimeError(f"HTTP {resp.status}")
+
+
+OUTBOX_CHANNELS = {
+    "stub": _send_stub,
+    "webhook": _send_webhook,
+}
+
+
+def _outbox_claim(limit: int) -> list:
+    """Берёт пачку готовых событий и продлевает им next_attempt_at на OUTBOX_LEASE,
+    чтобы другой воркер не отправил их параллельно."""
+    if USE_POSTGRES:
+        with pg_transaction() as cur:
+            cur.execute(
+                """UPDATE public.outbox
+                   SET next_attempt_at = NOW() + %s * interval '1 second', attempts = attempts + 1
+                   WHERE id IN (
+                       SELECT id FROM public.outbox
+                       WHERE status = 'pending' AND next_attempt_at <= NOW()
+                       ORDER BY id LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING id, event_type, aggregate_id, payload, attempts""",
+                (OUTBOX_LEASE, limit),
+            )
+            rows = _fetch_all_dicts(cur)
+    else:
+        conn = get_db_sqlite()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = [dict(r) for r in conn.execute(
+                "SELECT id, event_type, aggregate_id, payload, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (datetime.now().isoformat(timespec="seconds"), limit),
+            ).fetchall()]
+            conn.executemany(
+                "UPDATE outbox SET next_attempt_at = ?, attempts = attempts + 1 WHERE id = ?",
+                [((datetime.now() + timedelta(seconds=OUTBOX_LEASE)).isoformat(timespec="seconds"), r["id"])
+                 for r in rows],
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        for r in rows:
+            r["attempts"] += 1
+
+    for r in rows:
+        r["payload"] = json.loads(r["payload"]) if isinstance(r["payload"], str) else r["payload"]
+    return sorted(rows, key=lambda r: r["id"])
+
+
+def _outbox_retry_delay(attempts: int) -> float:
+    return min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+
+
+def _outbox_finish(sent_ids: list, failures: list):
+    """sent_ids — отправлены; failures — [(id, attempts, error)]: повтор позже или 'failed'."""
+    retry_rows = []
+    for event_id, attempts, error in failures:
+        status = "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+        retry_rows.append((status, _outbox_retry_delay(attempts), error[:500], event_id))
+
+    if USE_POSTGRES:
+        with pg_transaction() as cur:
+            if sent_ids:
+                cur.execute(
+                    "UPDATE public.outbox SET status = 'sent', sent_at = NOW(), last_error = NULL "
+                    "WHERE id = ANY(%s)",
+                    (sent_ids,),
+                )
+            if retry_rows:
+                cur.executemany(
+                    "UPDATE public.outbox SET status = %s, next_attempt_at = NOW() + %s * interval '1 second', "
+                    "last_error = %s WHERE id = %s",
+                    retry_rows,
+                )
+        return
+
+    now = datetime.now()
+    conn = get_db_sqlite()
+    try:
+        now_iso = now.isoformat(timespec="seconds")
+        conn.executemany(
+            "UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+            [(now_iso, event_id) for event_id in sent_ids],
+        )
+        conn.executemany(
+            "UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            [(s, (now + timedelta(seconds=d)).isoformat(timespec="seconds"), e, i) for s, d, e, i in retry_rows],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def dispatch_outbox(limit: int = None) -> dict:
+    """Одна пачка: забрать → отправить → отметить. Возвращает счётчики."""
+    send = OUTBOX_CHANNELS.get(OUTBOX_CHANNEL)
+    if send is None:
+        return {"sent": 0, "failed": 0}
+
+    events = _outbox_claim(limit or OUTBOX_BATCH_SIZE)
+    sent_ids, failures = [], []
+    for event in events:
+        try:
+            send(event)
+            sent_ids.append(event["id"])
+        except Exception as e:
+            failures.append((event["id"], event["attempts"], f"{type(e).__name__}: {e}"))
+
+    if events:
+        _outbox_finish(sent_ids, failures)
+    return {"sent": len(sent_ids), "failed": len(failures)}
+
+
+def _outbox_cleanup():
+    if USE_POSTGRES:
+        pg_execute(
+            "DELETE FROM public.outbox WHERE status = 'sent' AND sent_at < NOW() - %s * interval '1 day'",
+            (OUTBOX_KEEP_DAYS,),
+        )
+        return
+    cutoff = datetime.now() - timedelta(days=OUTBOX_KEEP_DAYS)
+    conn = get_db_sqlite()
+    conn.execute(
+        "DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?",
+        (cutoff.isoformat(timespec="seconds"),),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _outbox_loop():
+    last_cleanup = 0.0
+    while True:
+        try:
+            # полная пачка — скорее всего есть ещё, забираем сразу
+            while sum(dispatch_outbox().values()) >= OUTBOX_BATCH_SIZE:
+                pass
+            if time.monotonic() - last_cleanup > 3600:
+                _outbox_cleanup()
+                last_cleanup = time.monotonic()
+        except Exception as e:
+            print(f"Ошибка отправки outbox: {e}")
+        _outbox_wakeup.wait(OUTBOX_POLL)
+        _outbox_wakeup.clear()
+
+
+@app.on_event("startup")
+def start_outbox_dispatcher():
+    if OUTBOX_CHANNEL in OUTBOX_CHANNELS:
+        threading.Thread(target=_outbox_loop, daemon=True).start()
+
+
+# ==============================
+# Admission control + rate limiting
+# ==============================
+# Классы маршрутов: booking (POST записи/очереди), slots (свободные слоты),
+# read (прочие GET), write (прочие изменения). Для каждого класса:
+#   - не больше N одновременных запросов (остальные ждут ADMISSION_WAIT_MS, потом 503);
+#   - token bucket на IP клиента (rate запросов/сек, burst), сверх — 429.
+# Общий лимит ADMISSION_TOTAL не даёт исчерпать маленький пул соединений PostgreSQL.
+def _parse_limits(raw: str) -> dict:
+    """'booking=3,slots=0.5/10' -> {'booking': '3', 'slots': '0.5/10'}"""
+    out = {}
+    for part in raw.split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            out[name.strip()] = value.strip()
+    return out
+
+
+def _parse_rate(value: str) -> tuple:
+    rate, _, burst = value.partition("/")
+    return float(rate), float(burst or rate)
+
+
+ROUTE_CLASSES = ("booking", "slots", "read", "write")
+ADMISSION_LIMITS = {
+    name: int(v)
+    for name, v in _parse_limits(os.getenv("ADMISSION_LIMITS", "booking=3,slots=3,read=4,write=3")).items()
+}
+ADMISSION_TOTAL = int(os.getenv("ADMISSION_TOTAL", "5"))
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT_MS", "200")) / 1000
+RATE_LIMITS = {
+    name: _parse_rate(v)
+    for name, v in _parse_limits(
+        os.getenv("RATE_LIMITS", "booking=0.5/10,slots=2/30,read=5/60,write=2/30")
+    ).items()
+}
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory | db
+# X-Forwarded-For читаем только за своим прокси: иначе клиент подставит любой IP и обойдёт лимиты
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "0") == "1"
+TRUSTED_PROXY_COUNT = max(1, int(os.getenv("TRUSTED_PROXY_COUNT", "1")))
+
+
+def route_class(method: str, path: str):
+    if not path.startswith("/api/") or path == "/api/health" or method == "OPTIONS":
+        return None
+    if method == "POST" and path in ("/api/appointments", "/api/queue"):
+        return "booking"
+    if path.startswith("/api/available-slots"):
+        return "slots"
+    if method in ("GET", "HEAD"):
+        return "read"
+    return "write"
+
+
+class MemoryTokenBuckets:
+    """Token bucket'ы в памяти процесса (по умолчанию)."""
+
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """0 — запрос пропущен, иначе через сколько секунд можно повторить."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - ts) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_KEYS:
+                # выкидываем давно неактивные (уже полные) bucket'ы
+                idle = 3600
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < idle}
+            return (1 - tokens) / rate
+
+
+class DbTokenBuckets:
+    """Token bucket'ы в таблице rate_limits — общие для всех воркеров/инстансов."""
+
+    def __init__(self):
+        self._last_cleanup = 0.0
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        now = time.time()
+        self._cleanup(now)
+        if USE_POSTGRES:
+            with pg_transaction() as cur:
+                cur.execute(
+                    """INSERT INTO public.rate_limits AS r (bucket, tokens, updated_at) VALUES (%s, %s, %s)
+                       ON CONFLICT (bucket) DO UPDATE
+                       SET tokens = LEAST(%s, r.tokens + (EXCLUDED.updated_at - r.updated_at) * %s),
+                           updated_at = EXCLUDED.updated_at
+                       RETURNING tokens""",
+                    (key, burst, now, burst, rate),
+                )
+                tokens = cur.fetchone()[0]
+                if tokens >= 1:
+                    cur.execute("UPDATE public.rate_limits SET tokens = tokens - 1 WHERE bucket = %s", (key,))
+                    return 0.0
+                return (1 - tokens) / rate
+
+        conn = get_db_sqlite()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """INSERT INTO rate_limits (bucket, tokens, updated_at) VALUES (?, ?, ?)
+                   ON CONFLICT (bucket) DO UPDATE
+                   SET tokens = MIN(?, tokens + (excluded.updated_at - updated_at) * ?),
+                       updated_at = excluded.updated_at""",
+                (key, burst, now, burst, rate),
+            )
+            tokens = cur.execute("SELECT tokens FROM rate_limits WHERE bucket = ?", (key,)).fetchone()[0]
+            if tokens >= 1:
+                cur.execute("UPDATE rate_limits SET tokens = tokens - 1 WHERE bucket = ?", (key,))
+            conn.commit()
+            return 0.0 if tokens >= 1 else (1 - tokens) / rate
+        finally:
+            conn.close()
+
+    def _cleanup(self, now: float):
+        if now - self._last_cleanup < 600:
+            return
+        self._last_cleanup = now
+        try:
+            if USE_POSTGRES:
+                pg_execute("DELETE FROM public.rate_limits WHERE updated_at < %s", (now - 3600,))
+            else:
+                conn = get_db_sqlite()
+                conn.execute("DELETE FROM rate_limits WHERE updated_at < ?", (now - 3600,))
+                conn.commit()
+                conn.close()
+        except Exception as e:
+            print(f"Ошибка очистки rate_limits: {e}")
+
+
+_rate_limiter = DbTokenBuckets() if RATE_LIMIT_BACKEND == "db" else MemoryTokenBuckets()
+_admission_sems = {name: asyncio.Semaphore(ADMISSION_LIMITS.get(name, ADMISSION_TOTAL)) for name in ROUTE_CLASSES}
+_admission_total = asyncio.Semaphore(ADMISSION_TOTAL)
+
+
+def client_ip(request) -> str:
+    if TRUST_FORWARDED_FOR:
+        # каждый прокси дописывает адрес справа; левее — то, что прислал сам клиент
+        hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_COUNT:
+            return hops[-TRUSTED_PROXY_COUNT]
+    return request.client.host if request.client else "unknown"
+
+
+async def _try_acquire(sem: asyncio.Semaphore) -> bool:
+    if not sem.locked():
+        await sem.acquire()
+        return True
+    if ADMISSION_WAIT <= 0:
+        return False
+    try:
+        await asyncio.wait_for(sem.acquire(), timeout=ADMISSION_WAIT)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def _shed(status_code: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": detail},
+        headers={
+            "Retry-After": str(max(1, math.ceil(retry_after))),
+            # ответ уходит мимо CORSMiddleware — браузер должен увидеть 429/503, а не ошибку CORS
+            "Access-Control-Allow-Origin": "*",
+        },
+    )
+
+
+@app.middleware("http")
+async def admission_control(request, call_next):
+    cls = route_class(request.method, request.url.path)
+    if cls is None:
+        return await call_next(request)
+
+    rate, burst = RATE_LIMITS.get(cls, (0, 0))
+    if rate > 0:
+        key = f"{cls}:{client_ip(request)}"
+        try:
+            if RATE_LIMIT_BACKEND == "db":
+                wait = await run_in_threadpool(_rate_limiter.take, key, rate, burst)
+            else:
+                wait = _rate_limiter.take(key, rate, burst)
+        except Exception as e:
+            # общий backend недоступен — не блокируем клиентов
+            print(f"Rate limiter недоступен: {e}")
+            wait = 0
+        if wait > 0:
+            return _shed(429, "Слишком много запросов, повторите позже", wait)
+
+    sem = _admission_sems[cls]
+    if not await _try_acquire(sem):
+        return _shed(503, "Сервер перегружен, повторите позже", 1)
+    if not await _try_acquire(_admission_total):
+        sem.release()
+        return _shed(503, "Сервер перегружен, повторите позже", 1)
+    try:
+        with trace_span("handler", **{"admission.class": cls}):
+            return await call_next(request)
+    finally:
+        _admission_total.release()
+        sem.release()
+
+
+# ==============================
+# Маршрутизация чтения на реплики
+# ==============================
+# Чтения (врачи, очередь, записи на день, статистика, поиск) идут на реплики.
+# Read-your-writes: после успешного изменения клиент REPLICA_STICKY_SECONDS
+# читает с основной БД (по IP в этом процессе и по cookie rw_until — для
+# остальных воркеров). Кэши после инвалидации тоже перечитываются с основной
+# БД, иначе в кэш мог бы попасть снимок отстающей реплики.
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+_prefer_primary = contextvars.ContextVar("prefer_primary", default=False)
+_recent_writers = {}
+
+
+def replica_ok(cache_name: str = None) -> bool:
+    """Можно ли текущему запросу читать с реплики."""
+    if not DATABASE_REPLICA_URLS or _prefer_primary.get():
+        return False
+    if cache_name and time.monotonic() - _cache_changed_at.get(cache_name, 0.0) < REPLICA_STICKY_SECONDS:
+        return False
+    return True
+
+
+@app.middleware("http")
+async def replica_stickiness(request, call_next):
+    if not DATABASE_REPLICA_URLS or not request.url.path.startswith("/api/"):
+        return await call_next(request)
+
+    ip = client_ip(request)
+    now = time.time()
+    if request.method in ("GET", "HEAD"):
+        try:
+            cookie_until = float(request.cookies.get("rw_until") or 0)
+        except ValueError:
+            cookie_until = 0
+        token = _prefer_primary.set(max(_recent_writers.get(ip, 0), cookie_until) > now)
+        try:
+            return await call_next(request)
+        finally:
+            _prefer_primary.reset(token)
+
+    response = await call_next(request)
+    if request.method != "OPTIONS" and response.status_code < 400:
+        until = now + REPLICA_STICKY_SECONDS
+        if len(_recent_writers) > 10000:
+            _recent_writers.clear()
+        _recent_writers[ip] = until
+        response.set_cookie("rw_until", str(until), max_age=int(REPLICA_STICKY_SECONDS) + 1, samesite="lax")
+    return response
+
+
+# Span всего HTTP-запроса. Объявлен последним, поэтому это внешний middleware:
+# в его время входит и ожидание в admission control.
+@app.middleware("http")
+async def trace_requests(request, call_next):
+    if not TRACE_ENABLED or not request.url.path.startswith("/api/"):
+        return await call_next(request)
+
+    parent = parse_traceparent(request.headers.get("traceparent"))
+    name = f"{request.method} {request.url.path}"
+    with trace_span(name, kind="SERVER", parent=parent,
+                    **{"http.method": request.method, "http.path": request.url.path}) as span:
+        response = await call_next(request)
+        span.tags["http.status_code"] = response.status_code
+        response.headers["traceparent"] = f"00-{span.trace_id}-{span.span_id}-01"
+        return response
+
+
+# ==============================
+# Расписание врачей
+# ==============================
+# Недельный шаблон (doctor_schedules) + исключения на конкретные даты
+# (schedule_exceptions: 'выходной' на весь день или 'перерыв' с/по).
+# Шаблон один раз разворачивается в сетку слотов на день (DayPlan) и кэшируется
+# ("schedules"); любое изменение расписания сбрасывает кэш во всех воркерах.
+# Врач без шаблона работает как раньше: каждый день, слоты 08:00–18:00 по 30 минут.
+DEFAULT_DAY_START = os.getenv("DEFAULT_DAY_START", "08:00")
+DEFAULT_DAY_END = os.getenv("DEFAULT_DAY_END", "18:30")  # конец приёма: последний слот начинается в 18:00
+DEFAULT_SLOT_MINUTES = int(os.getenv("DEFAULT_SLOT_MINUTES", "30"))
+EXCEPTION_KINDS = ("выходной", "перерыв")
+
+
+def _minutes(value):
+    """'HH:MM' / time -> минуты от полуночи (None, если пусто)."""
+    if value is None or value == "":
+        return None
+    if hasattr(value, "hour"):
+        return value.hour * 60 + value.minute
+    h, m = str(value).strip()[:5].split(":")
+    return int(h) * 60 + int(m)
+
+
+def _hhmm(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def _time_str(value) -> str:
+    return value.strftime("%H:%M") if hasattr(value, "strftime") else str(value).strip()[:5]
+
+
+class DayPlan:
+    """Расписание врача на конкретную дату, уже развёрнутое в слоты."""
+
+    __slots__ = ("slots", "slot_set", "breaks", "day_off")
+
+    def __init__(self, slots=(), breaks=(), day_off=False):
+        self.slots = tuple(slots)           # ('08:00', '08:30', ...) по порядку
+        self.slot_set = frozenset(slots)    # для проверки «время в расписании»
+        self.breaks = tuple(breaks)         # ((780, 840), ...) в минутах
+        self.day_off = day_off
+
+
+def _expand_grid(start: int, end: int, slot: int, breaks) -> list:
+    out = []
+    t = start
+    while t + slot <= end:
+        if not any(t < b_end and t + slot > b_start for b_start, b_end in breaks):
+            out.append(_hhmm(t))
+        t += slot
+    return out
+
+
+DEFAULT_TEMPLATE = (_minutes(DEFAULT_DAY_START), _minutes(DEFAULT_DAY_END), DEFAULT_SLOT_MINUTES, ())
+
+
+def _load_schedule_templates() -> dict:
+    """{doctor_id: {weekday: (start, end, slot, breaks)}} — всё в минутах."""
+    if USE_POSTGRES:
+        rows = pg_query_all("SELECT * FROM public.doctor_schedules", readonly=replica_ok("schedules"))
+    else:
+        conn = get_db_sqlite()
+        rows = [dict(r) for r in conn.execute("SELECT * FROM doctor_schedules").fetchall()]
+        conn.close()
+
+    templates = {}
+    for r in rows:
+        b_start, b_end = _minutes(r["break_start"]), _minutes(r["break_end"])
+        breaks = ((b_start, b_end),) if b_start is not None and b_end is not None else ()
+        templates.setdefault(int(r["doctor_id"]), {})[int(r["weekday"])] = (
+            _minutes(r["start_time"]),
+            _minutes(r["end_time"]),
+            int(r["slot_minutes"] or DEFAULT_SLOT_MINUTES),
+            breaks,
+        )
+    return templates
+
+
+def _load_schedule_exceptions(date: str) -> dict:
+    """{doctor_id: [(kind, start, end), ...]} на одну дату."""
+    if USE_POSTGRES:
+        rows = pg_query_all(
+            "SELECT doctor_id, kind, start_time, end_time FROM public.schedule_exceptions WHERE exception_date = %s",
+            (date,),
+            readonly=replica_ok("schedules"),
+        )
+    else:
+        conn = get_db_sqlite()
+        rows = conn.execute(
+            "SELECT doctor_id, kind, start_time, end_time FROM schedule_exceptions WHERE exception_date = ?",
+            (date,),
+        ).fetchall()
+        conn.close()
+
+    result = {}
+    for r in rows:
+        result.setdefault(int(r["doctor_id"]), []).append(
+            (r["kind"], _minutes(r["start_time"]), _minutes(r["end_time"]))
+        )
+    return result
+
+
+def _build_day_plan(doctor_id: int, date: str) -> DayPlan:
+    try:
+        weekday = datetime.strptime(date, "%Y-%m-%d").weekday()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный формат даты")
+
+    templates = cache_get("schedules", None, _load_schedule_templates)
+    exceptions = cache_get("schedules", ("exceptions", date), lambda: _load_schedule_exceptions(date))
+    exceptions = exceptions.get(doctor_id, [])
+
+    template = templates[doctor_id].get(weekday) if doctor_id in templates else DEFAULT_TEMPLATE
+    if template is None or any(kind == "выходной" for kind, _, _ in exceptions):
+        return DayPlan(day_off=True)
+
+    start, end, slot, breaks = template
+    breaks = list(breaks) + [
+        (b_start, b_end) for kind, b_start, b_end in exceptions
+        if kind == "перерыв" and b_start is not None and b_end is not None
+    ]
+    return DayPlan(_expand_grid(start, end, slot, breaks), breaks)
+
+
+def day_plan(doctor_id: int, date: str) -> DayPlan:
+    return cache_get("schedules", ("day", doctor_id, date), lambda: _build_day_plan(doctor_id, date))
+
+
+def _union_grid(date: str) -> tuple:
+    """Сетка «любой врач»: объединение слотов всех активных врачей."""
+    times = set()
+    for doctor in cache_get("doctors", None, _load_doctors):
+        times.update(day_plan(int(doctor["id"]), date).slot_set)
+    return tuple(sorted(times))
+
+
+def schedule_status(doctor_id: int, now: datetime = None):
+    """'выходной' / 'перерыв' по расписанию на текущий момент, иначе None."""
+    now = now or datetime.now()
+    plan = day_plan(doctor_id, now.strftime("%Y-%m-%d"))
+    if plan.day_off:
+        return "выходной"
+    minute = now.hour * 60 + now.minute
+    if any(b_start <= minute < b_end for b_start, b_end in plan.breaks):
+        return "перерыв"
+    return None
+
+
+def ensure_in_schedule(doctor_id, date, time_value):
+    """400, если врач не принимает в это время (выходной, перерыв, вне сетки)."""
+    plan = day_plan(int(doctor_id), normalize_date_str(str(date)[:10]))
+    if plan.day_off:
+        raise HTTPException(status_code=400, detail="У врача выходной")
+    if _time_str(time_value) not in plan.slot_set:
+        raise HTTPException(status_code=400, detail="Врач не принимает в это время")
+
+
+def _parse_template_row(row: dict) -> tuple:
+    """Проверка строки недельного шаблона из запроса."""
+    try:
+        weekday = int(row["weekday"])
+        start, end = _minutes(row["start_time"]), _minutes(row["end_time"])
+        b_start, b_end = _minutes(row.get("break_start")), _minutes(row.get("break_end"))
+        slot = int(row.get("slot_minutes") or DEFAULT_SLOT_MINUTES)
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Неверная строка расписания")
+
+    if not 0 <= weekday <= 6:
+        raise HTTPException(status_code=400, detail="weekday: 0 (пн) … 6 (вс)")
+    if start is None or end is None or start >= end:
+        raise HTTPException(status_code=400, detail="start_time должно быть раньше end_time")
+    if not 5 <= slot <= 240:
+        raise HTTPException(status_code=400, detail="slot_minutes: от 5 до 240")
+    if (b_start is None) != (b_end is None) or (b_start is not None and not start <= b_start < b_end <= end):
+        raise HTTPException(status_code=400, detail="Перерыв должен быть внутри рабочего времени")
+
+    return (
+        weekday,
+        _hhmm(start),
+        _hhmm(end),
+        _hhmm(b_start) if b_start is not None else None,
+        _hhmm(b_end) if b_end is not None else None,
+        slot,
+    )
+
+
+# ==============================
+# Очередь в памяти (write-through)
+# ==============================
+# Активная очередь живёт в процессе: по каждому врачу три deque — ожидание,
+# вызваны ('готов'), на приёме ('в_работе'). При старте движок собирается из БД,
+# каждое изменение сначала пишется в БД (она — надёжный журнал), затем
+# применяется в памяти. GET /api/queue отдаёт готовый снимок, «следующий
+# пациент» — голова deque ожидания.
+# При WEB_CONCURRENCY > 1 сигнал "queue" по шине кэша помечает движок
+# устаревшим, и он перечитывается из БД при следующем обращении.
+QUEUE_CLOSED_STATUSES = ("завершён", "не_пришёл")
+QUEUE_ACTIVE_STATUSES = ("ожидание", "готов", "в_работе")
+
+
+def _queue_order_key(entry: dict):
+    # как раньше в SQL: ORDER BY called_at NULLS LAST, id
+    called_at = entry.get("called_at")
+    return (called_at is None, called_at or "", entry["id"])
+
+
+class QueueEngine:
+    def __init__(self):
+        self._entries = {}        # queue_id -> строка очереди (как в GET /api/queue)
+        self._doctors = {}        # doctor_id -> {status: deque(queue_id)}
+        self._by_appointment = {}  # appointment_id -> set(queue_id)
+        self._snapshot = []
+        self._stale = True
+        self._lock = threading.RLock()
+        self.version = 0  # растёт при каждом изменении снимка (табло сравнивает его)
+
+    # --- загрузка ---
+    def _ensure_loaded(self):
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._rebuild(_load_queue())
+
+    def _rebuild(self, rows: list):
+        self._entries = {}
+        self._doctors = {}
+        self._by_appointment = {}
+        for row in sorted(rows, key=_queue_order_key):
+            self._insert(row)
+        self._stale = False
+        self._publish()
+
+    def mark_stale(self):
+        self._stale = True
+
+    def load(self):
+        with self._lock:
+            self._rebuild(_load_queue())
+
+    # --- внутренние операции (под self._lock) ---
+    def _lanes(self, doctor_id):
+        lanes = self._doctors.get(doctor_id)
+        if lanes is None:
+            lanes = self._doctors[doctor_id] = {status: deque() for status in QUEUE_ACTIVE_STATUSES}
+        return lanes
+
+    def _insert(self, row: dict):
+        self._entries[row["id"]] = row
+        lane = self._lanes(row["doctor_id"]).get(row.get("status"))
+        if lane is not None:
+            lane.append(row["id"])
+        if row.get("appointment_id") is not None:
+            self._by_appointment.setdefault(row["appointment_id"], set()).add(row["id"])
+
+    def _remove(self, queue_id):
+        row = self._entries.pop(queue_id, None)
+        if row is None:
+            return None
+        lane = self._lanes(row["doctor_id"]).get(row.get("status"))
+        if lane is not None:
+            try:
+                lane.remove(queue_id)
+            except ValueError:
+                pass
+        ids = self._by_appointment.get(row.get("appointment_id"))
+        if ids:
+            ids.discard(queue_id)
+            if not ids:
+                del self._by_appointment[row["appointment_id"]]
+        return row
+
+    def _publish(self):
+        # снимок собирается один раз на изменение; чтения просто отдают ссылку
+        self._snapshot = sorted(self._entries.values(), key=_queue_order_key)
+        self.version += 1
+
+    # --- чтение ---
+    def snapshot(self) -> list:
+        self._ensure_loaded()
+        return self._snapshot
+
+    def next_waiting(self, doctor_id: int):
+        """Первый ожидающий у врача или None."""
+        self._ensure_loaded()
+        lane = self._doctors.get(doctor_id, {}).get("ожидание")
+        return self._entries.get(lane[0]) if lane else None
+
+    def active_count(self, doctor_id: int) -> int:
+        self._ensure_loaded()
+        lanes = self._doctors.get(doctor_id)
+        return sum(len(lane) for lane in lanes.values()) if lanes else 0
+
+    def get(self, queue_id: int):
+        self._ensure_loaded()
+        return self._entries.get(queue_id)
+
+    # --- изменения: вызывать ПОСЛЕ успешной записи в БД ---
+    @contextmanager
+    def writing(self):
+        """Запись в БД + применение в памяти под одной блокировкой:
+        порядок изменений в памяти совпадает с порядком в БД.
+        Если применить не удалось — движок перечитается из БД."""
+        with self._lock:
+            self._ensure_loaded()
+            try:
+                yield self
+            except HTTPException:
+                raise  # проверка не прошла — ни БД, ни память не менялись
+            except Exception:
+                self._stale = True
+                raise
+            self._publish()
+
+    def add_rows(self, rows: list):
+        for row in rows:
+            self._remove(row["id"])
+            if row.get("status") not in QUEUE_CLOSED_STATUSES:
+                self._insert(row)
+
+    def set_status(self, queue_id: int, status: str, called_at=None):
+        row = self._remove(queue_id)
+        if row is None or status in QUEUE_CLOSED_STATUSES:
+            return
+        row = {**row, "status": status}
+        if row.get("called_at") is None and called_at is not None:
+            row["called_at"] = called_at
+        self._insert(row)
+
+    def remove_appointment(self, appointment_id: int):
+        for queue_id in list(self._by_appointment.get(appointment_id, ())):
+            self._remove(queue_id)
+
+    def has_appointment(self, appointment_id: int) -> bool:
+        return bool(self._by_appointment.get(appointment_id))
+
+
+queue_engine = QueueEngine()
+
+
+@app.on_event("startup")
+def start_queue_engine():
+    try:
+        queue_engine.load()
+        service_times.ensure_loaded()
+    except Exception as e:
+        # БД недоступна при старте — соберём очередь при первом запросе
+        print(f"Очередь не загружена при старте: {e}")
+
+
+# ==============================
+# Оценка времени ожидания
+# ==============================
+# Длительность приёма = finished_at - called_at, копится по (врач, услуга) и
+# по врачу в целом: EWMA для оценки и скользящее окно последних WAIT_WINDOW
+# приёмов (отсортированное, bisect) для перцентилей. Каждое завершение —
+# O(log n), историю при этом не перечитываем; при старте берём последние
+# WAIT_BOOTSTRAP_ROWS завершённых приёмов одним запросом.
+# Статистика своя в каждом воркере — при WEB_CONCURRENCY > 1 оценки могут
+# немного отличаться до перезапуска.
+WAIT_DEFAULT_MINUTES = float(os.getenv("WAIT_DEFAULT_MINUTES", "30"))
+WAIT_EWMA_ALPHA = float(os.getenv("WAIT_EWMA_ALPHA", "0.2"))
+WAIT_WINDOW = int(os.getenv("WAIT_WINDOW", "50"))
+WAIT_MIN_SAMPLES = int(os.getenv("WAIT_MIN_SAMPLES", "3"))
+WAIT_MAX_SAMPLE_MINUTES = float(os.getenv("WAIT_MAX_SAMPLE_MINUTES", "240"))  # забытые «в работе» не считаем
+WAIT_BOOTSTRAP_ROWS = int(os.getenv("WAIT_BOOTSTRAP_ROWS", "2000"))
+WAIT_REFRESH_SECONDS = 5  # как часто пересчитывать оценки для GET /api/queue
+
+
+def _minutes_since(value) -> float:
+    """Минут прошло с called_at (строка ISO из SQLite или datetime из PG)."""
+    if value is None:
+        return 0.0
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return 0.0
+    now = datetime.now(value.tzinfo) if value.tzinfo else datetime.now()
+    return max(0.0, (now - value).total_seconds() / 60)
+
+
+class ServiceTimeStat:
+    __slots__ = ("count", "ewma", "window", "ordered")
+
+    def __init__(self):
+        self.count = 0
+        self.ewma = 0.0
+        self.window = deque(maxlen=WAIT_WINDOW)  # в порядке поступления
+        self.ordered = []                        # те же значения, отсортированы
+
+    def add(self, minutes: float):
+        self.count += 1
+        self.ewma = minutes if self.count == 1 else self.ewma + WAIT_EWMA_ALPHA * (minutes - self.ewma)
+        if len(self.window) == self.window.maxlen:
+            del self.ordered[bisect.bisect_left(self.ordered, self.window[0])]
+        self.window.append(minutes)
+        bisect.insort(self.ordered, minutes)
+
+    def percentile(self, p: float) -> float:
+        idx = min(len(self.ordered) - 1, int(round(p / 100 * (len(self.ordered) - 1))))
+        return self.ordered[idx]
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "ewma_min": round(self.ewma, 1),
+            "p50_min": round(self.percentile(50), 1),
+            "p90_min": round(self.percentile(90), 1),
+        }
+
+
+class ServiceTimes:
+    def __init__(self):
+        self._stats = {}  # (doctor_id, service_name) и (doctor_id, None) -> ServiceTimeStat
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.version = 0
+
+    def record(self, doctor_id: int, service_name, minutes: float):
+        if not (0 < minutes <= WAIT_MAX_SAMPLE_MINUTES):
+            return
+        with self._lock:
+            for key in ((doctor_id, service_name or None), (doctor_id, None)):
+                stat = self._stats.get(key)
+                if stat is None:
+                    stat = self._stats[key] = ServiceTimeStat()
+                stat.add(minutes)
+                if key[1] is None:
+                    break
+            self.version += 1
+
+    def _usable(self, key):
+        stat = self._stats.get(key)
+        return stat if stat is not None and stat.count >= WAIT_MIN_SAMPLES else None
+
+    def estimate(self, doctor_id: int, service_name=None, duration_hours=None) -> tuple:
+        """(ожидаемая длительность, p90) в минутах: врач+услуга → врач → длительность записи → по умолчанию."""
+        self.ensure_loaded()
+        stat = self._usable((doctor_id, service_name or None)) or self._usable((doctor_id, None))
+        if stat is not None:
+            return stat.ewma, stat.percentile(90)
+        planned = float(duration_hours) * 60 if duration_hours else WAIT_DEFAULT_MINUTES
+        return planned, planned
+
+    def summary(self) -> list:
+        self.ensure_loaded()
+        with self._lock:
+            return [
+                {"doctor_id": doctor_id, "service_name": service_name, **stat.as_dict()}
+                for (doctor_id, service_name), stat in sorted(
+                    self._stats.items(), key=lambda kv: (kv[0][0], kv[0][1] or ""))
+            ]
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            rows = _load_service_time_history(WAIT_BOOTSTRAP_ROWS)
+        except Exception as e:
+            print(f"История длительности приёмов не загружена: {e}")
+            return
+        for row in reversed(rows):  # от старых к новым — EWMA в правильном порядке
+            self.record(row["doctor_id"], row["service_name"], float(row["minutes"] or 0))
+
+
+def _load_service_time_history(limit: int) -> list:
+    if USE_POSTGRES:
+        return pg_query_all(
+            """SELECT q.doctor_id, a.service_name,
+                      EXTRACT(EPOCH FROM (q.finished_at - q.called_at)) / 60 AS minutes
+               FROM public.queue q
+               LEFT JOIN public.appointments a ON a.id = q.appointment_id
+               WHERE q.status = 'завершён' AND q.called_at IS NOT NULL AND q.finished_at IS NOT NULL
+               ORDER BY q.finished_at DESC
+               LIMIT %s""",
+            (limit,),
+            readonly=replica_ok(),
+        )
+    conn = get_db_sqlite()
+    rows = conn.execute(
+        """SELECT q.doctor_id, a.service_name,
+                  (julianday(q.finished_at) - julianday(q.called_at)) * 1440 AS minutes
+           FROM queue q
+           LEFT JOIN appointments a ON a.id = q.appointment_id
+           WHERE q.status = 'завершён' AND q.called_at IS NOT NULL AND q.finished_at IS NOT NULL
+           ORDER BY q.finished_at DESC
+           LIMIT ?""",
+        (limit,),
+    ).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+service_times = ServiceTimes()
+_wait_memo = {"snapshot": None, "key": None, "rows": None}
+
+
+def queue_with_estimates(snapshot: list) -> list:
+    """Снимок очереди + estimated_wait_min / estimated_wait_p90_min для каждой строки.
+    Один проход по активной очереди без запросов к БД; результат живёт WAIT_REFRESH_SECONDS
+    или до изменения очереди/статистики."""
+    key = (service_times.version, int(time.monotonic() // WAIT_REFRESH_SECONDS))
+    memo = _wait_memo
+    if memo["snapshot"] is snapshot and memo["key"] == key:
+        return memo["rows"]
+
+    ahead = {}  # doctor_id -> (минут до освобождения по EWMA, по p90)
+    rows = []
+    for entry in snapshot:  # порядок снимка: сначала вызванные, затем ожидающие по id
+        doctor_id = entry["doctor_id"]
+        mean, p90 = service_times.estimate(doctor_id, entry.get("service_name"), entry.get("duration_hours"))
+        wait, wait_p90 = ahead.get(doctor_id, (0.0, 0.0))
+        if entry.get("status") == "в_работе":
+            elapsed = _minutes_since(entry.get("called_at"))
+            mean, p90 = max(0.0, mean - elapsed), max(0.0, p90 - elapsed)
+            wait, wait_p90 = 0.0, 0.0
+        elif entry.get("status") == "готов":
+            wait, wait_p90 = 0.0, 0.0
+        prev = ahead.get(doctor_id, (0.0, 0.0))
+        ahead[doctor_id] = (prev[0] + mean, prev[1] + p90)
+        rows.append({**entry, "estimated_wait_min": round(wait), "estimated_wait_p90_min": round(wait_p90)})
+
+    memo["snapshot"], memo["key"], memo["rows"] = snapshot, key, rows
+    return rows
+
+
 # ==============================
 # API endpoints
 # ==============================
@@ -367,9 +2425,24 @@ def pg_execute(sql: str, params: tuple = (), returning_id: bool = False):
 @app.get("/api/doctors")
 def get_doctors():
     """Возвращает список всех врачей"""
+    doctors = cache_get("doctors", None, _load_doctors)
+
+    # выходной/перерыв берутся из расписания; пациента у врача ('занят') не прерываем
+    now = datetime.now()
+    result = []
+    for doctor in doctors:
+        auto = schedule_status(int(doctor["id"]), now)
+        if auto and doctor.get("status") != "занят":
+            doctor = {**doctor, "status": auto}
+        result.append(doctor)
+    return result
+
+
+def _load_doctors():
     if USE_POSTGRES:
         doctors = pg_query_all(
-            "SELECT * FROM public.doctors WHERE is_active = 1 ORDER BY id"
+            "SELECT * FROM public.doctors WHERE is_active = 1 ORDER BY id",
+            readonly=replica_ok("doctors"),
         )
 
         return doctors
@@ -383,8 +2456,12 @@ def get_doctors():
 @app.get("/api/services")
 def get_services():
     """Возвращает список всех услуг"""
+    return cache_get("services", None, _load_services)
+
+
+def _load_services():
     if USE_POSTGRES:
-        services = pg_query_all("SELECT * FROM public.services ORDER BY id")
+        services = pg_query_all("SELECT * FROM public.services ORDER BY id", readonly=replica_ok("services"))
         return services
 
     conn = get_db_sqlite()
@@ -394,6 +2471,7 @@ def get_services():
 
 
 @app.post("/api/services")
+@invalidates("services")
 def create_service(data: dict):
     """Создание новой услуги"""
     name = data.get("name", "").strip()
@@ -429,31 +2507,107 @@ def get_available_slots(date: str, doctor_id: int = None):
     # нормализуем дату
     date = normalize_date_str(date)
 
-    # Генерируем слоты
-    slots = []
-    h, m = 8, 0
-    while True:
-        slots.append(f"{h:02d}:{m:02d}")
-        m += 30
-        if m >= 60:
-            h += 1
-            m -= 60
-        if h > 18 or (h == 18 and m > 0):
-            break
+    # Сетка слотов из расписания (уже развёрнута и закэширована)
+    if doctor_id:
+        slots = day_plan(doctor_id, date).slots
+    else:
+        slots = cache_get("schedules", ("union", date), lambda: _union_grid(date))
 
     # Фильтруем занятые слоты
+    occupied_times = cache_get("slots", (date, doctor_id), lambda: _load_occupied_times(date, doctor_id))
+
+    available_slots = [slot for slot in slots if slot not in occupied_times]
+    return [
+        {
+            "time": slot,
+            "available": True
+        }
+        for slot in available_slots
+    ]
+
+
+@app.get("/api/available-slots/month")
+def get_month_availability(month: str, doctor_id: int = None):
+    """Сколько свободных слотов в каждом дне месяца (month=YYYY-MM) — для календаря на сайте.
+    Занятость за весь месяц — один сгруппированный запрос, сетки дней — из кэша расписаний.
+    """
+    try:
+        first = datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month: YYYY-MM")
+    next_month = (first.replace(day=28) + timedelta(days=4)).replace(day=1)
+    date_from, date_to = first.strftime("%Y-%m-%d"), (next_month - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    occupied = cache_get(
+        "slots", ("month", doctor_id, month),
+        lambda: _load_occupied_by_day(date_from, date_to, doctor_id),
+    )
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    days = []
+    d = first
+    while d < next_month:
+        date = d.strftime("%Y-%m-%d")
+        if doctor_id:
+            plan = day_plan(doctor_id, date)
+            grid, day_off = plan.slot_set, plan.day_off
+        else:
+            grid = frozenset(cache_get("schedules", ("union", date), lambda: _union_grid(date)))
+            day_off = not grid
+        free = 0 if date < today else len(grid - occupied.get(date, frozenset()))
+        days.append({"date": date, "free": free, "total": len(grid), "day_off": day_off})
+        d += timedelta(days=1)
+
+    return {"month": month, "doctor_id": doctor_id, "days": days}
+
+
+def _load_occupied_by_day(date_from: str, date_to: str, doctor_id: int = None) -> dict:
+    """{'YYYY-MM-DD': frozenset('HH:MM', ...)} — активные записи за период одним GROUP BY."""
+    if USE_POSTGRES:
+        sql = (
+            "SELECT appointment_date::text AS day, "
+            "string_agg(DISTINCT LEFT(appointment_time::text, 5), ',') AS times "
+            "FROM public.appointments "
+            "WHERE appointment_date BETWEEN %s AND %s AND status = 'активна'"
+        )
+        params = [date_from, date_to]
+        if doctor_id:
+            sql += " AND doctor_id = %s"
+            params.append(doctor_id)
+        rows = pg_query_all(sql + " GROUP BY appointment_date", tuple(params), readonly=replica_ok("slots"))
+    else:
+        sql = (
+            "SELECT appointment_date AS day, group_concat(DISTINCT substr(appointment_time, 1, 5)) AS times "
+            "FROM appointments "
+            "WHERE appointment_date BETWEEN ? AND ? AND status = 'активна'"
+        )
+        params = [date_from, date_to]
+        if doctor_id:
+            sql += " AND doctor_id = ?"
+            params.append(doctor_id)
+        conn = get_db_sqlite()
+        rows = conn.execute(sql + " GROUP BY appointment_date", tuple(params)).fetchall()
+        conn.close()
+
+    return {str(r["day"])[:10]: frozenset((r["times"] or "").split(",")) for r in rows}
+
+
+def _load_occupied_times(date: str, doctor_id: int = None) -> frozenset:
+    """Занятые времена (HH:MM) по врачу/дате — только активные записи."""
     if USE_POSTGRES:
         if doctor_id:
             occupied = pg_query_all(
                 "SELECT appointment_time FROM public.appointments "
                 "WHERE doctor_id = %s AND appointment_date = %s AND status = 'активна'",
-                (doctor_id, date)
+                (doctor_id, date),
+                readonly=replica_ok("slots"),
             )
         else:
             occupied = pg_query_all(
                 "SELECT appointment_time FROM public.appointments "
                 "WHERE appointment_date = %s AND status = 'активна'",
-                (date,)
+                (date,),
+                readonly=replica_ok("slots"),
             )
 
         occupied_times = {
@@ -483,19 +2637,21 @@ def get_available_slots(date: str, doctor_id: int = None):
         occupied_times = {str(row["appointment_time"])[:5] for row in occupied}
         conn.close()
 
-    available_slots = [slot for slot in slots if slot not in occupied_times]
-    return [
-        {
-            "time": slot,
-            "available": True
-        }
-        for slot in available_slots
-    ]
+    return frozenset(occupied_times)
 
 
 @app.post("/api/appointments")
-def create_appointment(appointment: AppointmentCreate):
-    """Создание новой записи"""
+@invalidates("slots")
+def create_appointment(appointment: AppointmentCreate,
+                       idempotency_key: str | None = Header(None, alias="Idempotency-Key")):
+    """Создание новой записи (поддерживает Idempotency-Key)"""
+    return run_idempotent(idempotency_key, "POST /api/appointments", appointment.model_dump(),
+                          lambda: _create_appointment(appointment))
+
+
+def _create_appointment(appointment: AppointmentCreate):
+    ensure_in_schedule(appointment.doctor_id, appointment.appointment_date, appointment.appointment_time)
+
     # Проверка занятости слота
     if USE_POSTGRES:
         existing = pg_query_one(
@@ -505,21 +2661,25 @@ def create_appointment(appointment: AppointmentCreate):
         if existing:
             raise HTTPException(status_code=400, detail="Время занято")
 
-        new_id = pg_execute(
-            """INSERT INTO public.appointments
-                (patient_name, phone, doctor_id, appointment_date, appointment_time, service_name, duration_hours, status)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, 'активна')""",
-            (
-                appointment.patient_name,
-                appointment.phone,
-                appointment.doctor_id,
-                appointment.appointment_date,
-                appointment.appointment_time,
-                appointment.service_name,
-                appointment.duration_hours or 1,
-            ),
-            returning_id=True,
-        )
+        # запись и событие-подтверждение — одной транзакцией
+        with pg_transaction() as cur:
+            cur.execute(
+                """INSERT INTO public.appointments
+                    (patient_name, phone, doctor_id, appointment_date, appointment_time, service_name, duration_hours, status)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, 'активна')
+                   RETURNING id""",
+                (
+                    appointment.patient_name,
+                    appointment.phone,
+                    appointment.doctor_id,
+                    appointment.appointment_date,
+                    appointment.appointment_time,
+                    appointment.service_name,
+                    appointment.duration_hours or 1,
+                ),
+            )
+            new_id = cur.fetchone()[0]
+            outbox_add(cur, "appointment_created", new_id, {"id": new_id, **appointment.model_dump()})
         return {"success": True, "id": int(new_id)}
 
     conn = get_db_sqlite()
@@ -546,13 +2706,15 @@ def create_appointment(appointment: AppointmentCreate):
             appointment.duration_hours or 1,
         ),
     )
-    conn.commit()
     apt_id = cursor.lastrowid
+    outbox_add(cursor, "appointment_created", apt_id, {"id": apt_id, **appointment.model_dump()})
+    conn.commit()
     conn.close()
     return {"success": True, "id": apt_id}
 
 
 @app.put("/api/appointments/{apt_id}")
+@invalidates("slots", "queue")
 def update_appointment(apt_id: int, data: dict):
     """Обновление записи (перенос/смена врача/времени/даты) — нужно клиенту.
     Ожидаемые поля: doctor_id, appointment_date, appointment_time, (опционально phone, patient_name, service_name, status)
@@ -577,6 +2739,8 @@ def update_appointment(apt_id: int, data: dict):
         doctor_id = new_doctor if new_doctor is not None else current["doctor_id"]
         ap_date = new_date if new_date is not None else current["appointment_date"]
         ap_time = new_time if new_time is not None else current["appointment_time"]
+        if {"doctor_id", "appointment_date", "appointment_time"} & fields.keys():
+            ensure_in_schedule(doctor_id, ap_date, ap_time)
 
         # конфликт
         existing = pg_query_one(
@@ -595,7 +2759,12 @@ def update_appointment(apt_id: int, data: dict):
             set_parts.append(f"{k} = %s")
             params.append(v)
         params.append(apt_id)
-        pg_execute(f"UPDATE public.appointments SET {', '.join(set_parts)} WHERE id = %s", tuple(params))
+        with pg_transaction() as cur:
+            cur.execute(f"UPDATE public.appointments SET {', '.join(set_parts)} WHERE id = %s", tuple(params))
+            event = _reschedule_event(current, doctor_id, ap_date, ap_time)
+            if event:
+                outbox_add(cur, "appointment_rescheduled", apt_id, event)
+        _refresh_queue_appointment(apt_id)
         return {"success": True}
 
     conn = get_db_sqlite()
@@ -608,6 +2777,12 @@ def update_appointment(apt_id: int, data: dict):
     doctor_id = new_doctor if new_doctor is not None else current["doctor_id"]
     ap_date = new_date if new_date is not None else current["appointment_date"]
     ap_time = new_time if new_time is not None else current["appointment_time"]
+    if {"doctor_id", "appointment_date", "appointment_time"} & fields.keys():
+        try:
+            ensure_in_schedule(doctor_id, ap_date, ap_time)
+        except HTTPException:
+            conn.close()
+            raise
 
     existing = cur.execute(
         """SELECT id FROM appointments
@@ -626,14 +2801,120 @@ def update_appointment(apt_id: int, data: dict):
         params.append(v)
     params.append(apt_id)
     cur.execute(f"UPDATE appointments SET {', '.join(set_parts)} WHERE id = ?", tuple(params))
+    event = _reschedule_event(dict(current), doctor_id, ap_date, ap_time)
+    if event:
+        outbox_add(cur, "appointment_rescheduled", apt_id, event)
     conn.commit()
     conn.close()
+    _refresh_queue_appointment(apt_id)
     return {"success": True}
 
 
+def _refresh_queue_appointment(apt_id: int):
+    """Пациент/услуга/время в очереди берутся из записи — перечитываем её строки."""
+    with queue_engine.writing() as q:
+        if q.has_appointment(apt_id):
+            q.remove_appointment(apt_id)
+            q.add_rows(_load_queue(appointment_id=apt_id))
+
+
+def _reschedule_event(current: dict, doctor_id, ap_date, ap_time):
+    """Payload уведомления о переносе или None, если врач/дата/время не менялись."""
+    before = (int(current["doctor_id"]), str(current["appointment_date"])[:10], _time_str(current["appointment_time"]))
+    after = (int(doctor_id), str(ap_date)[:10], _time_str(ap_time))
+    if before == after:
+        return None
+    return {
+        "id": current["id"],
+        "patient_name": current["patient_name"],
+        "phone": current["phone"],
+        "doctor_id": after[0],
+        "appointment_date": after[1],
+        "appointment_time": after[2],
+        "previous": {"doctor_id": before[0], "appointment_date": before[1], "appointment_time": before[2]},
+    }
+
+
+APPOINTMENTS_PAGE_MAX = 200
+
+
+def _encode_cursor(row: dict) -> str:
+    key = [str(row["appointment_date"])[:10], _time_str(row["appointment_time"]), int(row["id"])]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ap_date, ap_time, apt_id = json.loads(raw)
+        return str(ap_date), str(ap_time), int(apt_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Неверный cursor")
+
+
+@app.get("/api/appointments")
+def list_appointments(date_from: str = None, date_to: str = None, doctor_id: int = None,
+                      status: str = None, service_name: str = None, order: str = "asc",
+                      limit: int = 50, cursor: str = None, include_archive: bool = False):
+    """Список записей с фильтрами и keyset-пагинацией по (appointment_date, appointment_time, id).
+    status можно передать списком через запятую. Следующая страница — ?cursor=<next_cursor>;
+    каждая страница — один проход по индексу idx_appointments_keyset, без OFFSET.
+    """
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order: asc или desc")
+    limit = max(1, min(limit, APPOINTMENTS_PAGE_MAX))
+    ph = "%s" if USE_POSTGRES else "?"
+
+    where, params = [], []
+    if date_from:
+        where.append(f"a.appointment_date >= {ph}")
+        params.append(normalize_date_str(date_from))
+    if date_to:
+        where.append(f"a.appointment_date <= {ph}")
+        params.append(normalize_date_str(date_to))
+    if doctor_id:
+        where.append(f"a.doctor_id = {ph}")
+        params.append(doctor_id)
+    statuses = [s.strip() for s in (status or "").split(",") if s.strip()]
+    if statuses:  # "?status=," — пустой список, фильтр не нужен
+        where.append(f"a.status IN ({', '.join([ph] * len(statuses))})")
+        params.extend(statuses)
+    if service_name:
+        where.append(f"a.service_name = {ph}")
+        params.append(service_name)
+    if cursor:
+        op = ">" if order == "asc" else "<"
+        where.append(f"(a.appointment_date, a.appointment_time, a.id) {op} ({ph}, {ph}, {ph})")
+        params.extend(_decode_cursor(cursor))
+
+    direction = "ASC" if order == "asc" else "DESC"
+    sql = f"""SELECT a.*, d.name as doctor_name, d.room
+              FROM {appointments_source(include_archive)} a
+              LEFT JOIN {_table('doctors')} d ON a.doctor_id = d.id
+              {"WHERE " + " AND ".join(where) if where else ""}
+              ORDER BY a.appointment_date {direction}, a.appointment_time {direction}, a.id {direction}
+              LIMIT {limit + 1}"""
+
+    if USE_POSTGRES:
+        rows = pg_query_all(sql, tuple(params), readonly=replica_ok())
+    else:
+        conn = get_db_sqlite()
+        rows = [dict(r) for r in conn.execute(sql, tuple(params)).fetchall()]
+        conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": rows,
+        "next_cursor": _encode_cursor(rows[-1]) if has_more else None,
+    }
+
+
 @app.get("/api/appointments/search")
-def search_appointments(patient_name: str = ""):
-    """Поиск записей по ФИО/имени пациента — используется клиентом."""
+def search_appointments(patient_name: str = "", include_archive: bool = False):
+    """Поиск записей по ФИО/имени пациента — используется клиентом.
+    include_archive=true — искать также в архиве (для отчётов).
+    """
     q = (patient_name or "").strip()
     if q == "":
         # возвращать всё не будем (это тяжело); но для совместимости вернём пусто
@@ -641,19 +2922,20 @@ def search_appointments(patient_name: str = ""):
 
     if USE_POSTGRES:
         return pg_query_all(
-            """SELECT a.*, d.name as doctor_name, d.room
-               FROM public.appointments a
+            f"""SELECT a.*, d.name as doctor_name, d.room
+               FROM {appointments_source(include_archive)} a
                LEFT JOIN public.doctors d ON a.doctor_id = d.id
                WHERE LOWER(a.patient_name) LIKE LOWER(%s)
                ORDER BY a.appointment_date DESC, a.appointment_time DESC
                LIMIT 200""",
             (f"%{q}%",),
+            readonly=replica_ok(),
         )
 
     conn = get_db_sqlite()
     rows = conn.execute(
-        """SELECT a.*, d.name as doctor_name, d.room
-           FROM appointments a
+        f"""SELECT a.*, d.name as doctor_name, d.room
+           FROM {appointments_source(include_archive)} a
            LEFT JOIN doctors d ON a.doctor_id = d.id
            WHERE LOWER(a.patient_name) LIKE ?
            ORDER BY a.appointment_date DESC, a.appointment_time DESC
@@ -664,11 +2946,25 @@ def search_appointments(patient_name: str = ""):
     return [dict(r) for r in rows]
 
 
+def json_with_etag(request: Request, data) -> Response:
+    """JSON с ETag по содержимому; If-None-Match с тем же ETag -> 304 без тела.
+    Программа очереди так перепроверяет сохранённые дни, не скачивая их заново."""
+    body = json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
 @app.get("/api/appointments/today")
-def get_today_appointments(date: str = None):
+def get_today_appointments(request: Request, date: str = None):
     if not date:
         date = datetime.now().strftime("%Y-%m-%d")
+    return json_with_etag(request, _appointments_for_day(date))
+
 
+def _appointments_for_day(date: str):
     if USE_POSTGRES:
         return pg_query_all(
             """SELECT a.*, d.name as doctor_name, d.room
@@ -677,6 +2973,7 @@ def get_today_appointments(date: str = None):
                WHERE a.appointment_date = %s AND a.status = 'активна'
                ORDER BY a.appointment_time""",
             (date,),
+            readonly=replica_ok(),
         )
 
     conn = get_db_sqlite()
@@ -694,7 +2991,28 @@ def get_today_appointments(date: str = None):
 
 @app.get("/api/queue")
 def get_queue():
-    """Очередь — клиенту нужны: id, status, doctor_id, doctor_name, room, patient_name, phone, service_name, appointment_id, called_at, duration_hours."""
+    """Очередь — клиенту нужны: id, status, doctor_id, doctor_name, room, patient_name, phone, service_name, appointment_id, called_at, duration_hours.
+    estimated_wait_min / estimated_wait_p90_min — оценка ожидания до вызова (0 для уже вызванных)."""
+    return queue_with_estimates(queue_engine.snapshot())
+
+
+@app.get("/api/queue/service-times")
+def get_service_times():
+    """Статистика длительности приёма по врачу и услуге: EWMA, p50, p90 (минуты)."""
+    return service_times.summary()
+
+
+def _load_queue(queue_id: int = None, appointment_id: int = None):
+    """Активные строки очереди из основной БД (для QueueEngine): все или одну/по записи."""
+    filters, params = [], []
+    if queue_id is not None:
+        filters.append("q.id = {ph}")
+        params.append(queue_id)
+    if appointment_id is not None:
+        filters.append("q.appointment_id = {ph}")
+        params.append(appointment_id)
+    where = "".join(f" AND {f}" for f in filters)
+
     if USE_POSTGRES:
         return pg_query_all(
             """SELECT q.*,
@@ -709,8 +3027,9 @@ def get_queue():
                FROM public.queue q
                JOIN public.doctors d ON q.doctor_id = d.id
                LEFT JOIN public.appointments a ON q.appointment_id = a.id
-               WHERE q.status NOT IN ('завершён', 'не_пришёл')
-               ORDER BY q.called_at NULLS LAST, q.id"""
+               WHERE q.status NOT IN ('завершён', 'не_пришёл')""" + where.format(ph="%s") + """
+               ORDER BY q.called_at NULLS LAST, q.id""",
+            tuple(params),
         )
 
     conn = get_db_sqlite()
@@ -727,93 +3046,106 @@ def get_queue():
            FROM queue q
            JOIN doctors d ON q.doctor_id = d.id
            LEFT JOIN appointments a ON q.appointment_id = a.id
-           WHERE q.status NOT IN ('завершён', 'не_пришёл')
-           ORDER BY q.called_at NULLS LAST, q.id"""
+           WHERE q.status NOT IN ('завершён', 'не_пришёл')""" + where.format(ph="?") + """
+           ORDER BY q.called_at NULLS LAST, q.id""",
+        tuple(params),
     ).fetchall()
     conn.close()
     return [dict(row) for row in queue]
 
 
 @app.post("/api/queue")
-def add_to_queue(data: dict):
-    """Добавить пациента в очередь по appointment_id"""
+@invalidates("queue", "slots")
+def add_to_queue(data: dict, idempotency_key: str | None = Header(None, alias="Idempotency-Key")):
+    """Добавить пациента в очередь по appointment_id (поддерживает Idempotency-Key)"""
+    return run_idempotent(idempotency_key, "POST /api/queue", data, lambda: _add_to_queue(data))
+
+
+def _add_to_queue(data: dict):
     appointment_id = data.get("appointment_id")
     if not appointment_id:
         raise HTTPException(status_code=400, detail="appointment_id required")
 
-    if USE_POSTGRES:
-        apt = pg_query_one("SELECT * FROM public.appointments WHERE id = %s", (appointment_id,))
-        if not apt:
-            raise HTTPException(status_code=404, detail="Appointment not found")
-
-        doctor_id = apt.get("doctor_id")
-        patient_name = apt.get("patient_name") or apt.get("name") or ""
-        if not patient_name:
-            raise HTTPException(status_code=422, detail="patient_name missing in appointment")
-
-        # room is required (NOT NULL) in queue table
-        room = apt.get("room")
-        if not room and doctor_id is not None:
-            doc = pg_query_one("SELECT room FROM public.doctors WHERE id = %s", (doctor_id,))
-            room = (doc.get("room") if doc else None)
+    with queue_engine.writing() as q:
+        if USE_POSTGRES:
+            apt = pg_query_one("SELECT * FROM public.appointments WHERE id = %s", (appointment_id,))
+            if not apt:
+                raise HTTPException(status_code=404, detail="Appointment not found")
+
+            doctor_id = apt.get("doctor_id")
+            patient_name = apt.get("patient_name") or apt.get("name") or ""
+            if not patient_name:
+                raise HTTPException(status_code=422, detail="patient_name missing in appointment")
+
+            # room is required (NOT NULL) in queue table
+            room = apt.get("room")
+            if not room and doctor_id is not None:
+                doc = pg_query_one("SELECT room FROM public.doctors WHERE id = %s", (doctor_id,))
+                room = (doc.get("room") if doc else None)
+
+            if not room:
+                room = "-"  # безопасное значение, чтобы не нарушать NOT NULL
+
+            # Проверяем, не в очереди ли уже
+            exists = pg_query_one(
+                "SELECT id FROM public.queue WHERE appointment_id = %s AND status NOT IN ('завершён', 'не_пришёл', 'отменён')",
+                (appointment_id,),
+            )
+            if exists:
+                return {"ok": True, "queue_id": exists["id"], "message": "Already in queue"}
 
-        if not room:
-            room = "-"  # безопасное значение, чтобы не нарушать NOT NULL
+            sql = "INSERT INTO public.queue (appointment_id, patient_name, doctor_id, room, status) VALUES (%s, %s, %s, %s, 'ожидание')"
+            params = (appointment_id, patient_name, doctor_id, room)
+            new_id = pg_execute(sql, params, returning_id=True)
+            q.add_rows(_load_queue(queue_id=new_id))
 
-        # Проверяем, не в очереди ли уже
-        exists = pg_query_one(
-            "SELECT id FROM public.queue WHERE appointment_id = %s AND status NOT IN ('завершён', 'не_пришёл', 'отменён')",
-            (appointment_id,),
-        )
-        if exists:
-            return {"ok": True, "queue_id": exists["id"], "message": "Already in queue"}
+            return {"ok": True, "id": new_id, "appointment_id": appointment_id, "patient_name": patient_name, "doctor_id": doctor_id, "room": room, "status": "ожидание"}
 
-        sql = "INSERT INTO public.queue (appointment_id, patient_name, doctor_id, room, status) VALUES (%s, %s, %s, %s, 'ожидание')"
-        params = (appointment_id, patient_name, doctor_id, room)
-        new_id = pg_execute(sql, params, returning_id=True)
+        conn = get_db_sqlite()
+        cur = conn.cursor()
+        apt = cur.execute("SELECT * FROM appointments WHERE id = ?", (appointment_id,)).fetchone()
+        if not apt:
+            conn.close()
+            raise HTTPException(status_code=404, detail="Appointment not found")
 
-        return {"ok": True, "id": new_id, "appointment_id": appointment_id, "patient_name": patient_name, "doctor_id": doctor_id, "room": room, "status": "ожидание"}
+        doctor_id = apt["doctor_id"]
+        doc = cur.execute("SELECT room FROM doctors WHERE id = ?", (doctor_id,)).fetchone()
+        room = (doc["room"] if doc else None) or "-"
 
-    conn = get_db_sqlite()
-    cur = conn.cursor()
-    apt = cur.execute("SELECT * FROM appointments WHERE id = ?", (appointment_id,)).fetchone()
-    if not apt:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Appointment not found")
+        exists = cur.execute(
+            "SELECT id FROM queue WHERE appointment_id = ? AND status NOT IN ('завершён', 'не_пришёл')",
+            (appointment_id,)
+        ).fetchone()
+        if exists:
+            conn.close()
+            raise HTTPException(status_code=400, detail="Уже в очереди")
 
-    doctor_id = apt["doctor_id"]
-    room = apt.get("room", "")
+        insert_cols = ["appointment_id", "doctor_id", "status"]
+        insert_vals = [appointment_id, doctor_id, "ожидание"]
 
-    exists = cur.execute(
-        "SELECT id FROM queue WHERE appointment_id = ? AND status NOT IN ('завершён', 'не_пришёл')",
-        (appointment_id,)
-    ).fetchone()
-    if exists:
+        cols = [r[1] for r in cur.execute("PRAGMA table_info(queue)").fetchall()]
+        if "room" in cols:
+            insert_cols.append("room")
+            insert_vals.append(room)
+        if "patient_name" in cols:
+            insert_cols.append("patient_name")
+            insert_vals.append(apt["patient_name"] or "")
+
+        qmarks = ", ".join(["?"] * len(insert_cols))
+        cur.execute(f"INSERT INTO queue ({', '.join(insert_cols)}) VALUES ({qmarks})", tuple(insert_vals))
+        new_id = cur.lastrowid
+
+        # Изменить статус записи на "в_работе"
+        cur.execute("UPDATE appointments SET status = 'в_работе' WHERE id = ?", (appointment_id,))
+        conn.commit()
         conn.close()
-        raise HTTPException(status_code=400, detail="Уже в очереди")
-
-    insert_cols = ["appointment_id", "doctor_id", "status"]
-    insert_vals = [appointment_id, doctor_id, "ожидание"]
-
-    cols = [r[1] for r in cur.execute("PRAGMA table_info(queue)").fetchall()]
-    if "room" in cols:
-        insert_cols.append("room")
-        insert_vals.append(room)
-
-    qmarks = ", ".join(["?"] * len(insert_cols))
-    cur.execute(f"INSERT INTO queue ({', '.join(insert_cols)}) VALUES ({qmarks})", tuple(insert_vals))
-    conn.commit()
-    new_id = cur.lastrowid
-
-    # Изменить статус записи на "в_работе"
-    cur.execute("UPDATE appointments SET status = 'в_работе' WHERE id = ?", (appointment_id,))
-    conn.commit()
-    conn.close()
+        q.add_rows(_load_queue(queue_id=new_id))
 
     return {"success": True, "id": int(new_id)}
 
 
 @app.put("/api/queue/{queue_id}/status")
+@invalidates("queue", "slots", "doctors")
 def update_queue_status(queue_id: int, data: dict):
     """Обновить статус элемента очереди. Клиент шлёт {"status": "..."}"""
     status = (data or {}).get("status")
@@ -823,83 +3155,113 @@ def update_queue_status(queue_id: int, data: dict):
     # если статус меняется на "вызван/в_работе" и called_at пустой — ставим время
     now_iso = datetime.now().isoformat(timespec="seconds")
 
-    if USE_POSTGRES:
-        row = pg_query_one("SELECT id, called_at, doctor_id, appointment_id FROM public.queue WHERE id = %s",
-                           (queue_id,))
+    with queue_engine.writing() as q:
+        if USE_POSTGRES:
+            with pg_transaction() as cur:
+                cur.execute(
+                    "UPDATE public.queue SET status = %s, called_at = COALESCE(called_at, now()) WHERE id = %s "
+                    "RETURNING doctor_id, appointment_id, called_at",
+                    (status, queue_id),
+                )
+                row = _fetch_one_dict(cur)
+                if not row:
+                    raise HTTPException(status_code=404, detail="Queue item not found")
+
+                doctor_id = row["doctor_id"]
+                appointment_id = row["appointment_id"]
+
+                # Изменение статуса записи
+                if status == "завершён":
+                    cur.execute("UPDATE public.queue SET finished_at = now() WHERE id = %s", (queue_id,))
+                    cur.execute("UPDATE public.appointments SET status = 'завершена' WHERE id = %s", (appointment_id,))
+                elif status == "не_пришёл":
+                    cur.execute("UPDATE public.appointments SET status = 'не_пришёл' WHERE id = %s", (appointment_id,))
+
+                # Изменение статуса врача: активных пациентов считаем по очереди в памяти
+                if status in ("готов", "в_работе"):
+                    cur.execute("UPDATE public.doctors SET status = 'занят' WHERE id = %s", (doctor_id,))
+                elif status in QUEUE_CLOSED_STATUSES and _active_after_close(q, doctor_id, [queue_id]) == 0:
+                    cur.execute(
+                        "UPDATE public.doctors SET status = 'свободен' "
+                        "WHERE id = %s AND status NOT IN ('выходной', 'перерыв')",
+                        (doctor_id,),
+                    )
+            _record_service_time(q.get(queue_id), status)
+            q.set_status(queue_id, status, row["called_at"])
+            return {"success": True}
+
+        conn = get_db_sqlite()
+        cur = conn.cursor()
+        row = cur.execute("SELECT id, called_at, doctor_id, appointment_id FROM queue WHERE id = ?", (queue_id,)).fetchone()
         if not row:
+            conn.close()
             raise HTTPException(status_code=404, detail="Queue item not found")
 
-        doctor_id = row.get("doctor_id")
-        appointment_id = row.get("appointment_id")
+        doctor_id = row["doctor_id"]
+        appointment_id = row["appointment_id"]
+        called_at = row["called_at"] or now_iso
 
-        if row.get("called_at") is None:
-            pg_execute("UPDATE public.queue SET status = %s, called_at = now() WHERE id = %s", (status, queue_id))
-        else:
-            pg_execute("UPDATE public.queue SET status = %s WHERE id = %s", (status, queue_id))
+        cur.execute("UPDATE queue SET status = ?, called_at = ? WHERE id = ?", (status, called_at, queue_id))
 
         # Изменение статуса записи
         if status == "завершён":
-            pg_execute("UPDATE public.appointments SET status = 'завершена' WHERE id = %s", (appointment_id,))
+            cur.execute("UPDATE queue SET finished_at = ? WHERE id = ?", (now_iso, queue_id))
+            cur.execute("UPDATE appointments SET status = 'завершена' WHERE id = ?", (appointment_id,))
         elif status == "не_пришёл":
-            pg_execute("UPDATE public.appointments SET status = 'не_пришёл' WHERE id = %s", (appointment_id,))
+            cur.execute("UPDATE appointments SET status = 'не_пришёл' WHERE id = ?", (appointment_id,))
 
-        # Изменение статуса врача
+        # Изменение статуса врача: активных пациентов считаем по очереди в памяти
         if status in ("готов", "в_работе"):
-            pg_execute("UPDATE public.doctors SET status = 'занят' WHERE id = %s", (doctor_id,))
-        elif status in ("завершён", "не_пришёл"):
-            active = pg_query_one(
-                "SELECT COUNT(*)::int as cnt FROM public.queue WHERE doctor_id = %s AND status IN ('ожидание', 'готов', 'в_работе')",
-                (doctor_id,)
+            cur.execute("UPDATE doctors SET status = 'занят' WHERE id = ?", (doctor_id,))
+        elif status in QUEUE_CLOSED_STATUSES and _active_after_close(q, doctor_id, [queue_id]) == 0:
+            cur.execute(
+                "UPDATE doctors SET status = 'свободен' WHERE id = ? AND status NOT IN ('выходной', 'перерыв')",
+                (doctor_id,),
             )
-            if active and active.get("cnt", 0) == 0:
-                # Проверяем текущий статус врача
-                doctor = pg_query_one("SELECT status FROM public.doctors WHERE id = %s", (doctor_id,))
-                if doctor and doctor.get("status") not in ("выходной", "перерыв"):
-                    pg_execute("UPDATE public.doctors SET status = 'свободен' WHERE id = %s", (doctor_id,))
-
-        return {"success": True}
 
-    conn = get_db_sqlite()
-    cur = conn.cursor()
-    row = cur.execute("SELECT id, called_at, doctor_id, appointment_id FROM queue WHERE id = ?", (queue_id,)).fetchone()
-    if not row:
+        conn.commit()
         conn.close()
-        raise HTTPException(status_code=404, detail="Queue item not found")
+        _record_service_time(q.get(queue_id), status)
+        q.set_status(queue_id, status, called_at)
+    return {"success": True}
 
-    doctor_id = row["doctor_id"]
-    appointment_id = row["appointment_id"]
 
-    if row["called_at"] is None:
-        cur.execute("UPDATE queue SET status = ?, called_at = ? WHERE id = ?", (status, now_iso, queue_id))
-    else:
-        cur.execute("UPDATE queue SET status = ? WHERE id = ?", (status, queue_id))
-
-    # Изменение статуса записи
-    if status == "завершён":
-        cur.execute("UPDATE appointments SET status = 'завершена' WHERE id = ?", (appointment_id,))
-    elif status == "не_пришёл":
-        cur.execute("UPDATE appointments SET status = 'не_пришёл' WHERE id = ?", (appointment_id,))
-
-    # Изменение статуса врача
-    if status in ("готов", "в_работе"):
-        cur.execute("UPDATE doctors SET status = 'занят' WHERE id = ?", (doctor_id,))
-    elif status in ("завершён", "не_пришёл"):
-        active = cur.execute(
-            "SELECT COUNT(*) as cnt FROM queue WHERE doctor_id = ? AND status IN ('ожидание', 'готов', 'в_работе')",
-            (doctor_id,)
-        ).fetchone()
-        if active and active["cnt"] == 0:
-            # Проверяем текущий статус врача
-            doctor = cur.execute("SELECT status FROM doctors WHERE id = ?", (doctor_id,)).fetchone()
-            if doctor and doctor["status"] not in ("выходной", "перерыв"):
-                cur.execute("UPDATE doctors SET status = 'свободен' WHERE id = ?", (doctor_id,))
+def _record_service_time(entry: dict, status: str):
+    """Завершённый приём (был вызван раньше) — в статистику длительности."""
+    if status == "завершён" and entry and entry.get("called_at") is not None:
+        sample = (entry["doctor_id"], entry.get("service_name"), _minutes_since(entry["called_at"]))
+        pending = _batch_service_samples.get()
+        if pending is not None:
+            pending.append(sample)  # пакет ещё может откатиться
+        else:
+            service_times.record(*sample)
 
-    conn.commit()
-    conn.close()
-    return {"success": True}
+
+def _active_after_close(engine: QueueEngine, doctor_id: int, closing_ids) -> int:
+    """Сколько активных пациентов останется у врача, когда closing_ids уйдут из очереди.
+    Вычитаем только строки, которые active_count считает (статус из QUEUE_ACTIVE_STATUSES):
+    закрытие, например, «вызван» не уменьшает число активных."""
+    closing = 0
+    for qid in set(closing_ids):
+        entry = engine.get(qid) or {}
+        if entry.get("doctor_id") == doctor_id and entry.get("status") in QUEUE_ACTIVE_STATUSES:
+            closing += 1
+    return engine.active_count(doctor_id) - closing
+
+
+@app.post("/api/queue/next")
+def call_next_patient(doctor_id: int):
+    """Вызвать следующего ожидающего пациента врача (голова очереди в памяти)."""
+    with queue_engine.writing() as q:
+        entry = q.next_waiting(doctor_id)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Нет ожидающих пациентов")
+        update_queue_status(entry["id"], {"status": "готов"})
+        return q.get(entry["id"])
 
 
 @app.put("/api/doctors/{doctor_id}/status")
+@invalidates("doctors")
 def update_doctor_status(doctor_id: int, data: dict):
     status = data.get("status")
     if not status:
@@ -916,70 +3278,211 @@ def update_doctor_status(doctor_id: int, data: dict):
     return {"success": True}
 
 
-@app.put("/api/appointments/{apt_id}/cancel")
-def cancel_appointment(apt_id: int):
+@app.get("/api/doctors/{doctor_id}/schedule")
+def get_doctor_schedule(doctor_id: int, date_from: str = None, days: int = 7):
+    """Недельный шаблон, исключения и развёрнутые слоты на ближайшие дни."""
+    date_from = normalize_date_str(date_from) if date_from else datetime.now().strftime("%Y-%m-%d")
+    days = max(1, min(days, 31))
+
     if USE_POSTGRES:
-        # Получаем doctor_id из очереди перед удалением
-        queue_item = pg_query_one("SELECT doctor_id FROM public.queue WHERE appointment_id = %s", (apt_id,))
+        weekly = pg_query_all(
+            "SELECT * FROM public.doctor_schedules WHERE doctor_id = %s ORDER BY weekday",
+            (doctor_id,),
+            readonly=replica_ok("schedules"),
+        )
+        exceptions = pg_query_all(
+            "SELECT * FROM public.schedule_exceptions WHERE doctor_id = %s AND exception_date >= %s "
+            "ORDER BY exception_date, start_time",
+            (doctor_id, date_from),
+            readonly=replica_ok("schedules"),
+        )
+    else:
+        conn = get_db_sqlite()
+        weekly = [dict(r) for r in conn.execute(
+            "SELECT * FROM doctor_schedules WHERE doctor_id = ? ORDER BY weekday", (doctor_id,)
+        ).fetchall()]
+        exceptions = [dict(r) for r in conn.execute(
+            "SELECT * FROM schedule_exceptions WHERE doctor_id = ? AND exception_date >= ? "
+            "ORDER BY exception_date, start_time",
+            (doctor_id, date_from),
+        ).fetchall()]
+        conn.close()
 
-        pg_execute("UPDATE public.appointments SET status = 'отменена' WHERE id = %s", (apt_id,))
-        pg_execute("DELETE FROM public.queue WHERE appointment_id = %s", (apt_id,))
+    start = datetime.strptime(date_from, "%Y-%m-%d")
+    preview = []
+    for i in range(days):
+        d = (start + timedelta(days=i)).strftime("%Y-%m-%d")
+        plan = day_plan(doctor_id, d)
+        preview.append({"date": d, "day_off": plan.day_off, "slots": list(plan.slots)})
 
-        # Освобождаем врача если у него нет активных пациентов
-        if queue_item:
-            doctor_id = queue_item.get("doctor_id")
-            active = pg_query_one(
-                "SELECT COUNT(*)::int as cnt FROM public.queue WHERE doctor_id = %s AND status IN ('ожидание', 'готов', 'в_работе')",
-                (doctor_id,)
-            )
-            if active and active.get("cnt", 0) == 0:
-                doctor = pg_query_one("SELECT status FROM public.doctors WHERE id = %s", (doctor_id,))
-                if doctor and doctor.get("status") not in ("выходной", "перерыв"):
-                    pg_execute("UPDATE public.doctors SET status = 'свободен' WHERE id = %s", (doctor_id,))
+    return {
+        "doctor_id": doctor_id,
+        "is_default": not weekly,
+        "weekly": weekly,
+        "exceptions": exceptions,
+        "days": preview,
+    }
 
+
+@app.put("/api/doctors/{doctor_id}/schedule")
+@invalidates("schedules")
+def set_doctor_schedule(doctor_id: int, data: dict):
+    """Заменяет недельный шаблон врача.
+    data = {"weekly": [{"weekday": 0, "start_time": "08:00", "end_time": "17:00",
+                        "break_start": "13:00", "break_end": "14:00", "slot_minutes": 30}, ...]}
+    Дня недели нет в списке — выходной. Пустой список — расписание по умолчанию.
+    """
+    rows = [_parse_template_row(r) for r in (data or {}).get("weekly", [])]
+    if len({r[0] for r in rows}) != len(rows):
+        raise HTTPException(status_code=400, detail="День недели указан дважды")
+
+    if USE_POSTGRES:
+        with pg_transaction() as cur:
+            cur.execute("DELETE FROM public.doctor_schedules WHERE doctor_id = %s", (doctor_id,))
+            for row in rows:
+                cur.execute(
+                    """INSERT INTO public.doctor_schedules
+                        (doctor_id, weekday, start_time, end_time, break_start, break_end, slot_minutes)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    (doctor_id,) + row,
+                )
         return {"success": True}
 
     conn = get_db_sqlite()
-    cur = conn.cursor()
+    conn.execute("DELETE FROM doctor_schedules WHERE doctor_id = ?", (doctor_id,))
+    conn.executemany(
+        """INSERT INTO doctor_schedules
+            (doctor_id, weekday, start_time, end_time, break_start, break_end, slot_minutes)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        [(doctor_id,) + row for row in rows],
+    )
+    conn.commit()
+    conn.close()
+    return {"success": True}
 
-    # Получаем doctor_id из очереди перед удалением
-    queue_item = cur.execute("SELECT doctor_id FROM queue WHERE appointment_id = ?", (apt_id,)).fetchone()
 
-    cur.execute("UPDATE appointments SET status = 'отменена' WHERE id = ?", (apt_id,))
-    cur.execute("DELETE FROM queue WHERE appointment_id = ?", (apt_id,))
+@app.post("/api/doctors/{doctor_id}/schedule/exceptions")
+@invalidates("schedules")
+def add_schedule_exception(doctor_id: int, data: dict):
+    """Исключение на дату: {"date", "kind": 'выходной'|'перерыв', "start_time", "end_time", "note"}"""
+    data = data or {}
+    kind = data.get("kind", "выходной")
+    if kind not in EXCEPTION_KINDS:
+        raise HTTPException(status_code=400, detail="kind: 'выходной' или 'перерыв'")
+    exc_date = normalize_date_str(data.get("date") or "")
+    try:
+        datetime.strptime(exc_date, "%Y-%m-%d")
+        start, end = _minutes(data.get("start_time")), _minutes(data.get("end_time"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверная дата или время")
+    if kind == "перерыв" and (start is None or end is None or start >= end):
+        raise HTTPException(status_code=400, detail="Для перерыва нужны start_time < end_time")
+    start_time = _hhmm(start) if kind == "перерыв" else None
+    end_time = _hhmm(end) if kind == "перерыв" else None
+    note = data.get("note", "")
 
-    # Освобождаем врача если у него нет активных пациентов
-    if queue_item:
-        doctor_id = queue_item["doctor_id"]
-        active = cur.execute(
-            "SELECT COUNT(*) as cnt FROM queue WHERE doctor_id = ? AND status IN ('ожидание', 'готов', 'в_работе')",
-            (doctor_id,)
-        ).fetchone()
-        if active and active["cnt"] == 0:
-            doctor = cur.execute("SELECT status FROM doctors WHERE id = ?", (doctor_id,)).fetchone()
-            if doctor and doctor["status"] not in ("выходной", "перерыв"):
-                cur.execute("UPDATE doctors SET status = 'свободен' WHERE id = ?", (doctor_id,))
+    if USE_POSTGRES:
+        new_id = pg_execute(
+            """INSERT INTO public.schedule_exceptions (doctor_id, exception_date, kind, start_time, end_time, note)
+               VALUES (%s, %s, %s, %s, %s, %s)""",
+            (doctor_id, exc_date, kind, start_time, end_time, note),
+            returning_id=True,
+        )
+        return {"success": True, "id": int(new_id)}
+
+    conn = get_db_sqlite()
+    cur = conn.cursor()
+    cur.execute(
+        """INSERT INTO schedule_exceptions (doctor_id, exception_date, kind, start_time, end_time, note)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        (doctor_id, exc_date, kind, start_time, end_time, note),
+    )
+    conn.commit()
+    new_id = cur.lastrowid
+    conn.close()
+    return {"success": True, "id": int(new_id)}
+
+
+@app.delete("/api/schedule/exceptions/{exception_id}")
+@invalidates("schedules")
+def delete_schedule_exception(exception_id: int):
+    if USE_POSTGRES:
+        pg_execute("DELETE FROM public.schedule_exceptions WHERE id = %s", (exception_id,))
+        return {"success": True}
 
+    conn = get_db_sqlite()
+    conn.execute("DELETE FROM schedule_exceptions WHERE id = ?", (exception_id,))
     conn.commit()
     conn.close()
     return {"success": True}
 
 
+@app.put("/api/appointments/{apt_id}/cancel")
+@invalidates("slots", "queue", "doctors")
+def cancel_appointment(apt_id: int):
+    with queue_engine.writing() as q:
+        if USE_POSTGRES:
+            with pg_transaction() as cur:
+                cur.execute("UPDATE public.appointments SET status = 'отменена' WHERE id = %s", (apt_id,))
+                cur.execute("DELETE FROM public.queue WHERE appointment_id = %s RETURNING id, doctor_id", (apt_id,))
+                removed = _fetch_all_dicts(cur)
+
+                # Освобождаем врача если у него нет активных пациентов
+                for doctor_id in {r["doctor_id"] for r in removed}:
+                    if _active_after_close(q, doctor_id, [r["id"] for r in removed]) == 0:
+                        cur.execute(
+                            "UPDATE public.doctors SET status = 'свободен' "
+                            "WHERE id = %s AND status NOT IN ('выходной', 'перерыв')",
+                            (doctor_id,),
+                        )
+            q.remove_appointment(apt_id)
+            return {"success": True}
+
+        conn = get_db_sqlite()
+        cur = conn.cursor()
+
+        # Получаем строки очереди перед удалением
+        removed = cur.execute("SELECT id, doctor_id FROM queue WHERE appointment_id = ?", (apt_id,)).fetchall()
+
+        cur.execute("UPDATE appointments SET status = 'отменена' WHERE id = ?", (apt_id,))
+        cur.execute("DELETE FROM queue WHERE appointment_id = ?", (apt_id,))
+
+        # Освобождаем врача если у него нет активных пациентов
+        for doctor_id in {r["doctor_id"] for r in removed}:
+            if _active_after_close(q, doctor_id, [r["id"] for r in removed]) == 0:
+                cur.execute(
+                    "UPDATE doctors SET status = 'свободен' WHERE id = ? AND status NOT IN ('выходной', 'перерыв')",
+                    (doctor_id,),
+                )
+
+        conn.commit()
+        conn.close()
+        q.remove_appointment(apt_id)
+    return {"success": True}
+
+
 @app.get("/api/stats")
-def get_stats():
+def get_stats(include_archive: bool = False):
+    """Статистика. По умолчанию — только рабочие таблицы; include_archive=true — вместе с архивом."""
+    apts = appointments_source(include_archive)
+    queue = queue_source(include_archive)
+
     if USE_POSTGRES:
-        total = pg_query_one("SELECT COUNT(*)::int as cnt FROM public.appointments")["cnt"]
-        active = pg_query_one("SELECT COUNT(*)::int as cnt FROM public.appointments WHERE status = 'активна'")["cnt"]
-        cancelled = pg_query_one("SELECT COUNT(*)::int as cnt FROM public.appointments WHERE status = 'отменена'")[
-            "cnt"]
-        completed = pg_query_one("SELECT COUNT(*)::int as cnt FROM public.queue WHERE status = 'завершён'")["cnt"]
+        ro = replica_ok()
+        total = pg_query_one(f"SELECT COUNT(*)::int as cnt FROM {apts} a", readonly=ro)["cnt"]
+        active = pg_query_one(f"SELECT COUNT(*)::int as cnt FROM {apts} a WHERE status = 'активна'", readonly=ro)["cnt"]
+        cancelled = pg_query_one(f"SELECT COUNT(*)::int as cnt FROM {apts} a WHERE status = 'отменена'",
+                                 readonly=ro)["cnt"]
+        completed = pg_query_one(f"SELECT COUNT(*)::int as cnt FROM {queue} q WHERE status = 'завершён'",
+                                 readonly=ro)["cnt"]
         doctors_stats = pg_query_all(
-            """SELECT d.name, COUNT(q.id)::int as completed_count
+            f"""SELECT d.name, COUNT(q.id)::int as completed_count
                FROM public.doctors d
-               LEFT JOIN public.queue q
+               LEFT JOIN {queue} q
                  ON d.id = q.doctor_id AND q.status = 'завершён'
                GROUP BY d.id, d.name
-               ORDER BY d.id"""
+               ORDER BY d.id""",
+            readonly=ro,
         )
         return {
             "total": total,
@@ -990,12 +3493,12 @@ def get_stats():
         }
 
     conn = get_db_sqlite()
-    total = conn.execute("SELECT COUNT(*) as cnt FROM appointments").fetchone()["cnt"]
-    active = conn.execute("SELECT COUNT(*) as cnt FROM appointments WHERE status = 'активна'").fetchone()["cnt"]
-    cancelled = conn.execute("SELECT COUNT(*) as cnt FROM appointments WHERE status = 'отменена'").fetchone()["cnt"]
-    completed = conn.execute("SELECT COUNT(*) as cnt FROM queue WHERE status = 'завершён'").fetchone()["cnt"]
+    total = conn.execute(f"SELECT COUNT(*) as cnt FROM {apts} a").fetchone()["cnt"]
+    active = conn.execute(f"SELECT COUNT(*) as cnt FROM {apts} a WHERE status = 'активна'").fetchone()["cnt"]
+    cancelled = conn.execute(f"SELECT COUNT(*) as cnt FROM {apts} a WHERE status = 'отменена'").fetchone()["cnt"]
+    completed = conn.execute(f"SELECT COUNT(*) as cnt FROM {queue} q WHERE status = 'завершён'").fetchone()["cnt"]
     doctors_stats = conn.execute(
-        "SELECT d.name, COUNT(q.id) as completed_count FROM doctors d LEFT JOIN queue q ON d.id = q.doctor_id AND q.status = 'завершён' GROUP BY d.id, d.name"
+        f"SELECT d.name, COUNT(q.id) as completed_count FROM doctors d LEFT JOIN {queue} q ON d.id = q.doctor_id AND q.status = 'завершён' GROUP BY d.id, d.name"
     ).fetchall()
     conn.close()
     return {
@@ -1007,11 +3510,424 @@ def get_stats():
     }
 
 
+@app.get("/api/outbox/stats")
+def outbox_stats():
+    """Сколько уведомлений ждёт отправки / отправлено / не удалось отправить."""
+    if USE_POSTGRES:
+        rows = pg_query_all("SELECT status, COUNT(*) AS cnt FROM public.outbox GROUP BY status")
+    else:
+        conn = get_db_sqlite()
+        rows = conn.execute("SELECT status, COUNT(*) AS cnt FROM outbox GROUP BY status").fetchall()
+        conn.close()
+    stats = {"pending": 0, "sent": 0, "failed": 0}
+    stats.update({r["status"]: int(r["cnt"]) for r in rows})
+    return stats
+
+
+@app.post("/api/outbox/dispatch")
+def run_outbox_dispatch():
+    """Отправить пачку outbox сейчас, не дожидаясь фонового диспетчера."""
+    return dispatch_outbox()
+
+
+@app.post("/api/archive/run")
+def run_archive(days: int = None):
+    """Ручной запуск архивации (по умолчанию горизонт ARCHIVE_AFTER_DAYS)."""
+    if days is not None and days < 1:
+        raise HTTPException(status_code=400, detail="days должен быть >= 1")
+    return archive_old_records(days)
+
+
+# ==============================
+# Табло очереди (SSE)
+# ==============================
+# Веб-табло для телевизоров в зале ожидания (website/board.html): сервер сам
+# присылает состояние по Server-Sent Events. Табло собирается один раз на
+# изменение очереди (или раз в WAIT_REFRESH_SECONDS — оценки ожидания и
+# статусы по расписанию), все экраны получают одну и ту же строку; каждое
+# соединение лишь сравнивает версию в памяти — БД на экран не опрашивается.
+BOARD_TICK = float(os.getenv("BOARD_TICK", "0.5"))          # как часто поток проверяет версию
+BOARD_KEEPALIVE = float(os.getenv("BOARD_KEEPALIVE", "15"))  # комментарий-пинг, чтобы прокси не рвали связь
+BOARD_MAX_STREAMS = int(os.getenv("BOARD_MAX_STREAMS", "100"))
+
+_board_memo = {"key": None, "payload": None}
+_board_streams = set()
+
+
+def _board_key():
+    return queue_engine.version, _cache_gen["doctors"], int(time.monotonic() // WAIT_REFRESH_SECONDS)
+
+
+def board_payload() -> str:
+    """JSON табло: по врачу — кабинет, статус, кто на приёме/приглашён, сколько ждут, оценка ожидания.
+    Телефонов и услуг в нём нет — он показывается на общем экране."""
+    key = _board_key()
+    memo = _board_memo
+    if memo["key"] == key:
+        return memo["payload"]
+
+    by_doctor = {}
+    for item in queue_with_estimates(queue_engine.snapshot()):
+        by_doctor.setdefault(item["doctor_id"], []).append(item)
+
+    board = []
+    for doctor in get_doctors():
+        current = None
+        waiting = 0
+        next_wait = None
+        for item in by_doctor.get(doctor["id"], ()):
+            if item["status"] == "в_работе":
+                current = item
+            elif item["status"] in ("готов", "ожидание"):
+                if current is None:
+                    current = item
+                waiting += 1
+            if item["status"] == "ожидание" and next_wait is None:
+                next_wait = item.get("estimated_wait_min")
+        board.append({
+            "id": doctor["id"],
+            "name": doctor["name"],
+            "room": doctor["room"],
+            "status": doctor.get("status"),
+            "current": {"patient_name": current["patient_name"], "status": current["status"]} if current else None,
+            "waiting": waiting,
+            "next_wait_min": next_wait,
+        })
+
+    memo["key"], memo["payload"] = key, json.dumps({"doctors": board}, ensure_ascii=False, default=str)
+    return memo["payload"]
+
+
+@app.get("/api/queue/board")
+def get_queue_board():
+    """Табло одним запросом (для экранов без EventSource)."""
+    return Response(board_payload(), media_type="application/json")
+
+
+@app.get("/api/queue/stream")
+async def queue_stream(request: Request):
+    """text/event-stream: event board при каждом изменении табло, пинг раз в BOARD_KEEPALIVE."""
+    if len(_board_streams) >= BOARD_MAX_STREAMS:
+        raise HTTPException(status_code=503, detail="Слишком много подключённых экранов")
+
+    async def events():
+        stream = object()
+        _board_streams.add(stream)
+        try:
+            yield "retry: 3000\n\n"
+            last_key, last_payload = None, None
+            last_sent = time.monotonic()
+            while not await request.is_disconnected():
+                key = _board_key()
+                if key != last_key:
+                    last_key = key
+                    # первая сборка после изменения может сходить в БД (врачи) — не в event loop
+                    payload = await run_in_threadpool(board_payload)
+                    if payload != last_payload:
+                        last_payload = payload
+                        last_sent = time.monotonic()
+                        yield f"event: board\ndata: {payload}\n\n"
+                if time.monotonic() - last_sent >= BOARD_KEEPALIVE:
+                    last_sent = time.monotonic()
+                    yield ": ping\n\n"
+                await asyncio.sleep(BOARD_TICK)
+        finally:
+            _board_streams.discard(stream)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ==============================
+# Пакетные изменения (/api/batch)
+# ==============================
+# Массовые действия администратора (перенос записей врача, неявки) одним
+# запросом: операции выполняются обычными обработчиками, но в одной
+# транзакции БД — get_db_sqlite / pg_* внутри пакета берут соединение пакета,
+# а их commit/close ничего не делают. Каждая операция — под SAVEPOINT, чтобы
+# ошибка одной откатывала только её. atomic=true (по умолчанию): при первой
+# ошибке откатывается весь пакет.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "200"))
+
+
+class _BatchAborted(Exception):
+    pass
+
+
+def _batch_id(item: dict) -> int:
+    try:
+        return int(item["id"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="id required")
+
+
+BATCH_OPS = {
+    "appointment.update": lambda item: update_appointment(_batch_id(item), item.get("data") or {}),
+    "appointment.cancel": lambda item: cancel_appointment(_batch_id(item)),
+    "queue.add": lambda item: _add_to_queue({"appointment_id": item.get("appointment_id")}),
+    "queue.status": lambda item: update_queue_status(_batch_id(item), {"status": item.get("status")}),
+}
+
+
+@contextmanager
+def _batch_transaction():
+    if USE_POSTGRES:
+        conn, key = _pg_getconn()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                yield _TracedPgCursor(cur) if TRACE_ENABLED else cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            _pg_putconn(conn, key)
+        return
+
+    conn = get_db_sqlite()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        yield _BatchSqliteConnection(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _batch_item(tx, index: int, item) -> dict:
+    op = BATCH_OPS.get(item.get("op")) if isinstance(item, dict) else None
+    if op is None:
+        return {"index": index, "ok": False, "status": 400,
+                "error": f"op: одно из {', '.join(BATCH_OPS)}"}
+
+    samples = _batch_service_samples.get()
+    mark = len(samples)
+    tx.execute("SAVEPOINT batch_item")
+    try:
+        result = op(item)
+    except Exception as e:
+        del samples[mark:]  # операция откатилась — её приём не завершён
+        tx.execute("ROLLBACK TO SAVEPOINT batch_item")
+        tx.execute("RELEASE SAVEPOINT batch_item")
+        if isinstance(e, HTTPException):
+            return {"index": index, "ok": False, "status": e.status_code, "error": e.detail}
+        print(f"Ошибка операции пакета #{index}: {e}")
+        return {"index": index, "ok": False, "status": 500, "error": f"{type(e).__name__}: {e}"}
+    tx.execute("RELEASE SAVEPOINT batch_item")
+    return {"index": index, "ok": True, "status": 200, "result": result}
+
+
+@app.post("/api/batch")
+def run_batch(data: dict, idempotency_key: str | None = Header(None, alias="Idempotency-Key")):
+    """Пакет изменений записей и очереди в одной транзакции.
+    {"atomic": true, "items": [{"op": "queue.status", "id": 5, "status": "не_пришёл"},
+                               {"op": "appointment.update", "id": 7, "data": {...}}, ...]}
+    Ответ: {"committed": bool, "results": [{"index", "ok", "status", "result"|"error"}, ...]}
+    """
+    return run_idempotent(idempotency_key, "POST /api/batch", data, lambda: _run_batch(data))
+
+
+def _run_batch(data: dict):
+    items = (data or {}).get("items")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="items required")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Не больше {BATCH_MAX_ITEMS} операций в пакете")
+    atomic = bool(data.get("atomic", True))
+
+    results = []
+    samples = []
+    committed = True
+    # очередь в памяти блокируем на весь пакет: применённое в ней совпадает с тем, что зафиксировано
+    with queue_engine.writing() as q:
+        try:
+            with _batch_transaction() as tx:
+                token = _batch_tx.set(tx)
+                samples_token = _batch_service_samples.set(samples)
+                try:
+                    for index, item in enumerate(items):
+                        results.append(_batch_item(tx, index, item))
+                        if atomic and not results[-1]["ok"]:
+                            raise _BatchAborted()
+                finally:
+                    _batch_service_samples.reset(samples_token)
+                    _batch_tx.reset(token)
+            for sample in samples:
+                service_times.record(*sample)
+        except _BatchAborted:
+            committed = False
+            q.mark_stale()  # успешные операции до ошибки откатились в БД — перечитаем очередь
+        finally:
+            # обработчики сбрасывали кэш до commit — сбрасываем ещё раз, уже после
+            invalidate("slots", "queue", "doctors")
+
+    return {"committed": committed, "results": results}
+
+
+# ==============================
+# Статика сайта: отпечатки имён + предсжатие
+# ==============================
+# Brotli необязателен: без него отдаём gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+WEBSITE_DIR = os.getenv("WEBSITE_DIR", "website")
+
+# эти файлы получают имя с хэшем (style.3f2a9c1b.css) и кэшируются навсегда
+FINGERPRINT_EXTS = (".css", ".js", ".svg", ".png", ".jpg", ".jpeg", ".gif", ".ico", ".woff", ".woff2")
+# эти имеет смысл сжимать (картинки и шрифты уже сжаты)
+COMPRESS_EXTS = (".html", ".css", ".js", ".svg", ".json", ".txt", ".map")
+COMPRESS_MIN_SIZE = 256
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+
+class StaticAsset:
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        self.encoded = {}  # "br"/"gzip" -> bytes
+
+
+def _accepted_encodings(header: str) -> set:
+    """Accept-Encoding -> множество кодировок (q=0 означает «нельзя»)."""
+    result = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                pass
+        result.add(name)
+    return result
+
+
+class PrecompressedStatic:
+    """
+    ASGI-приложение для website/: всё читается и сжимается один раз при старте.
+    - css/js/картинки доступны по имени с хэшем содержимого (Cache-Control: immutable),
+      ссылки в html переписываются на эти имена;
+    - html и старые имена (style.css) — no-cache + ETag, повторный запрос получает 304;
+    - ответ выбирается по Accept-Encoding: br > gzip > без сжатия.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets = {}
+        self.fingerprints = {}  # "style.css" -> "style.3f2a9c1b.css"
+        self._build()
+
+    def _build(self):
+        files = {}
+        for root, dirs, names in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if name.startswith("."):
+                    continue
+                full = os.path.join(root, name)
+                rel = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    files[rel] = f.read()
+
+        for rel, body in files.items():
+            stem, ext = os.path.splitext(rel)
+            if ext.lower() in FINGERPRINT_EXTS:
+                digest = hashlib.sha256(body).hexdigest()[:8]
+                fp = f"{stem}.{digest}{ext}"
+                self.fingerprints[rel] = fp
+                self._add(fp, body, CACHE_IMMUTABLE)
+
+        for rel, body in files.items():
+            if rel.lower().endswith((".html", ".htm")):
+                body = self._rewrite_links(body)
+            self._add(rel, body, CACHE_REVALIDATE)
+
+    def _rewrite_links(self, body: bytes) -> bytes:
+        if not self.fingerprints:
+            return body
+        text = body.decode("utf-8")
+
+        def repl(m):
+            prefix, slash, ref = m.group(1), m.group(2), m.group(3)
+            fp = self.fingerprints.get(ref)
+            return f"{prefix}{slash}{fp}" if fp else m.group(0)
+
+        text = re.sub(r'((?:href|src)=["\'])(/?)([^"\'?#:]+)', repl, text)
+        return text.encode("utf-8")
+
+    def _add(self, rel: str, body: bytes, cache_control: str):
+        media_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+        asset = StaticAsset(body, media_type, cache_control)
+        if rel.lower().endswith(COMPRESS_EXTS) and len(body) >= COMPRESS_MIN_SIZE:
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                asset.encoded["gzip"] = gz
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    asset.encoded["br"] = br
+        self.assets[rel] = asset
+
+    async def __call__(self, scope, receive, send):
+        if scope["method"] not in ("GET", "HEAD"):
+            await Response("Method Not Allowed", status_code=405, media_type="text/plain")(scope, receive, send)
+            return
+
+        rel = scope["path"].lstrip("/")
+        if rel == "" or rel.endswith("/"):
+            rel += "index.html"
+        asset = self.assets.get(rel)
+        if asset is None:
+            await Response("Not Found", status_code=404, media_type="text/plain")(scope, receive, send)
+            return
+
+        req_headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        headers = {
+            "Cache-Control": asset.cache_control,
+            "ETag": asset.etag,
+            "Vary": "Accept-Encoding",
+        }
+        if asset.etag in [t.strip() for t in req_headers.get("if-none-match", "").split(",")]:
+            await Response(status_code=304, headers=headers)(scope, receive, send)
+            return
+
+        body = asset.body
+        accepted = _accepted_encodings(req_headers.get("accept-encoding", ""))
+        for enc in ("br", "gzip"):
+            if enc in asset.encoded and enc in accepted:
+                body = asset.encoded[enc]
+                headers["Content-Encoding"] = enc
+                break
+
+        await Response(body, media_type=asset.media_type, headers=headers)(scope, receive, send)
+
+
 # Чтобы backend-url мог отдавать фронт-страницу и статику (если хочешь)
-if os.path.isdir("website"):
-    # /style.css, /script.js и т.п.
-    app.mount("/", StaticFiles(directory="website", html=True), name="website")
+if os.path.isdir(WEBSITE_DIR):
+    # /, /style.<hash>.css, /script.<hash>.js и т.п.
+    app.mount("/", PrecompressedStatic(WEBSITE_DIR), name="website")
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if WORKERS > 1:
+        # несколько процессов: uvicorn сам импортирует server:app в каждом воркере
+        uvicorn.run("server:app", host="0.0.0.0", port=port, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,73 @@
+"""Общие фикстуры: сервер на копии dental_clinic.db (SQLite) и TestClient без сети."""
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Окружение — до импорта server/queue_program: они читают его при импорте
+_tmp = tempfile.mkdtemp(prefix="dental-tests-")
+shutil.copy(os.path.join(APP_DIR, "dental_clinic.db"), os.path.join(_tmp, "db.sqlite"))
+os.environ["DATABASE_URL"] = ""
+os.environ["SQLITE_PATH"] = os.path.join(_tmp, "db.sqlite")
+os.environ["DATA_DIR"] = _tmp
+os.environ["OFFLINE_DB"] = os.path.join(_tmp, "queue_offline.db")
+os.environ["OUTBOX_CHANNEL"] = "stub"
+os.environ["ARCHIVE_AFTER_DAYS"] = "0"  # архиватор не трогает записи во время тестов
+os.environ["RATE_LIMITS"] = "booking=1000/1000,slots=1000/1000,read=1000/1000,write=1000/1000"
+sys.path.insert(0, APP_DIR)
+
+
+@pytest.fixture(scope="session")
+def server():
+    import server as server_module
+
+    return server_module
+
+
+@pytest.fixture(scope="session")
+def client(server):
+    from fastapi.testclient import TestClient
+
+    with TestClient(server.app) as c:  # с startup: init БД, очередь в памяти
+        yield c
+
+
+def _slot_times(data):
+    return [t if isinstance(t, str) else t.get("time") for t in data if isinstance(t, str) or t.get("available", True)]
+
+
+@pytest.fixture
+def free_slots(client):
+    """free_slots(n) -> (doctor_id, date, [n свободных времён]) — день и врач, у которого они есть."""
+
+    def find(n=1):
+        doctors = client.get("/api/doctors").json()
+        for days in range(7, 60):
+            day = (date.today() + timedelta(days=days)).strftime("%Y-%m-%d")
+            for doctor in doctors:
+                r = client.get("/api/available-slots", params={"date": day, "doctor_id": doctor["id"]})
+                times = _slot_times(r.json()) if r.status_code == 200 else []
+                if len(times) >= n:
+                    return doctor["id"], day, times[:n]
+        pytest.skip("нет свободных слотов в тестовой базе")
+
+    return find
+
+
+@pytest.fixture
+def book(client):
+    """book(doctor_id, date, time, **поля) -> id новой записи."""
+
+    def create(doctor_id, day, time, **fields):
+        payload = {"patient_name": "Тест Пациент", "phone": "+992900000000",
+                   "doctor_id": doctor_id, "appointment_date": day, "appointment_time": time, **fields}
+        r = client.post("/api/appointments", json=payload)
+        assert r.status_code == 200, r.text
+        return r.json()["id"]
+
+    return create
@@ -0,0 +1,70 @@
+"""GET /api/appointments: фильтры и keyset-пагинация по next_cursor."""
+
+
+def _pages(client, **params):
+    items, cursor, pages = [], None, 0
+    while True:
+        r = client.get("/api/appointments", params={**params, **({"cursor": cursor} if cursor else {})})
+        assert r.status_code == 200, r.text
+        body = r.json()
+        items.extend(body["items"])
+        pages += 1
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return items, pages
+
+
+def test_keyset_pages_match_single_page(client, free_slots, book):
+    doctor_id, day, times = free_slots(5)
+    created = [book(doctor_id, day, t) for t in times]
+    params = {"date_from": day, "date_to": day, "doctor_id": doctor_id}
+
+    paged, pages = _pages(client, **params, limit=2)
+    whole = client.get("/api/appointments", params={**params, "limit": 100}).json()["items"]
+
+    assert pages == (len(whole) + 1) // 2
+    assert [i["id"] for i in paged] == [i["id"] for i in whole]  # без повторов и пропусков
+    assert [i["id"] for i in paged if i["id"] in created] == created  # время по возрастанию
+
+
+def test_keyset_desc_order(client, free_slots, book):
+    doctor_id, day, times = free_slots(3)
+    created = [book(doctor_id, day, t) for t in times]
+
+    items, _ = _pages(client, date_from=day, date_to=day, doctor_id=doctor_id, limit=1, order="desc")
+
+    assert len({i["id"] for i in items}) == len(items)
+    assert [i["id"] for i in items if i["id"] in created] == created[::-1]
+
+
+def test_cursor_only_while_more_rows(client, free_slots, book):
+    doctor_id, day, times = free_slots(2)
+    for t in times:
+        book(doctor_id, day, t)
+    params = {"date_from": day, "date_to": day, "doctor_id": doctor_id}
+    total = len(client.get("/api/appointments", params={**params, "limit": 100}).json()["items"])
+
+    short = client.get("/api/appointments", params={**params, "limit": total - 1}).json()
+    full = client.get("/api/appointments", params={**params, "limit": total}).json()
+
+    assert short["next_cursor"] is not None
+    assert full["next_cursor"] is None
+    assert len(full["items"]) == total
+
+
+def test_status_filter(client, free_slots, book):
+    doctor_id, day, (time, cancelled_time) = free_slots(2)
+    active = book(doctor_id, day, time)
+    cancelled = book(doctor_id, day, cancelled_time)
+    client.put(f"/api/appointments/{cancelled}/cancel")
+    params = {"date_from": day, "date_to": day, "doctor_id": doctor_id}
+
+    def ids(status):
+        r = client.get("/api/appointments", params={**params, "status": status})
+        assert r.status_code == 200, r.text
+        return {i["id"] for i in r.json()["items"]} & {active, cancelled}
+
+    assert ids("активна") == {active}
+    assert ids("активна, отменена") == {active, cancelled}
+    assert ids(",") == {active, cancelled}  # пустой список — без фильтра, а не IN ()
+    assert ids(" , ") == {active, cancelled}
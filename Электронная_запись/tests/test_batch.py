@@ -0,0 +1,69 @@
+"""POST /api/batch: атомарный пакет откатывается целиком, если одна операция не прошла."""
+
+
+def _appointment(client, day, apt_id):
+    return next(a for a in client.get("/api/appointments/today", params={"date": day}).json() if a["id"] == apt_id)
+
+
+def test_atomic_batch_rolls_back_on_failed_item(client, free_slots, book):
+    doctor_id, day, (time, new_time) = free_slots(2)
+    apt_id = book(doctor_id, day, time)
+
+    r = client.post("/api/batch", json={"atomic": True, "items": [
+        {"op": "appointment.update", "id": apt_id, "data": {"appointment_time": new_time}},
+        {"op": "queue.status", "id": 99999999, "status": "готов"},
+    ]})
+
+    assert r.status_code == 200, r.text
+    body = r.json()
+    assert body["committed"] is False
+    assert body["results"][0]["ok"] is True
+    assert body["results"][1]["ok"] is False
+    assert _appointment(client, day, apt_id)["appointment_time"] == time  # первая операция откатилась
+
+
+def test_non_atomic_batch_keeps_successful_items(client, free_slots, book):
+    doctor_id, day, (time, new_time) = free_slots(2)
+    apt_id = book(doctor_id, day, time)
+
+    body = client.post("/api/batch", json={"atomic": False, "items": [
+        {"op": "appointment.update", "id": apt_id, "data": {"appointment_time": new_time}},
+        {"op": "nope"},
+    ]}).json()
+
+    assert body["committed"] is True
+    assert [r["ok"] for r in body["results"]] == [True, False]
+    assert _appointment(client, day, apt_id)["appointment_time"] == new_time
+
+
+def test_unknown_op_aborts_atomic_batch(client, free_slots, book):
+    doctor_id, day, (time,) = free_slots(1)
+    apt_id = book(doctor_id, day, time)
+
+    body = client.post("/api/batch", json={"items": [
+        {"op": "appointment.cancel", "id": apt_id},
+        {"op": "nope"},
+    ]}).json()
+
+    assert body["committed"] is False
+    assert _appointment(client, day, apt_id)["status"] == "активна"
+
+
+def test_rolled_back_completion_not_in_service_times(client, server, free_slots, book):
+    doctor_id, day, (time,) = free_slots(1)
+    queue_id = client.post("/api/queue", json={"appointment_id": book(doctor_id, day, time)}).json()["id"]
+    assert client.put(f"/api/queue/{queue_id}/status", json={"status": "в_работе"}).status_code == 200
+    version = server.service_times.version
+
+    body = client.post("/api/batch", json={"items": [
+        {"op": "queue.status", "id": queue_id, "status": "завершён"},
+        {"op": "nope"},
+    ]}).json()
+
+    assert body["committed"] is False
+    assert server.service_times.version == version  # приём не завершён — в статистику не попал
+
+    body = client.post("/api/batch", json={"items": [{"op": "queue.status", "id": queue_id, "status": "завершён"}]}).json()
+
+    assert body["committed"] is True
+    assert server.service_times.version == version + 1
@@ -0,0 +1,21 @@
+"""IP клиента для лимитов: X-Forwarded-For учитывается только за доверенным прокси."""
+from types import SimpleNamespace
+
+
+def _request(forwarded=None):
+    headers = {"x-forwarded-for": forwarded} if forwarded else {}
+    return SimpleNamespace(headers=headers, client=SimpleNamespace(host="10.0.0.1"))
+
+
+def test_forwarded_for_ignored_by_default(server):
+    assert server.client_ip(_request("1.2.3.4")) == "10.0.0.1"
+
+
+def test_forwarded_for_takes_hop_added_by_proxy(server, monkeypatch):
+    monkeypatch.setattr(server, "TRUST_FORWARDED_FOR", True)
+    # левый адрес прислал клиент, правый дописал прокси
+    assert server.client_ip(_request("6.6.6.6, 1.2.3.4")) == "1.2.3.4"
+
+    monkeypatch.setattr(server, "TRUSTED_PROXY_COUNT", 2)
+    assert server.client_ip(_request("6.6.6.6, 1.2.3.4, 172.16.0.5")) == "1.2.3.4"
+    assert server.client_ip(_request("1.2.3.4")) == "10.0.0.1"
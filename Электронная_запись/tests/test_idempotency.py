@@ -0,0 +1,50 @@
+"""Idempotency-Key: повтор POST с тем же ключом не создаёт дубль."""
+import uuid
+
+
+def _payload(doctor_id, day, time, name="Идемпотентный Тест"):
+    return {"patient_name": name, "phone": "+992900000001", "doctor_id": doctor_id,
+            "appointment_date": day, "appointment_time": time}
+
+
+def test_same_key_replays_response(client, free_slots):
+    doctor_id, day, (time,) = free_slots(1)
+    key = str(uuid.uuid4())
+
+    first = client.post("/api/appointments", json=_payload(doctor_id, day, time), headers={"Idempotency-Key": key})
+    second = client.post("/api/appointments", json=_payload(doctor_id, day, time), headers={"Idempotency-Key": key})
+
+    assert first.status_code == 200, first.text
+    assert second.status_code == 200, second.text
+    assert second.json()["id"] == first.json()["id"]
+    assert second.headers.get("Idempotent-Replayed") == "true"
+    assert "Idempotent-Replayed" not in first.headers
+
+    rows = client.get("/api/appointments/today", params={"date": day}).json()
+    assert sum(r["id"] == first.json()["id"] for r in rows) == 1
+
+
+def test_same_key_other_body_is_rejected(client, free_slots):
+    doctor_id, day, (time, other_time) = free_slots(2)
+    key = str(uuid.uuid4())
+
+    first = client.post("/api/appointments", json=_payload(doctor_id, day, time), headers={"Idempotency-Key": key})
+    other = client.post("/api/appointments", json=_payload(doctor_id, day, other_time), headers={"Idempotency-Key": key})
+
+    assert first.status_code == 200, first.text
+    assert other.status_code == 422
+    assert other_time in [t if isinstance(t, str) else t["time"] for t in
+                          client.get("/api/available-slots", params={"date": day, "doctor_id": doctor_id}).json()]
+
+
+def test_error_response_is_replayed_too(client, free_slots, book):
+    doctor_id, day, (time,) = free_slots(1)
+    book(doctor_id, day, time)
+    key = str(uuid.uuid4())
+
+    first = client.post("/api/appointments", json=_payload(doctor_id, day, time), headers={"Idempotency-Key": key})
+    second = client.post("/api/appointments", json=_payload(doctor_id, day, time), headers={"Idempotency-Key": key})
+
+    assert first.status_code == 400  # время занято
+    assert second.status_code == 400
+    assert second.headers.get("Idempotent-Replayed") == "true"
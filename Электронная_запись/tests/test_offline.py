@@ -0,0 +1,182 @@
+"""Программа очереди без связи: наложение outbox на копию (apply_pending) и проверка конфликтов при отправке."""
+import asyncio
+
+import httpx
+import pytest
+
+import queue_program as qp
+
+
+@pytest.fixture
+def store(tmp_path):
+    return qp.OfflineStore(str(tmp_path / "offline.db"))
+
+
+def _view(store, key, rows):
+    return qp.apply_pending(key, rows, store.pending(), store.server_id)
+
+
+# ---------- apply_pending ----------
+def test_queued_create_shows_in_day_and_takes_slot(store):
+    data = {"patient_name": "Офлайн", "phone": "+992900000002", "doctor_id": 1,
+            "appointment_date": "2030-01-10", "appointment_time": "09:00"}
+    entry_id = store.enqueue("appointment.create", {"data": data}, {"doctor_name": "Врач", "room": "Кабинет 1"})
+
+    day = _view(store, "appointments:2030-01-10", [{"id": 5, "appointment_time": "10:00"}])
+    slots = _view(store, "slots:2030-01-10:1", ["08:30", "09:00", "09:30"])
+
+    assert [r["id"] for r in day] == [-entry_id, 5]  # по времени
+    assert day[0]["room"] == "Кабинет 1"
+    assert slots == ["08:30", "09:30"]
+    assert _view(store, "appointments:2030-01-11", []) == []
+
+
+def test_queued_move_leaves_old_day(store):
+    row = {"id": 7, "patient_name": "П", "doctor_id": 1, "appointment_date": "2030-01-10", "appointment_time": "09:00"}
+    store.enqueue("appointment.update", {"id": 7, "data": {"appointment_date": "2030-01-11"}}, {"row": row})
+
+    assert _view(store, "appointments:2030-01-10", [dict(row)]) == []
+    assert [r["id"] for r in _view(store, "appointments:2030-01-11", [])] == [7]
+
+
+def test_queued_status_and_cancel_update_queue(store):
+    rows = [{"id": 1, "appointment_id": 10, "status": "ожидание"},
+            {"id": 2, "appointment_id": 11, "status": "ожидание"},
+            {"id": 3, "appointment_id": 12, "status": "ожидание"}]
+    store.enqueue("queue.status", {"id": 1, "data": {"status": "готов"}})
+    store.enqueue("queue.status", {"id": 2, "data": {"status": "завершён"}})
+    store.enqueue("appointment.cancel", {"id": 12})
+
+    assert [(r["id"], r["status"]) for r in _view(store, "queue", rows)] == [(1, "готов")]
+
+
+def test_local_id_maps_to_server_id_after_flush(store):
+    created = store.enqueue("queue.add", {"data": {"appointment_id": 10}}, {"patient_name": "П"})
+    store.enqueue("queue.status", {"id": -created, "data": {"status": "готов"}})
+    store.done(created, server_id=42)
+
+    rows = _view(store, "queue", [{"id": 42, "appointment_id": 10, "status": "ожидание"}])
+
+    assert [(r["id"], r["status"]) for r in rows] == [(42, "готов")]
+
+
+# ---------- отправка outbox и конфликты (против server.app, без сети) ----------
+@pytest.fixture
+def database(client, server, store):
+    """Database с клиентом httpx прямо к server.app; без потока ApiLoop — корутины запускаются в тесте."""
+    db = object.__new__(qp.Database)
+    db.api_base = "http://testserver"
+    db.offline = store
+    db.online = True
+    db._etags, db._fresh = {}, {}
+    db._writes = 0
+    db._httpx = httpx
+    db.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app))
+    return db
+
+
+def _server_row(client, day, apt_id):
+    return next(a for a in client.get("/api/appointments/today", params={"date": day}).json() if a["id"] == apt_id)
+
+
+def test_offline_move_is_sent_when_server_unchanged(client, database, free_slots, book):
+    doctor_id, day, (time, new_time) = free_slots(2)
+    apt_id = book(doctor_id, day, time)
+
+    async def scenario():
+        await database.get_appointments(day)  # копия — то, что видел администратор
+        database.online = False
+        queued = await database.update_appointment(apt_id, appointment_time=new_time)
+        return queued, await database.flush_outbox()
+
+    queued, flushed = asyncio.run(scenario())
+
+    assert queued["queued"] is True
+    assert flushed is True
+    assert database.offline.take_conflicts() == []
+    assert _server_row(client, day, apt_id)["appointment_time"] == new_time
+
+
+def test_offline_move_conflicts_with_server_change(client, database, free_slots, book):
+    doctor_id, day, (time, my_time, their_time) = free_slots(3)
+    apt_id = book(doctor_id, day, time)
+
+    async def scenario():
+        await database.get_appointments(day)
+        database.online = False
+        await database.update_appointment(apt_id, appointment_time=my_time)
+        # пока администратор был без связи, запись перенесли на сайте/с другого места
+        assert client.put(f"/api/appointments/{apt_id}", json={"appointment_time": their_time}).status_code == 200
+        return await database.flush_outbox()
+
+    assert asyncio.run(scenario()) is True
+    conflicts = database.offline.take_conflicts()
+    assert [c["op"] for c in conflicts] == ["appointment.update"]
+    assert their_time in conflicts[0]["error"]
+    assert _server_row(client, day, apt_id)["appointment_time"] == their_time  # чужое изменение не затёрто
+
+
+def test_offline_move_already_applied_is_dropped(client, database, free_slots, book):
+    doctor_id, day, (time, new_time) = free_slots(2)
+    apt_id = book(doctor_id, day, time)
+
+    async def scenario():
+        await database.get_appointments(day)
+        database.online = False
+        await database.update_appointment(apt_id, appointment_time=new_time)
+        # PUT ушёл по таймауту, но сервер его применил
+        assert client.put(f"/api/appointments/{apt_id}", json={"appointment_time": new_time}).status_code == 200
+        return await database.flush_outbox()
+
+    assert asyncio.run(scenario()) is True
+    assert database.offline.take_conflicts() == []
+    assert database.offline.pending() == []
+    assert _server_row(client, day, apt_id)["appointment_time"] == new_time
+
+
+def _offline_close(client, database, queue_id, mine, theirs):
+    async def scenario():
+        await database.get_queue()
+        database.online = False
+        await database.update_queue_status(queue_id, mine)
+        # пока администратор был без связи, пациента закрыли в другом месте
+        assert client.put(f"/api/queue/{queue_id}/status", json={"status": theirs}).status_code == 200
+        return await database.flush_outbox()
+
+    assert asyncio.run(scenario()) is True
+    assert database.offline.pending() == []
+    return database.offline.take_conflicts()
+
+
+def test_offline_no_show_already_applied_is_dropped(client, database, free_slots, book):
+    doctor_id, day, (time,) = free_slots(1)
+    apt_id = book(doctor_id, day, time)
+    queue_id = client.post("/api/queue", json={"appointment_id": apt_id}).json()["id"]
+
+    assert _offline_close(client, database, queue_id, "не_пришёл", "не_пришёл") == []
+
+
+def test_offline_no_show_conflicts_when_closed_as_done(client, database, free_slots, book):
+    doctor_id, day, (time,) = free_slots(1)
+    apt_id = book(doctor_id, day, time)
+    queue_id = client.post("/api/queue", json={"appointment_id": apt_id}).json()["id"]
+
+    conflicts = _offline_close(client, database, queue_id, "не_пришёл", "завершён")
+
+    assert [c["op"] for c in conflicts] == ["queue.status"]
+    assert "нет в очереди" in conflicts[0]["error"]
+
+
+def test_refresh_after_write_does_not_join_earlier_request(database, free_slots, book):
+    doctor_id, day, (time, new_time) = free_slots(2)
+    apt_id = book(doctor_id, day, time)
+    keys = []
+    database.submit = lambda make_coro, callback=None, key=None, group=None: keys.append(key)
+
+    database.get_queue_async(None)
+    database.get_queue_async(None)  # без изменений между ними — тот же запрос
+    asyncio.run(database.update_appointment(apt_id, appointment_time=new_time))
+    database.get_queue_async(None)
+
+    assert keys[0] == keys[1]
+    assert keys[2] != keys[1]
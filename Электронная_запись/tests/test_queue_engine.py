@@ -0,0 +1,29 @@
+"""Очередь в памяти: сколько активных пациентов останется у врача после закрытия строк."""
+
+
+def _engine(server, rows):
+    engine = server.QueueEngine()
+    engine._rebuild([{"appointment_id": None, "called_at": None, **row} for row in rows])
+    return engine
+
+
+def test_closing_inactive_row_keeps_active_count(server):
+    engine = _engine(server, [
+        {"id": 1, "doctor_id": 1, "status": "вызван"},
+        {"id": 2, "doctor_id": 1, "status": "в_работе"},
+    ])
+
+    # «вызван» не в активных дорожках — после его закрытия у врача всё ещё пациент на приёме
+    assert server._active_after_close(engine, 1, [1]) == 1
+    assert server._active_after_close(engine, 1, [2]) == 0
+
+
+def test_closing_counts_each_row_once_and_only_for_doctor(server):
+    engine = _engine(server, [
+        {"id": 1, "doctor_id": 1, "status": "ожидание"},
+        {"id": 2, "doctor_id": 1, "status": "готов"},
+        {"id": 3, "doctor_id": 2, "status": "ожидание"},
+    ])
+
+    assert server._active_after_close(engine, 1, [1, 1, 3]) == 1
+    assert server._active_after_close(engine, 1, [1, 2, 99]) == 0
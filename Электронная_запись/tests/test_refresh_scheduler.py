@@ -0,0 +1,36 @@
+"""Автообновление панели: ошибка в обновлении не останавливает RefreshScheduler."""
+import pytest
+
+import queue_program as qp
+
+
+class FakeRoot:
+    def __init__(self):
+        self.jobs = []
+
+    def bind(self, *args, **kwargs):
+        pass
+
+    def after(self, ms, func):
+        self.jobs.append(func)
+        return len(self.jobs)
+
+    def after_cancel(self, job):
+        pass
+
+    def state(self):
+        return "normal"
+
+
+def test_failed_refresh_schedules_next_tick():
+    def refresh(done):
+        raise RuntimeError("ошибка отрисовки")
+
+    root = FakeRoot()
+    scheduler = qp.RefreshScheduler(root, refresh)
+    scheduler.now()
+    with pytest.raises(RuntimeError):
+        root.jobs[-1]()
+
+    assert scheduler.running is False
+    assert len(root.jobs) == 2  # следующее обновление запланировано
@@ -0,0 +1,117 @@
+// Табло зала ожидания: состояние приходит с сервера по SSE (/api/queue/stream).
+// Карточка врача создаётся один раз, дальше меняется только её текст.
+const cards = {};
+const POLL_INTERVAL = 5000;  // если EventSource недоступен — опрос /api/queue/board
+
+document.addEventListener('DOMContentLoaded', function() {
+    updateClock();
+    setInterval(updateClock, 1000);
+    connect();
+});
+
+function updateClock() {
+    const now = new Date();
+    document.getElementById('clock').textContent =
+        now.toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' });
+}
+
+function connect() {
+    if (!window.EventSource) {
+        poll();
+        return;
+    }
+    const source = new EventSource('/api/queue/stream');
+    source.addEventListener('board', function(e) {
+        setOffline(false);
+        render(JSON.parse(e.data));
+    });
+    // EventSource сам переподключается (retry от сервера), показываем только плашку
+    source.onerror = function() {
+        setOffline(true);
+    };
+}
+
+function poll() {
+    fetch('/api/queue/board')
+        .then(response => response.json())
+        .then(data => {
+            setOffline(false);
+            render(data);
+        })
+        .catch(() => setOffline(true))
+        .finally(() => setTimeout(poll, POLL_INTERVAL));
+}
+
+function setOffline(offline) {
+    document.getElementById('offline').hidden = !offline;
+}
+
+function createCard() {
+    const card = document.createElement('div');
+    card.className = 'card';
+    card.innerHTML =
+        '<div class="card-room"></div>' +
+        '<div class="card-name"></div>' +
+        '<div class="card-state"></div>' +
+        '<div class="card-patient"></div>' +
+        '<div class="card-wait"></div>';
+    return {
+        root: card,
+        room: card.querySelector('.card-room'),
+        name: card.querySelector('.card-name'),
+        state: card.querySelector('.card-state'),
+        patient: card.querySelector('.card-patient'),
+        wait: card.querySelector('.card-wait'),
+    };
+}
+
+function setText(el, text) {
+    if (el.textContent !== text) el.textContent = text;
+}
+
+function cardState(doctor) {
+    if (doctor.current && doctor.current.status === 'в_работе') return ['ИДЁТ ПРИЁМ', 'in-work'];
+    if (doctor.current && doctor.current.status === 'готов') return ['ПРИГЛАШАЕМ', 'called'];
+    if (doctor.current) return ['ОЖИДАНИЕ', 'waiting'];
+    if (doctor.status === 'выходной') return ['ВЫХОДНОЙ', 'off'];
+    if (doctor.status === 'перерыв') return ['ПЕРЕРЫВ', 'off'];
+    return ['СВОБОДНО', 'free'];
+}
+
+function render(data) {
+    const board = document.getElementById('board');
+    const seen = new Set();
+
+    data.doctors.forEach((doctor, index) => {
+        seen.add(String(doctor.id));
+        let card = cards[doctor.id];
+        if (!card) {
+            card = cards[doctor.id] = createCard();
+        }
+        if (board.children[index] !== card.root) {
+            board.insertBefore(card.root, board.children[index] || null);
+        }
+
+        const [stateText, stateClass] = cardState(doctor);
+        setText(card.room, doctor.room);
+        setText(card.name, doctor.name);
+        setText(card.state, stateText);
+        card.state.className = 'card-state ' + stateClass;
+
+        let patient = '';
+        if (doctor.current && doctor.current.status !== 'ожидание') {
+            patient = doctor.current.patient_name;
+        } else if (doctor.waiting > 0) {
+            patient = `${doctor.waiting} чел.`;
+        }
+        setText(card.patient, patient);
+        setText(card.wait, doctor.next_wait_min != null ? `Ожидание ≈ ${doctor.next_wait_min} мин` : '');
+    });
+
+    Object.keys(cards).forEach(id => {
+        if (!seen.has(id)) {
+            cards[id].root.remove();
+            delete cards[id];
+        }
+    });
+}
@@ -1,4 +1,9 @@
 let selectedTime = null;
+// Свободные слоты по дням месяца: `${doctorId}|${YYYY-MM}` -> [{date, free, total, day_off}]
+const monthCache = {};
+// Ключ идемпотентности текущей попытки записи: повтор после таймаута не создаст дубль
+let bookingKey = null;
+const BOOKING_RETRIES = 2;
 
 document.addEventListener('DOMContentLoaded', function() {
     setTimeout(function() {
@@ -17,8 +22,14 @@ function setMinDate() {
 }
 
 function setupEventListeners() {
-    document.getElementById('doctor').addEventListener('change', loadTimeSlots);
-    document.getElementById('date').addEventListener('change', loadTimeSlots);
+    document.getElementById('doctor').addEventListener('change', function() {
+        loadTimeSlots();
+        loadMonthAvailability();
+    });
+    document.getElementById('date').addEventListener('change', function() {
+        loadTimeSlots();
+        loadMonthAvailability();
+    });
     
     document.getElementById('phone').addEventListener('input', function(e) {
         let value = e.target.value.replace(/\D/g, '');
@@ -117,6 +128,78 @@ function loadTimeSlots() {
         });
 }
 
+// Ключ monthCache для выбранных сейчас врача и месяца (null — врач не выбран)
+function currentMonthKey() {
+    const doctorId = document.getElementById('doctor').value;
+    const date = document.getElementById('date').value;
+    if (!doctorId) {
+        return null;
+    }
+    const month = (date || new Date().toISOString().split('T')[0]).slice(0, 7);
+    return `${doctorId}|${month}`;
+}
+
+function loadMonthAvailability() {
+    const container = document.getElementById('monthDays');
+    const key = currentMonthKey();
+
+    if (!key) {
+        container.innerHTML = '';
+        return;
+    }
+
+    const [doctorId, month] = key.split('|');
+    if (monthCache[key]) {
+        renderMonthDays(monthCache[key]);
+        return;
+    }
+
+    // один запрос на весь месяц вместо запроса слотов по каждому дню
+    fetch(`/api/available-slots/month?doctor_id=${doctorId}&month=${month}`)
+        .then(response => response.json())
+        .then(data => {
+            monthCache[key] = data.days || [];
+            // пока шёл запрос, могли сменить врача или месяц — чужой ответ не рисуем
+            if (currentMonthKey() === key) {
+                renderMonthDays(monthCache[key]);
+            }
+        })
+        .catch(error => {
+            console.error('Ошибка загрузки календаря:', error);
+            if (currentMonthKey() === key) {
+                container.innerHTML = '';
+            }
+        });
+}
+
+function renderMonthDays(days) {
+    const container = document.getElementById('monthDays');
+    const dateInput = document.getElementById('date');
+    const today = new Date().toISOString().split('T')[0];
+    container.innerHTML = '';
+
+    days.filter(day => day.date >= today).forEach(day => {
+        const div = document.createElement('div');
+        let state = '';
+        if (day.day_off) state = ' off';
+        else if (day.free === 0) state = ' full';
+        else if (day.free <= 3) state = ' few';
+        div.className = 'day-cell' + state + (day.date === dateInput.value ? ' selected' : '');
+        div.innerHTML = `${Number(day.date.slice(8))}<small>${day.day_off ? 'вых.' : day.free}</small>`;
+        div.title = day.day_off ? 'Врач не принимает' : `Свободно: ${day.free}`;
+
+        if (!day.day_off && day.free > 0) {
+            div.addEventListener('click', function() {
+                dateInput.value = day.date;
+                loadTimeSlots();
+                renderMonthDays(days);
+            });
+        }
+
+        container.appendChild(div);
+    });
+}
+
 function submitBooking() {
     const name = document.getElementById('patientName').value.trim();
     const phone = document.getElementById('phone').value.trim();
@@ -165,18 +248,22 @@ function submitBooking() {
         service_name: serviceName || null
     };
     
-    fetch('/api/appointments', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify(data)
-    })
+    // тот же ключ для тех же данных: повторное нажатие после сбоя сети безопасно
+    const fingerprint = JSON.stringify(data);
+    if (!bookingKey || bookingKey.fingerprint !== fingerprint) {
+        bookingKey = { fingerprint: fingerprint, key: newIdempotencyKey() };
+    }
+    
+    postBooking(data, bookingKey.key, BOOKING_RETRIES)
     .then(response => response.json())
     .then(result => {
+        // занятость месяца изменилась (или время уже заняли) — при следующем показе запросим заново
+        delete monthCache[`${data.doctor_id}|${data.appointment_date.slice(0, 7)}`];
         if (result.success || result.id) {
+            bookingKey = null;
             showConfirmation(data, doctorName);
         } else {
+            loadMonthAvailability();
             alert('Ошибка при записи. Попробуйте снова.');
         }
     })
@@ -186,6 +273,32 @@ function submitBooking() {
     });
 }
 
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+}
+
+function postBooking(data, key, retriesLeft) {
+    return fetch('/api/appointments', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': key
+        },
+        body: JSON.stringify(data)
+    })
+    .catch(error => {
+        // сетевая ошибка: повторяем с тем же ключом — сервер не создаст дубль
+        if (retriesLeft > 0) {
+            return new Promise(resolve => setTimeout(resolve, 1000))
+                .then(() => postBooking(data, key, retriesLeft - 1));
+        }
+        throw error;
+    });
+}
+
 function showConfirmation(data, doctorName) {
     document.getElementById('bookingForm').style.display = 'none';
     document.getElementById('confirmation').style.display = 'block';